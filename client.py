@@ -3,12 +3,31 @@ import json
 import argparse
 import time
 import threading
+import uuid
 import gui
 from tkinter import messagebox
 
 # global variable for tracking connected server instances
 connected_servers = []
 
+# read-only commands that may be answered by any replica; the same set as the server's
+# READ_COMMANDS
+READ_ONLY_COMMANDS = {"search", "get_delivered", "refresh_home", "get_messages_since", "get_conversation"}
+# spread read-only commands over every connected server instead of only the first
+follower_reads = False
+# replication position of this client's latest write, sent with reads so a replica
+# that has not caught up with it hands the read to the leader
+session_token = {}
+# socket the last request went out on; its reply is read from the same socket
+reply_socket = None
+reads_sent = 0
+# commands that change server state; each is sent with a fresh request id so a retry
+# on another server is answered from that server's dedup cache instead of applied twice
+WRITE_COMMANDS = {"create", "login", "logout", "delete_acct", "send_msg", "get_undelivered", "delete_msg"}
+# the last request sent, kept so it can be resent if its server goes away before replying;
+# reads are safe to repeat and writes carry their request id
+pending_request = None
+
 def retrieve_active_socket():
     # retrieves an active socket connection if available
     global connected_servers
@@ -16,6 +35,67 @@ def retrieve_active_socket():
         return None
     return connected_servers[0][1]
 
+def retrieve_reply_socket():
+    # the socket the reply to the last request will arrive on
+    for _, conn in connected_servers:
+        if conn is reply_socket:
+            return conn
+    return retrieve_active_socket()
+
+def record_session_token(token):
+    # keep the furthest position seen for each origin
+    for origin, index in token.items():
+        session_token[origin] = max(session_token.get(origin, 0), index)
+
+class RequestRouter:
+    # socket-like sender handed to the gui: writes go to the first server, reads rotate
+    # over all connected servers when follower reads are enabled
+    def sendall(self, message):
+        global reply_socket, reads_sent, pending_request
+        request = json.loads(message.decode("utf-8").rstrip("\0"))
+        if request["command"] in WRITE_COMMANDS:
+            request["data"]["request_id"] = uuid.uuid4().hex
+            message = (json.dumps(request) + "\0").encode("utf-8")
+        servers = list(connected_servers)
+        if not servers:
+            raise ConnectionError("no server connected")
+        sock = servers[0][1]
+        if request["command"] in READ_ONLY_COMMANDS:
+            if session_token:
+                request["data"]["session"] = dict(session_token)
+                message = (json.dumps(request) + "\0").encode("utf-8")
+            if follower_reads:
+                reads_sent += 1
+                sock = servers[reads_sent % len(servers)][1]
+        reply_socket = sock
+        pending_request = message
+        sock.sendall(message)
+
+def receive_reply(sock):
+    # read the reply to the last request; if the connection dies before it arrives (the
+    # server crashed or is draining for a restart) the request is resent once to another server
+    global reply_socket
+    try:
+        data = sock.recv(1024)
+    except OSError:
+        data = b""
+    if data or pending_request is None:
+        return data
+    for _, conn in list(connected_servers):
+        if conn is sock:
+            continue
+        try:
+            conn.sendall(pending_request)
+            reply_socket = conn
+            return conn.recv(1024)
+        except OSError:
+            continue
+    return data
+
+def route_request():
+    # used by the gui in place of a raw socket
+    return RequestRouter()
+
 def run_client_interface(hosts, ports, num_ports):
     # handles connection to server and ui state management
     state_data = None
@@ -24,7 +104,7 @@ def run_client_interface(hosts, ports, num_ports):
 
     try:
         while True:
-            s = retrieve_active_socket
+            s = route_request
             
             # handle ui based on current application state
             if current_state == "login":
@@ -46,19 +126,21 @@ def run_client_interface(hosts, ports, num_ports):
                 gui.launch_signup_window(s)
 
             # process server response
-            s = retrieve_active_socket()
+            s = retrieve_reply_socket()
             if s is None:
                 messagebox.showerror("Error", "Could not connect to server!")
                 print("Error: Could not connect to server!")
                 break
 
-            data = s.recv(1024)
+            data = receive_reply(s)
             json_data = json.loads(data.decode("utf-8"))
             
             # extract response components
             command = json_data["command"]
             version = json_data["version"]
             command_data = json_data["data"]
+            if "session" in json_data:
+                record_session_token(json_data["session"])
 
             # process server commands
             if version != 0:
@@ -114,6 +196,11 @@ def get_connection_args():
         default="50000",
         help="list of starting port values (default: 50000)",
     )
+    parser.add_argument(
+        "--follower_reads",
+        action="store_true",
+        help="send read-only requests to any connected server, not just the first",
+    )
     return parser.parse_args()
 
 def maintain_server_connections(hosts, ports, num_ports):
@@ -184,6 +271,7 @@ if __name__ == "__main__":
     hosts = args.hosts.split(",")
     ports = list(map(int, args.ports.split(",")))
     num_ports = list(map(int, args.num_ports.split(",")))
+    follower_reads = args.follower_reads
 
     # start connection maintenance in background
     threading.Thread(
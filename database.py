@@ -5,6 +5,11 @@ import os
 users_store_location = lambda id: f"database/users_{id}.json" 
 messages_store_location = lambda id: f"database/messages_{id}.json" 
 config_store_location = lambda id: f"database/settings_{id}.json" 
+journal_store_location = lambda id: f"database/journal_{id}.jsonl"
+snapshot_store_location = lambda id: f"database/snapshot_{id}.part"
+
+# number of journaled operations after which the stores are rewritten in full
+JOURNAL_COMPACT_ENTRIES = 1000
 
 
 def read_json_securely(filepath, default_value):
@@ -56,6 +61,7 @@ def fetch_data_stores(vm_id):
     messages = read_json_securely(
         messages_store_location(vm_id), {"undelivered": [], "delivered": []}
     )
+    messages = replay_journal(vm_id, messages)
 
     # load settings with safe default
     settings = read_json_securely(
@@ -72,14 +78,79 @@ def fetch_data_stores(vm_id):
     return users, messages, settings
 
 
+def write_json_atomically(filepath, value):
+    # writes to a temporary file and renames it over the target,
+    # so readers and crashes only ever see the old or the new contents
+    tmp_path = f"{filepath}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(value, file)
+    os.replace(tmp_path, filepath)
+
+
 def persist_data_stores(vm_id, users, messages, settings):
     # writes all data components to their respective json files
-    with open(users_store_location(vm_id), "w") as users_file:
-        json.dump(users, users_file)
-    with open(messages_store_location(vm_id), "w") as messages_file:
-        json.dump(messages, messages_file)
-    with open(config_store_location(vm_id), "w") as settings_file:
-        json.dump(settings, settings_file)
+    # a full rewrite captures every journaled operation, so the journal is emptied afterwards
+    write_json_atomically(users_store_location(vm_id), users)
+    write_json_atomically(messages_store_location(vm_id), messages)
+    write_json_atomically(config_store_location(vm_id), settings)
+    clear_journal(vm_id)
+
+
+def append_journal(vm_id, entry):
+    # appends one operation to the journal instead of rewriting the stores
+    with open(journal_store_location(vm_id), "a") as journal_file:
+        journal_file.write(json.dumps(entry) + "\n")
+
+
+def read_journal(vm_id):
+    # returns the journaled operations in order, skipping a torn final line
+    entries = []
+    try:
+        with open(journal_store_location(vm_id), "r") as journal_file:
+            for line in journal_file:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def clear_journal(vm_id):
+    # drops journaled operations once they are part of the stores on disk
+    if os.path.exists(journal_store_location(vm_id)):
+        os.remove(journal_store_location(vm_id))
+
+
+def replay_journal(vm_id, messages):
+    # applies journaled message deletions to freshly loaded message lists
+    # entries are idempotent, so replaying after a crash mid-rewrite is harmless
+    removed = set()
+    for entry in read_journal(vm_id):
+        if entry.get("command") == "delete_msg":
+            removed.update(entry["ids"])
+    if removed:
+        for box in ("undelivered", "delivered"):
+            messages[box] = [msg for msg in messages[box] if msg["id"] not in removed]
+    return messages
+
+
+def to_mailboxes(messages):
+    # converts the persisted message lists into id-keyed mailboxes for in-memory use
+    # keeps insertion order, so flattening them again preserves the stored order
+    return {
+        "undelivered": {msg["id"]: msg for msg in messages["undelivered"]},
+        "delivered": {msg["id"]: msg for msg in messages["delivered"]},
+    }
+
+
+def to_message_lists(mailboxes):
+    # flattens id-keyed mailboxes back into the list format stored on disk and sent to peers
+    return {
+        "undelivered": list(mailboxes["undelivered"].values()),
+        "delivered": list(mailboxes["delivered"].values()),
+    }
 
 
 def retrieve_client_config(vm_id):
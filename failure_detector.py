@@ -0,0 +1,60 @@
+import collections
+import math
+
+# defaults for heartbeats between peers; with these a silent peer is suspected after about
+# 1.3 seconds, long enough to ride out a pause of the peer's event loop (a large snapshot
+# being encoded, a garbage collection) without starting a needless election
+DEFAULT_HEARTBEAT_INTERVAL_MS = 200
+DEFAULT_SUSPICION_TIMEOUT_MS = 2000
+DEFAULT_PHI_THRESHOLD = 8.0
+# heartbeat intervals remembered per peer
+HISTORY_SIZE = 100
+# seconds a newly connected peer gets to answer its first ping, since its own connection
+# back to us may not be established yet
+STARTUP_GRACE = 5.0
+
+
+class PhiAccrualDetector:
+    # suspicion level for one peer based on the arrival times of its pongs
+    # phi is -log10 of the probability that a heartbeat arrives later than the current
+    # silence, assuming normally distributed intervals, so it grows quickly once the peer
+    # stops answering at its usual pace
+    def __init__(self, now, heartbeat_interval, suspicion_timeout, phi_threshold):
+        self.heartbeat_interval = heartbeat_interval
+        self.suspicion_timeout = suspicion_timeout
+        self.phi_threshold = phi_threshold
+        self.intervals = collections.deque(maxlen=HISTORY_SIZE)
+        # the connection time stands in for the first heartbeat
+        self.last_heartbeat = now
+        self.answered = False
+        self.rtt = None
+
+    def heartbeat(self, now, rtt=None):
+        # the wait for the first pong includes connection setup, so it is not a sample
+        if self.answered:
+            self.intervals.append(now - self.last_heartbeat)
+        self.answered = True
+        self.last_heartbeat = now
+        if rtt is not None:
+            # smoothed the same way tcp smooths its rtt estimate
+            self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+
+    def phi(self, now):
+        elapsed = now - self.last_heartbeat
+        if not self.intervals:
+            return 0.0
+        mean = sum(self.intervals) / len(self.intervals)
+        variance = sum((i - mean) ** 2 for i in self.intervals) / len(self.intervals)
+        # a floor of one interval on the deviation keeps a very regular peer from being
+        # suspected when a single heartbeat is a few intervals late
+        std = max(math.sqrt(variance), self.heartbeat_interval)
+        p_later = 0.5 * math.erfc((elapsed - mean) / (std * math.sqrt(2)))
+        if p_later <= 0:
+            return float("inf")
+        return -math.log10(p_later)
+
+    def suspected(self, now):
+        if not self.answered:
+            return now - self.last_heartbeat > max(self.suspicion_timeout, STARTUP_GRACE)
+        return (now - self.last_heartbeat > self.suspicion_timeout
+                or self.phi(now) > self.phi_threshold)
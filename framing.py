@@ -0,0 +1,57 @@
+import json
+import struct
+
+# bytes requested per recv on peer connections
+PEER_RECV_BYTES = 65536
+# carried in hello and welcome; bumped whenever the peer wire format changes, so a node
+# still running the newline delimited json protocol (version 0) is refused with a log line
+PROTOCOL_VERSION = 1
+# every peer frame starts with the byte lengths of its json header and of its binary body
+FRAME_HEADER = struct.Struct(">II")
+# larger declared frames mean the stream is corrupt or not speaking this protocol
+MAX_FRAME_BYTES = 256 * 1024 * 1024
+
+
+def encode_frame(obj, body=b""):
+    # one peer frame: the two lengths, a compact json header and an optional raw body
+    # bulk bytes such as snapshot chunks travel in the body, without base64 or json escaping
+    header = json.dumps(obj, separators=(",", ":")).encode("utf-8")
+    return FRAME_HEADER.pack(len(header), len(body)) + header + body
+
+
+class FrameDecoder:
+    # incremental splitter for length-prefixed frames on a peer connection
+    # received bytes are appended to one bytearray, the lengths say where each frame ends so
+    # nothing is scanned, and consumed frames are removed in a single compaction per batch
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, chunk):
+        self.buffer += chunk
+
+    def pop_frames(self):
+        # returns (header bytes, body bytes) for every complete frame received so far,
+        # keeping any partial tail buffered; raises ValueError on an impossible length
+        frames = []
+        view = memoryview(self.buffer)
+        start = 0
+        try:
+            while len(self.buffer) - start >= FRAME_HEADER.size:
+                header_len, body_len = FRAME_HEADER.unpack_from(self.buffer, start)
+                if header_len + body_len > MAX_FRAME_BYTES:
+                    raise ValueError(f"peer frame of {header_len + body_len} bytes")
+                header_start = start + FRAME_HEADER.size
+                body_start = header_start + header_len
+                end = body_start + body_len
+                if end > len(self.buffer):
+                    break
+                frames.append((bytes(view[header_start:body_start]), bytes(view[body_start:end])))
+                start = end
+        finally:
+            view.release()
+        if start:
+            del self.buffer[:start]
+        return frames
+
+    def pending_bytes(self):
+        return len(self.buffer)
@@ -444,18 +444,32 @@ def delete_message(s, root, delete_ids, current_user):
         messagebox.showerror("Error", "All fields are required")
         return
 
-    # Validate that input is alphanumeric and comma-separated
-    if re.match("^[a-zA-Z0-9,]+$", delete_ids_str) is None:
+    # Validate that input is a comma-separated list of IDs or ID ranges (e.g. 3,7-12)
+    if re.match("^[0-9]+(-[0-9]+)?(,[0-9]+(-[0-9]+)?)*$", delete_ids_str) is None:
         messagebox.showerror(
-            "Error", "Delete IDs must be alphanumeric comma-separated list"
+            "Error", "Delete IDs must be a comma-separated list of IDs or ranges"
         )
         return
 
+    # Split the input into single IDs and inclusive ranges
+    delete_ids = []
+    delete_ranges = []
+    for token in delete_ids_str.split(","):
+        if "-" in token:
+            low, high = token.split("-")
+            delete_ranges.append([int(low), int(high)])
+        else:
+            delete_ids.append(int(token))
+
     # Format the delete message request (json) and send it to the server
     message_dict = {
         "version": 0,
         "command": "delete_msg",
-        "data": {"delete_ids": delete_ids_str, "current_user": current_user},
+        "data": {
+            "delete_ids": delete_ids,
+            "delete_ranges": delete_ranges,
+            "current_user": current_user,
+        },
     }
     message = (json.dumps(message_dict) + "\0").encode("utf-8")
     s().sendall(message)
@@ -473,7 +487,7 @@ def launch_delete_messages_window(s, current_user):
     # Label instructing the user to input message IDs
     tk.Label(
         root,
-        text="Message IDs of the messages you wish to delete (comma-separated, no spaces):",
+        text="Message IDs or ranges to delete (comma-separated, no spaces, e.g. 3,7-12):",
     ).pack()
     delete_var = tk.StringVar(root)
     tk.Entry(root, textvariable=delete_var).pack()
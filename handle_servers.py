@@ -1,10 +1,126 @@
+import collections
+import concurrent.futures
+import errno
+import hashlib
 import json
+import merkle
 import socket
 import threading
 import time
 import database
+import failure_detector
+import framing
 import selectors
+import scheduler
+import sharding
+import snapshot_transfer
 import types
+import uuid
+import workers
+
+# how long a connection attempt to a candidate peer may take
+DEFAULT_CONNECT_TIMEOUT_MS = 500
+# upper bound on the delay between attempts to reach an endpoint that keeps failing
+DEFAULT_MAX_BACKOFF_MS = 5000
+# replica group of a node when users are not sharded
+DEFAULT_SHARD_GROUP = "0"
+# number of replicated updates kept in memory for incremental catch-up
+DEFAULT_LOG_CAPACITY = 10000
+# bytes of replication updates buffered per peer before they are dropped for a resync
+DEFAULT_PEER_QUEUE_BYTES = 8 * 1024 * 1024
+# updates produced within this window (or up to the batch size) share one frame
+DEFAULT_BATCH_WINDOW_MS = 5
+DEFAULT_BATCH_MAX = 64
+# while a drained peer is away the log may grow to this many times log_capacity to keep
+# the updates it will ask for when it rejoins
+DEPARTED_LOG_FACTOR = 4
+# seconds a restarted node waits to reach a caught-up peer before it leads by itself, and
+# the longest a starting node waits for peer discovery before its first election
+REJOIN_GRACE = 5.0
+# how long a follower waits for the leader to answer a get_log or get_database before asking
+# again; encoding a large snapshot can take far longer than one monitor pass
+SYNC_REQUEST_TIMEOUT = 30.0
+
+# peer frames handled ahead of everything else read in the same batch
+HEARTBEAT_COMMANDS = {"ping", "pong"}
+
+class PeerChannel:
+    # outbound half of a peer connection: encoded frames waiting to be written
+    # filled from any thread and drained by the coordinator's event loop
+    def __init__(self, addr, sock, max_bytes):
+        self.addr = addr
+        self.sock = sock
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # (frame bytes, droppable) pairs; the head may be partially written
+        self.frames = collections.deque()
+        self.queued_bytes = 0
+        self.head_offset = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_dropped = 0
+        self.overflows = 0
+        self.max_depth = 0
+
+    def enqueue(self, frame, droppable):
+        # queue a frame, returning False when the buffer overflowed
+        # replication updates are droppable because the peer can catch up from the log,
+        # while control frames (snapshots, catch-up replies) are always kept
+        with self.lock:
+            overflow = droppable and self.queued_bytes + len(frame) > self.max_bytes
+            if overflow:
+                self.discard_updates()
+                self.frames_dropped += 1
+                self.overflows += 1
+                return False
+            self.frames.append((frame, droppable))
+            self.queued_bytes += len(frame)
+            self.max_depth = max(self.max_depth, len(self.frames))
+            return True
+
+    def discard_updates(self):
+        # drop queued updates, keeping control frames and a partially written head
+        kept = collections.deque()
+        for position, (frame, droppable) in enumerate(self.frames):
+            if droppable and not (position == 0 and self.head_offset):
+                self.queued_bytes -= len(frame)
+                self.frames_dropped += 1
+            else:
+                kept.append((frame, droppable))
+        self.frames = kept
+
+    def drain(self):
+        # write as much as the socket accepts without blocking
+        # returns True once the queue is empty; socket errors propagate to the caller
+        with self.lock:
+            while self.frames:
+                frame, _ = self.frames[0]
+                try:
+                    sent = self.sock.send(frame[self.head_offset:])
+                except BlockingIOError:
+                    return False
+                self.head_offset += sent
+                self.bytes_sent += sent
+                if self.head_offset < len(frame):
+                    return False
+                self.frames.popleft()
+                self.queued_bytes -= len(frame)
+                self.head_offset = 0
+                self.frames_sent += 1
+            return True
+
+    def stats(self):
+        # queue depth and counters for monitoring
+        with self.lock:
+            return {
+                "depth": len(self.frames),
+                "queued_bytes": self.queued_bytes,
+                "max_depth": self.max_depth,
+                "frames_sent": self.frames_sent,
+                "bytes_sent": self.bytes_sent,
+                "frames_dropped": self.frames_dropped,
+                "overflows": self.overflows,
+            }
 
 class ServerCoordinator(threading.Thread):
     def __init__(
@@ -16,6 +132,20 @@ class ServerCoordinator(threading.Thread):
         max_ports: list[int],
         current_host: str,
         current_port: int,
+        log_capacity: int = DEFAULT_LOG_CAPACITY,
+        peer_queue_bytes: int = DEFAULT_PEER_QUEUE_BYTES,
+        batch_window_ms: int = DEFAULT_BATCH_WINDOW_MS,
+        batch_max: int = DEFAULT_BATCH_MAX,
+        snapshot_chunk_bytes: int = snapshot_transfer.DEFAULT_CHUNK_BYTES,
+        cluster_size: int = 0,
+        heartbeat_interval_ms: int = failure_detector.DEFAULT_HEARTBEAT_INTERVAL_MS,
+        suspicion_timeout_ms: int = failure_detector.DEFAULT_SUSPICION_TIMEOUT_MS,
+        phi_threshold: float = failure_detector.DEFAULT_PHI_THRESHOLD,
+        connect_timeout_ms: int = DEFAULT_CONNECT_TIMEOUT_MS,
+        max_backoff_ms: int = DEFAULT_MAX_BACKOFF_MS,
+        shard_groups: list[str] = None,
+        shard_group: str = DEFAULT_SHARD_GROUP,
+        anti_entropy_interval_ms: int = merkle.DEFAULT_ANTI_ENTROPY_INTERVAL_MS,
     ):
         super().__init__()
 
@@ -33,7 +163,123 @@ class ServerCoordinator(threading.Thread):
                 for counter in range(max_ports[i]):
                     self.available_endpoints.append((host, port + counter))
 
+        # sharding: users are spread over replica groups by a consistent-hash ring, and
+        # replication, leadership and acks are confined to this node's group.
+        # peer_groups maps "host:port" to the group each peer announced in its handshake
+        self.ring = sharding.HashRing(shard_groups) if shard_groups else None
+        self.group = shard_group
+        self.peer_groups = {}
+        # per-group update streams this node sends to other groups, group -> last index
+        self.stream_index = {}
+
+        self.sel = None
+        # one connection per peer, as (peer listening addr, sock); each is used in both directions
         self.peer_connections = []
+        # connections in peer_connections that this node dialled itself
+        self.dialled = set()
+        # snapshot replies being encoded on the worker pool, as (future, addr, sock)
+        self.pending_snapshots = []
+        # chunked snapshot transfers: addr -> (sock, OutgoingSnapshot) being sent,
+        # the last encoded snapshot kept so interrupted transfers can resume,
+        # and the IncomingSnapshot this node is receiving, if any
+        self.snapshot_chunk_bytes = snapshot_chunk_bytes
+        self.outgoing_snapshots = {}
+        self.snapshot_cache = None
+        self.incoming_snapshot = None
+        # the catch-up request this node sent and has no answer to yet, as (leader, deadline),
+        # so the monitor does not make the leader encode the same reply every second
+        self.sync_request = None
+
+        # replication log: updates are numbered per origin, and an origin is one boot of
+        # one node, so a restarted node never reuses sequence numbers it handed out before
+        self.origin = f"{vm_id}:{int(time.time() * 1000)}"
+        self.next_index = 0
+        self.log_capacity = log_capacity
+        self.replication_log = collections.deque()
+        # origin -> first index of that origin still held in replication_log
+        self.log_first = {}
+
+        # per-peer outbound queues, addr -> PeerChannel
+        self.peer_queue_bytes = peer_queue_bytes
+        self.outbound = {}
+        # updates waiting to be sent together, flushed when full or when the window closes
+        self.batch_window = batch_window_ms / 1000
+        self.batch_max = batch_max
+        self.batch_lock = threading.Lock()
+        self.pending_batch = []
+        self.batch_deadline = None
+
+        # write concern: the highest index of our own origin each peer has applied, and
+        # writes waiting on acknowledgements as (index, needed, deadline, future)
+        # cluster_size sets the majority; 0 counts the nodes currently connected
+        self.cluster_size = cluster_size
+        self.ack_lock = threading.Lock()
+        self.peer_acks = {}
+        self.ack_waiters = []
+
+        # heartbeats: peers are pinged every interval and each pong feeds that peer's
+        # failure detector, keyed by "host:port"
+        self.heartbeat_interval = heartbeat_interval_ms / 1000
+        self.suspicion_timeout = suspicion_timeout_ms / 1000
+        self.phi_threshold = phi_threshold
+        self.detectors = {}
+        self.next_heartbeat = 0
+        # the leader's applied vector as of its last ping, for measuring how far we trail it
+        self.leader_applied = None
+        self.leader_applied_at = 0
+
+        # peer discovery: non-blocking connects in flight, addr -> (sock, deadline), and
+        # endpoints that failed, addr -> (time of the next attempt, current delay)
+        self.connect_timeout = connect_timeout_ms / 1000
+        self.max_backoff = max_backoff_ms / 1000
+        self.connecting = {}
+        self.backoff = {}
+
+        # anti-entropy: a synchronized follower compares its merkle tree with the leader's
+        # every interval and fetches only the users and mailboxes that differ (0 disables)
+        self.anti_entropy_interval = anti_entropy_interval_ms / 1000
+        self.next_anti_entropy = time.monotonic() + self.anti_entropy_interval
+        # key -> our item hash when we asked the leader for it; keys that change here before
+        # the leader's copy arrives are left for the next round
+        self.repair_fetched = {}
+
+        # metrics for the stats admin command: per-peer counters keyed by "host:port",
+        # node-wide counters, and when each recent update of ours was broadcast, as
+        # (index, monotonic time), so a peer's acknowledged index converts into a lag in ms
+        self.peer_counters = collections.defaultdict(collections.Counter)
+        self.counters = collections.Counter()
+        self.broadcast_times = collections.deque(maxlen=log_capacity)
+
+        # guards the server's database between this thread and the client loop; replication
+        # holds it at high priority, and heartbeats never take it so they are answered on time
+        self.state_lock = scheduler.PriorityLock()
+
+        # rolling restarts: a node restarting with stores of its own, whether it drained or
+        # crashed, rejoins from them and catches up from the leader's log, and is not elected
+        # until it has. catching_up holds peers still doing so, and departed maps peers that
+        # drained to the applied vector they announced, so the log keeps what they will ask for
+        settings = self.vm.database["settings"]
+        self.rejoining = bool(settings.get("drained") or settings.get("applied"))
+        self.started = time.monotonic()
+        self.catching_up = set()
+        self.departed = {}
+        self.draining = False
+        self.drain_deadline = None
+        self.leaving_sent = False
+        self.drained = threading.Event()
+        # leadership is kept while the leader stays a candidate; a starting node first waits
+        # for discovery, then follows the leader its peers reported so it never takes over
+        # from a live group. every election that changes the leader starts a later term, and
+        # handshakes and pings carry each node's (term, leader), kept in peer_leaders by
+        # "host:port", so the two sides of a healed partition settle on one leader
+        self.peer_leaders = {}
+        self.elected = False
+        self.term = 0
+
+        # lets other threads wake the event loop when they queue frames
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
 
     def run(self):
         # starts a tcp server to listen for incoming connections and messages
@@ -45,239 +291,1168 @@ class ServerCoordinator(threading.Thread):
         listener.listen()
         listener.setblocking(False)
         self.sel.register(listener, selectors.EVENT_READ, data=None)
+        self.sel.register(self.wakeup_recv, selectors.EVENT_READ, data="wakeup")
 
         # start monitoring thread
         threading.Thread(target=self.monitor_network_peers, daemon=True).start()
 
         # main event loop
         while True:
-            events = self.sel.select(timeout=None)
+            # poll while snapshots are encoding or peers are backed up so both progress,
+            # and wake up in time to close the current batch window
+            draining = self.draining and not self.drained.is_set()
+            busy = (self.pending_snapshots or self.outgoing_snapshots or draining
+                    or not self.flush_outbound())
+            timeout = 0.01 if busy else None
+            deadline = self.batch_deadline
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            remaining = max(0, self.next_heartbeat - time.monotonic())
+            timeout = remaining if timeout is None else min(timeout, remaining)
+            waiters = list(self.ack_waiters)
+            if waiters:
+                remaining = max(0, min(waiter[2] for waiter in waiters) - time.monotonic())
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            events = self.sel.select(timeout=timeout)
+            # heartbeats go out before the frames that arrived are processed
+            if time.monotonic() >= self.next_heartbeat:
+                self.heartbeat()
+                self.discover_peers(time.monotonic())
             for key, mask in events:
                 if key.data is None:
                     self.register_new_connection(key.fileobj)
+                elif isinstance(key.data, tuple) and key.data[0] == "connect":
+                    self.finish_connect(key.fileobj, key.data[1])
+                elif key.data == "wakeup":
+                    try:
+                        self.wakeup_recv.recv(4096)
+                    except BlockingIOError:
+                        pass
                 else:
                     self.process_peer_message(key, mask)
+            if self.batch_deadline is not None and time.monotonic() >= self.batch_deadline:
+                self.flush_batch()
+            if self.ack_waiters:
+                with self.ack_lock:
+                    self.settle_ack_waiters()
+            self.flush_snapshots()
+            self.pump_snapshots()
+            self.flush_outbound()
+            if self.draining and not self.drained.is_set():
+                self.continue_drain()
+
+    def wake(self):
+        # interrupt a blocking select so newly queued frames are written
+        try:
+            self.wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def channel_for(self, addr, sock):
+        # the outbound queue for a peer connection, replaced when the peer reconnects
+        channel = self.outbound.get(addr)
+        if channel is None or channel.sock is not sock:
+            channel = PeerChannel(addr, sock, self.peer_queue_bytes)
+            self.outbound[addr] = channel
+        return channel
+
+    def send_to_peer(self, addr, sock, frame, droppable=False):
+        # queue an encoded frame for a peer without blocking the caller
+        channel = self.channel_for(addr, sock)
+        if not channel.enqueue(frame, droppable):
+            # the peer fell too far behind: its queued updates are gone, so tell it to catch up
+            print(f"INTERNAL {self.id}: Send queue to {addr} overflowed, requesting resync")
+            channel.enqueue(framing.encode_frame({"version": 0, "command": "resync"}), False)
+        self.wake()
+
+    def flush_outbound(self):
+        # drain every peer queue; returns True when all of them are empty
+        all_drained = True
+        for addr, channel in list(self.outbound.items()):
+            try:
+                all_drained = channel.drain() and all_drained
+            except OSError:
+                print(f"INTERNAL {self.id}: Connection to {addr} lost.")
+                self.drop_peer(addr)
+        return all_drained
+
+    def drop_peer(self, addr):
+        # forget a failed peer connection and its queue
+        channel = self.outbound.pop(addr, None)
+        if channel is not None:
+            self.close_socket(channel.sock)
+        for peer_addr, sock in self.peer_connections:
+            if peer_addr == addr:
+                self.close_socket(sock)
+        self.peer_connections = [(a, s) for a, s in self.peer_connections if a != addr]
+        self.detectors.pop(f"{addr[0]}:{addr[1]}", None)
+        self.peer_groups.pop(f"{addr[0]}:{addr[1]}", None)
+        self.peer_leaders.pop(f"{addr[0]}:{addr[1]}", None)
+        if self.sync_request is not None and self.sync_request[0] == f"{addr[0]}:{addr[1]}":
+            # the request went down with the connection
+            self.sync_request = None
+
+    def close_socket(self, sock):
+        # stop watching a socket before closing it so its descriptor can be reused safely
+        self.dialled.discard(sock)
+        if self.sel is not None:
+            try:
+                self.sel.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+        sock.close()
+
+    def close_connection(self, sock):
+        # a connection ended; forget the peer it belonged to, if it had been identified
+        for addr, peer_sock in self.peer_connections:
+            if peer_sock is sock:
+                self.drop_peer(addr)
+                return
+        self.close_socket(sock)
+
+    def handshake_data(self):
+        # what each side of a new peer connection tells the other about itself
+        generator = getattr(self.vm, "id_generator", None)
+        return {"vm_id": self.id, "group": self.group, "rejoining": self.rejoining,
+                "node_number": None if generator is None else generator.node_number,
+                "leader": self.leader, "term": self.term}
+
+    def handshake_conflict(self, msg):
+        # why a peer that sent this hello or welcome cannot share the cluster with us, or None
+        if msg.get("version") != framing.PROTOCOL_VERSION:
+            return (f"it speaks peer protocol version {msg.get('version')}, "
+                    f"we speak version {framing.PROTOCOL_VERSION}")
+        mine = self.handshake_data()["node_number"]
+        if mine is not None and msg["data"].get("node_number") == mine:
+            return f"it uses our node number {mine}, so both could mint the same message ids"
+        return None
+
+    def refuse_peer(self, conn, msg, reason):
+        print(f"INTERNAL {self.id}: Refusing peer {msg['host']}:{msg['port']}: {reason}")
+        self.close_connection(conn)
+
+    def accept_handshake(self, conn, msg):
+        # an accepted connection has identified its peer; keep a single connection per pair.
+        # when both nodes dial each other, the connection dialled by the lower address wins
+        addr = (msg["host"], msg["port"])
+        conflict = self.handshake_conflict(msg)
+        if conflict:
+            self.refuse_peer(conn, msg, conflict)
+            return
+        we_dialled = any(a == addr and sock in self.dialled for a, sock in self.peer_connections)
+        if (self.host, self.port) < addr and (we_dialled or addr in self.connecting):
+            self.close_socket(conn)
+            return
+        if addr in self.connecting:
+            pending, _ = self.connecting.pop(addr)
+            self.close_socket(pending)
+        # replaces our own losing connection, or a stale one from before the peer restarted
+        self.drop_peer(addr)
+        self.peer_connections.append((addr, conn))
+        self.sel.get_key(conn).data.peer = addr
+        self.peer_groups[f"{addr[0]}:{addr[1]}"] = msg["data"].get("group", DEFAULT_SHARD_GROUP)
+        self.note_rejoining(f"{addr[0]}:{addr[1]}", msg["data"])
+        print(f"INTERNAL {self.id}: Connection from {addr[0]}:{addr[1]} identified")
+        # the dialling side learns our group from the reply
+        welcome = {"version": framing.PROTOCOL_VERSION, "command": "welcome", "host": self.host, "port": self.port,
+                   "data": self.handshake_data()}
+        self.send_to_peer(addr, conn, framing.encode_frame(welcome))
+
+    def heartbeat(self):
+        # ping every peer and drop the ones whose detectors suspect them
+        now = time.monotonic()
+        self.next_heartbeat = now + self.heartbeat_interval
+        ping_data = {"sent": now, "leader": self.leader, "term": self.term}
+        if self.is_leader():
+            # followers compare this with their own vector to bound the staleness of their reads
+            ping_data["applied"] = dict(self.applied_vector())
+        ping = framing.encode_frame({"version": 0, "command": "ping", "host": self.host,
+                                     "port": self.port, "data": ping_data})
+        suspected = []
+        for addr, sock in list(self.peer_connections):
+            key = f"{addr[0]}:{addr[1]}"
+            detector = self.detectors.get(key)
+            if detector is None:
+                self.detectors[key] = failure_detector.PhiAccrualDetector(
+                    now, self.heartbeat_interval, self.suspicion_timeout, self.phi_threshold)
+            elif detector.suspected(now):
+                suspected.append(addr)
+                continue
+            self.send_to_peer(addr, sock, ping)
+        for addr in suspected:
+            print(f"INTERNAL {self.id}: Peer {addr} stopped answering heartbeats, dropping it")
+            self.drop_peer(addr)
+        if suspected:
+            # re-elect right away instead of waiting for the next monitor pass
+            self.verify_leader()
+
+    def discover_peers(self, now):
+        # start a non-blocking connect to every unconnected endpoint that is due for an
+        # attempt; the outcome arrives as a write event, and attempts past their deadline fail
+        connected = {addr for addr, _ in self.peer_connections}
+        for addr in self.available_endpoints:
+            if addr == (self.host, self.port) or addr in connected or addr in self.connecting:
+                continue
+            if now < self.backoff.get(addr, (0, 0))[0]:
+                continue
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setblocking(False)
+            err = s.connect_ex(addr)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                s.close()
+                self.connect_failed(addr, now)
+                continue
+            self.connecting[addr] = (s, now + self.connect_timeout)
+            self.sel.register(s, selectors.EVENT_WRITE, data=("connect", addr))
+        for addr, (s, deadline) in list(self.connecting.items()):
+            if now >= deadline:
+                self.sel.unregister(s)
+                s.close()
+                del self.connecting[addr]
+                self.connect_failed(addr, now)
+
+    def finish_connect(self, sock, addr):
+        # a pending connect resolved; keep the socket as the peer's connection if it succeeded
+        self.sel.unregister(sock)
+        self.connecting.pop(addr, None)
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            sock.close()
+            self.connect_failed(addr, time.monotonic())
+            return
+        self.backoff.pop(addr, None)
+        if any(a == addr for a, _ in self.peer_connections):
+            # the peer's own connection to us was adopted while this one was in flight
+            sock.close()
+            return
+        self.peer_connections.append((addr, sock))
+        self.dialled.add(sock)
+        self.sel.register(sock, selectors.EVENT_READ,
+                          data=types.SimpleNamespace(addr=addr, decoder=framing.FrameDecoder(), peer=addr))
+        # introduce ourselves so the peer can use this connection for its traffic too
+        hello = {"version": framing.PROTOCOL_VERSION, "command": "hello", "host": self.host, "port": self.port,
+                 "data": self.handshake_data()}
+        self.send_to_peer(addr, sock, framing.encode_frame(hello))
+
+    def connect_failed(self, addr, now):
+        # back off exponentially from the heartbeat interval up to max_backoff
+        delay = self.backoff.get(addr, (0, 0))[1]
+        delay = min(self.max_backoff, delay * 2 if delay else self.heartbeat_interval)
+        self.backoff[addr] = (now + delay, delay)
+
+    def peer_health(self):
+        # smoothed round trip time and current suspicion level for each peer
+        now = time.monotonic()
+        return {key: {"rtt_ms": None if d.rtt is None else d.rtt * 1000, "phi": d.phi(now)}
+                for key, d in list(self.detectors.items())}
+
+    def queue_stats(self):
+        # per-peer outbound queue depth and counters
+        return {f"{addr[0]}:{addr[1]}": channel.stats() for addr, channel in self.outbound.items()}
+
+    def lag_ms(self, acked):
+        # how long ago we broadcast the oldest update a peer has not acknowledged
+        for index, sent in list(self.broadcast_times):
+            if index > acked:
+                return (time.monotonic() - sent) * 1000
+        return 0.0
+
+    def metrics(self):
+        # replication counters and lag, per peer and for this node; a peer's lag counts the
+        # updates of ours it has not acknowledged, which is the data at risk if we failed now
+        health = self.peer_health()
+        queues = self.queue_stats()
+        with self.ack_lock:
+            acks = dict(self.peer_acks)
+        in_group = {f"{addr[0]}:{addr[1]}" for addr, _ in self.peers_in_group(self.group)}
+        peers = {}
+        for addr, _ in list(self.peer_connections):
+            key = f"{addr[0]}:{addr[1]}"
+            peer = {"group": self.peer_groups.get(key), **self.peer_counters[key]}
+            peer.update(health.get(key, {}))
+            peer["queue"] = queues.get(key)
+            if key in in_group:
+                acked = acks.get(key, 0)
+                peer["acked_index"] = acked
+                peer["lag_ops"] = max(0, self.next_index - acked)
+                peer["lag_ms"] = self.lag_ms(acked)
+            peers[key] = peer
+        lag = self.read_lag()
+        return {
+            "node": f"{self.host}:{self.port}",
+            "group": self.group,
+            "leader": self.leader,
+            "is_leader": self.is_leader(),
+            "synchronized": self.db_synchronized,
+            "last_index": self.next_index,
+            # updates the leader has applied that we have not; None when its position is unknown
+            "lag_ops": None if lag == float("inf") else lag,
+            "counters": dict(self.counters),
+            "peers": peers,
+        }
 
     def register_new_connection(self, sock):
-        # accept and register a new connection with the selector
+        # accept and register a new connection with the selector; the peer is unknown
+        # until its hello arrives. only read events are needed: writes leave through the peer queues
         conn, addr = sock.accept()
         print(f"INTERNAL: Accepted connection from {addr}")
         conn.setblocking(False)
-        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        self.sel.register(conn, events, data=data)
+        data = types.SimpleNamespace(addr=addr, decoder=framing.FrameDecoder(), peer=None)
+        self.sel.register(conn, selectors.EVENT_READ, data=data)
 
     def process_peer_message(self, key, mask):
-        # handles an incoming connection, reading messages and processing them
+        # reads from a peer connection and handles every frame completed by the new bytes
         conn = key.fileobj
         data = key.data
         if mask & selectors.EVENT_READ:
             try:
-                recv_data = conn.recv(4096)
-            except ConnectionResetError:
+                recv_data = conn.recv(framing.PEER_RECV_BYTES)
+            except OSError:
                 recv_data = None
 
-            if recv_data:
-                data.outb += recv_data
-            else:
-                self.sel.unregister(conn)
-                conn.close()
+            if not recv_data:
+                self.close_connection(conn)
                 return
-                
-        if mask & selectors.EVENT_WRITE:
-            if data.outb:
-                # process complete messages terminated by null byte
-                lines = data.outb.decode("utf-8").split("\0")[:-1]
-                for line in lines:
-                    try:
-                        msg = json.loads(line)
-
-                        if msg["command"] == "ping":
-                            pass
-                        elif msg["command"] == "internal_update":
-                            if "leader" in msg["data"]:
-                                self.leader = msg["data"]["leader"]
-                                print(
-                                    f"INTERNAL {self.id}: Leader updated to {self.leader}"
-                                )
-                        elif msg["command"] == "distribute_update":
-                            command = msg["data"]["command"]
-                            received_data = msg["data"]
-
-                            if command == "create":
-                                self.vm.register_user(conn, received_data, True)
-                            elif command == "login":
-                                self.vm.user_login(conn, received_data, True)
-                            elif command == "logout":
-                                self.vm.user_logout(conn, received_data, True)
-                            elif command == "search":
-                                self.vm.find_users(conn, received_data)
-                            elif command == "delete_acct":
-                                self.vm.remove_account(conn, received_data, True)
-                            elif command == "send_msg":
-                                self.vm.process_msg(conn, received_data, True)
-                            elif command == "get_undelivered":
-                                self.vm.fetch_pending_msgs(conn, received_data)
-                            elif command == "get_delivered":
-                                self.vm.fetch_seen_msgs(conn, received_data)
-                            elif command == "refresh_home":
-                                self.vm.update_home(conn, received_data)
-                            elif command == "delete_msg":
-                                self.vm.remove_msgs(conn, received_data, True)
-                            else:
-                                # command not recognized
-                                print(f"No valid command: {received_data}")
-                                data.outb = data.outb[len(received_data) :]
-                        elif msg["command"] == "get_database":
-                            for addr, sock in self.peer_connections:
-                                if addr[0] == msg["host"] and addr[1] == msg["port"]:
-                                    sock.sendall(
-                                        (
-                                            json.dumps(
-                                                {
-                                                    "version": 0,
-                                                    "command": "set_database",
-                                                    "data": {
-                                                        "users": self.vm.database[
-                                                            "users"
-                                                        ],
-                                                        "messages": self.vm.database[
-                                                            "messages"
-                                                        ],
-                                                        "settings": self.vm.database[
-                                                            "settings"
-                                                        ],
-                                                    },
-                                                }
-                                            )
-                                            + "\0"
-                                        ).encode("utf-8")
-                                    )
-                        elif msg["command"] == "set_database":
-                            print(f"INTERNAL {self.id}: Updating users database")
-                            self.vm.database["users"] = msg["data"]["users"]
-                            print(f"INTERNAL {self.id}: Updating messages database")
-                            self.vm.database["messages"] = msg["data"]["messages"]
-                            print(f"INTERNAL {self.id}: Updating settings database")
-                            self.vm.database["settings"] = msg["data"]["settings"]
-                            database.persist_data_stores(
-                                self.id,
-                                self.vm.database["users"],
-                                self.vm.database["messages"],
-                                self.vm.database["settings"],
-                            )
-                            print(f"INTERNAL {self.id}: Updating COMPLETE database")
-                            self.db_synchronized = True
-                        else:
-                            print(f"INTERNAL {self.id}: Error parsing message: {line}")
-                    except Exception as e:
-                        print(
-                            f"INTERNAL {self.id}: Error parsing message: {e}\n\nLINE: {line}"
-                        )
-
-                data.outb = data.outb[len(data.outb.decode("utf-8")) :]
-
-    def monitor_network_peers(self):
-        # continuously monitors and maintains connections to peer servers
-        while True:
-            active_peers = []
 
-            # check existing connections with heartbeats
-            for addr, conn in self.peer_connections:
+            if data.peer is not None:
+                self.peer_counters[f"{data.peer[0]}:{data.peer[1]}"]["bytes_received"] += len(recv_data)
+            data.decoder.feed(recv_data)
+            try:
+                frames = data.decoder.pop_frames()
+            except ValueError as e:
+                print(f"INTERNAL {self.id}: Dropping connection with a corrupt stream: {e}")
+                self.close_connection(conn)
+                return
+            messages = []
+            for header, body in frames:
                 try:
-                    conn.sendall(
-                        f"{json.dumps({'version': 0, 'command': 'ping'})}\0".encode(
-                            "utf-8"
-                        )
+                    msg = json.loads(header)
+                except Exception as e:
+                    print(
+                        f"INTERNAL {self.id}: Error parsing message: {e}\n\nLINE: {header[:200]}"
                     )
-                    active_peers.append(addr)
-                except Exception:
-                    print(f"INTERNAL {self.id}: Connection to {addr} lost.")
-                    conn.close()
-                    self.peer_connections.remove((addr, conn))
-
-            # attempt to connect to unconnected peers
-            for addr in self.available_endpoints:
-                if addr in active_peers or addr == (self.host, self.port):
                     continue
+                if body:
+                    # raw bytes carried next to the header, such as a snapshot chunk
+                    msg["body"] = body
+                messages.append(msg)
+            # pings and pongs are answered first and without the state lock, so a busy
+            # client loop never makes a healthy peer look dead
+            for msg in messages:
+                if msg.get("command") in HEARTBEAT_COMMANDS:
+                    self.handle_peer_frame(conn, msg)
+            others = [msg for msg in messages if msg.get("command") not in HEARTBEAT_COMMANDS]
+            if others:
+                with self.state_lock.high():
+                    for msg in others:
+                        try:
+                            self.handle_peer_frame(conn, msg)
+                        except Exception as e:
+                            print(f"INTERNAL {self.id}: Error handling {msg.get('command')}: {e}")
 
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                try:
-                    s.connect(addr)
-
-                    # check if already in our peer list
-                    already_connected = False
-                    for saved_addr, _ in self.peer_connections:
-                        if saved_addr == addr:
-                            already_connected = True
-                            break
-
-                    if not already_connected:
-                        self.peer_connections.append((addr, s))
-                except Exception:
-                    # clean up any failed connections
-                    for ind, (saved_addr, conn) in enumerate(self.peer_connections):
-                        if saved_addr == addr:
-                            conn.close()
-                            del self.peer_connections[ind]
-
-            # verify leader status
-            self.verify_leader()
+    def handle_peer_frame(self, conn, msg):
+        # dispatch one decoded peer frame
+        if msg["command"] == "hello":
+            self.accept_handshake(conn, msg)
+        elif msg["command"] == "welcome":
+            conflict = self.handshake_conflict(msg)
+            if conflict:
+                self.refuse_peer(conn, msg, conflict)
+                return
+            self.peer_groups[f"{msg['host']}:{msg['port']}"] = msg["data"].get("group", DEFAULT_SHARD_GROUP)
+            self.note_rejoining(f"{msg['host']}:{msg['port']}", msg["data"])
+        elif msg["command"] == "leaving":
+            # a peer is draining for a restart; stop routing to it and keep its log delta
+            peer = f"{msg['host']}:{msg['port']}"
+            print(f"INTERNAL {self.id}: Peer {peer} is draining for a restart")
+            self.departed[peer] = msg["data"]["applied"]
+            if peer == self.leader:
+                self.select_leader()
+        elif msg["command"] == "caught_up":
+            self.catching_up.discard(f"{msg['host']}:{msg['port']}")
+        elif msg["command"] == "ping":
+            if "host" in msg:
+                self.note_leader(f"{msg['host']}:{msg['port']}", msg["data"])
+            if "applied" in msg["data"] and f"{msg['host']}:{msg['port']}" == self.leader:
+                self.leader_applied = msg["data"]["applied"]
+                self.leader_applied_at = time.monotonic()
+            if "host" in msg:
+                pong = framing.encode_frame({"version": 0, "command": "pong", "host": self.host,
+                                             "port": self.port, "data": msg["data"]})
+                for addr, sock in self.peer_connections:
+                    if addr[0] == msg["host"] and addr[1] == msg["port"]:
+                        self.send_to_peer(addr, sock, pong)
+        elif msg["command"] == "pong":
+            detector = self.detectors.get(f"{msg['host']}:{msg['port']}")
+            if detector is not None:
+                now = time.monotonic()
+                detector.heartbeat(now, now - msg["data"]["sent"])
+        elif msg["command"] == "internal_update":
+            if "leader" in msg["data"]:
+                if msg["data"]["leader"] != self.leader:
+                    self.counters["leader_changes"] += 1
+                self.leader = msg["data"]["leader"]
+                print(f"INTERNAL {self.id}: Leader updated to {self.leader}")
+        elif msg["command"] == "distribute_update":
+            self.apply_update(conn, msg)
+            self.send_ack(msg, [msg])
+        elif msg["command"] == "distribute_batch":
+            for entry in msg["data"]["entries"]:
+                self.apply_update(conn, entry)
+            self.send_ack(msg, msg["data"]["entries"])
+        elif msg["command"] == "ack":
+            self.record_ack(f"{msg['host']}:{msg['port']}", msg["data"]["applied"])
+        elif msg["command"] == "get_database":
+            for addr, sock in self.peer_connections:
+                if addr[0] == msg["host"] and addr[1] == msg["port"]:
+                    self.send_snapshot(addr, sock, msg.get("resume"))
+        elif msg["command"] == "get_log":
+            for addr, sock in self.peer_connections:
+                if addr[0] == msg["host"] and addr[1] == msg["port"]:
+                    self.send_log_suffix(addr, sock, msg["applied"])
+        elif msg["command"] == "forward_request":
+            # a follower handed us a client write; run it and send back the client's reply
+            # once it has met the write concern
+            if self.vm.forwards_writes():
+                # the sender's view of our group's leader is stale; running the write here
+                # would bypass the leader's sequencing
+                error = {"version": 0, "command": "error",
+                         "data": {"error": "not the leader, please retry"}}
+                self.send_forward_reply(msg, workers.encode_frame(error).decode("utf-8"))
+                return
+            reply = self.vm.execute_forwarded(msg["data"])
+            # replication frames are queued before the reply so the follower has applied
+            # the write by the time its client hears about it
+            self.flush_batch()
+            reply.add_done_callback(lambda done: self.send_forward_reply(msg, done.result()))
+        elif msg["command"].startswith("merkle_"):
+            self.handle_anti_entropy(msg)
+        elif msg["command"] == "forward_reply":
+            self.vm.complete_forwarded(msg["data"]["request_id"], msg["data"]["reply"])
+        elif msg["command"] == "resync":
+            print(f"INTERNAL {self.id}: Peer dropped updates for us, resynchronizing")
+            self.db_synchronized = False
+            self.sync_request = None
+        elif msg["command"] == "log_entries":
+            print(f"INTERNAL {self.id}: Applying {len(msg['data']['entries'])} missed updates")
+            self.sync_request = None
+            # caught up unless apply_update finds a gap in the suffix and clears this again
+            self.db_synchronized = True
+            for entry in msg["data"]["entries"]:
+                self.apply_update(conn, entry)
+            if self.db_synchronized:
+                self.finish_rejoin()
+        elif msg["command"] == "set_database":
+            # single-frame snapshot from a peer without chunked transfer
+            self.sync_request = None
+            self.install_snapshot(msg["data"])
+        elif msg["command"] == "snapshot_begin":
+            self.begin_incoming_snapshot(msg["data"])
+        elif msg["command"] == "snapshot_chunk":
+            incoming = self.incoming_snapshot
+            if incoming is not None and not incoming.add_chunk(msg["data"], msg.get("body", b"")):
+                # out of order or corrupt: ask once for the rest from the last good
+                # chunk, ignoring chunks still in flight until the transfer restarts
+                if not incoming.resume_requested:
+                    print(f"INTERNAL {self.id}: Bad snapshot chunk {msg['data']['seq']}, resuming")
+                    self.request_snapshot_resume()
+        elif msg["command"] == "snapshot_end":
+            self.finish_incoming_snapshot(msg["data"])
+        else:
+            print(f"INTERNAL {self.id}: Unknown peer command: {msg['command']}")
+
+    def applied_vector(self):
+        # origin -> index of the last update from that origin applied to the local database
+        return self.vm.database["settings"].setdefault("applied", {})
+
+    def append_log(self, entry):
+        # keep an applied update for peers that fall behind, evicting the oldest when full
+        # unless a drained peer still needs it and the log is within its extended bound
+        while len(self.replication_log) >= self.log_capacity:
+            oldest = self.replication_log[0]
+            if (len(self.replication_log) < self.log_capacity * DEPARTED_LOG_FACTOR
+                    and any(oldest["index"] > applied.get(oldest["origin"], 0)
+                            for applied in self.departed.values())):
+                break
+            evicted = self.replication_log.popleft()
+            self.log_first[evicted["origin"]] = evicted["index"] + 1
+        self.replication_log.append(entry)
+        self.log_first.setdefault(entry["origin"], entry["index"])
+
+    def apply_update(self, conn, entry):
+        # applies one replicated update at most once and in per-origin order
+        origin = entry.get("origin")
+        index = entry.get("index")
+        if origin is not None:
+            applied = self.applied_vector()
+            last = applied.get(origin, 0)
+            if index <= last:
+                return
+            if index > last + 1:
+                # a gap means updates were missed, so catch up from the leader instead
+                print(f"INTERNAL {self.id}: Missing updates from {origin}, resynchronizing")
+                self.db_synchronized = False
+                return
+            # recorded before the handler runs so its persist stores the new position
+            applied[origin] = index
+            self.append_log(entry)
+        self.counters["updates_applied"] += 1
+
+        command = entry["data"]["command"]
+        received_data = entry["data"]
+        if "request" in received_data:
+            # cached before the handler runs so its persist stores the entry with the write
+            request = received_data["request"]
+            self.vm.remember_request(request["request_id"], request["replies"])
+        if command == "create":
+            self.vm.register_user(conn, received_data, True)
+        elif command == "login":
+            self.vm.user_login(conn, received_data, True)
+        elif command == "logout":
+            self.vm.user_logout(conn, received_data, True)
+        elif command == "delete_acct":
+            self.vm.remove_account(conn, received_data, True)
+        elif command == "send_msg":
+            self.vm.process_msg(conn, received_data, True)
+        elif command == "get_undelivered":
+            self.vm.fetch_pending_msgs(conn, received_data, True)
+        elif command == "delete_msg":
+            self.vm.remove_msgs(conn, received_data, True)
+        else:
+            # command not recognized
+            print(f"No valid command: {received_data}")
+
+    def log_suffix(self, peer_applied):
+        # the logged updates a peer has not applied yet, or None when some were compacted away
+        for origin, index in self.applied_vector().items():
+            known = peer_applied.get(origin, 0)
+            if index > known and self.log_first.get(origin, index + 1) > known + 1:
+                return None
+        return [
+            entry for entry in self.replication_log
+            if entry["index"] > peer_applied.get(entry["origin"], 0)
+        ]
+
+    def send_log_suffix(self, addr, sock, peer_applied):
+        # answer a catch-up request with the missing updates, falling back to a snapshot
+        entries = self.log_suffix(peer_applied)
+        if entries is None:
+            print(f"INTERNAL {self.id}: Catch-up history compacted, sending snapshot")
+            self.send_snapshot(addr, sock)
+            return
+        frame = {"version": 0, "command": "log_entries", "data": {"entries": entries}}
+        self.send_to_peer(addr, sock, framing.encode_frame(frame))
+
+    def build_snapshot(self):
+        # copy the containers so the encoder never sees them resized mid-iteration
+        # message objects are never mutated after creation, so they are shared as-is
+        settings = {
+            key: dict(value) if isinstance(value, dict) else value
+            for key, value in self.vm.database["settings"].items()
+        }
+        return {
+            "users": {name: dict(user) for name, user in self.vm.database["users"].items()},
+            "messages": database.to_message_lists(self.vm.database["messages"]),
+            "settings": settings,
+        }
+
+    def send_snapshot(self, addr, sock, resume=None):
+        # stream the database to a peer in chunks, resuming an interrupted transfer when
+        # the peer still holds part of the snapshot we last encoded
+        cache = self.snapshot_cache
+        if resume is not None and cache is not None and cache[0] == resume["snapshot_id"]:
+            print(f"INTERNAL {self.id}: Resuming snapshot to {addr} at chunk {resume['next_seq']}")
+            self.outgoing_snapshots[addr] = (sock, snapshot_transfer.OutgoingSnapshot(
+                cache[0], cache[1], cache[2], self.snapshot_chunk_bytes, resume["next_seq"]))
+            return
+        if self.snapshot_in_progress(addr, sock):
+            # a repeated request would encode another copy and restart the peer's transfer
+            print(f"INTERNAL {self.id}: Snapshot to {addr} already in progress, ignoring request")
+            return
+        snapshot = self.build_snapshot()
+        if self.vm.encoder_pool is None:
+            self.start_snapshot_transfer(addr, sock, workers.encode_frame(snapshot))
+            return
+        self.pending_snapshots.append(
+            (self.vm.encoder_pool.submit(workers.encode_frame, snapshot), addr, sock)
+        )
+
+    def snapshot_in_progress(self, addr, sock):
+        # a snapshot for this peer connection is still being encoded or streamed
+        outgoing = self.outgoing_snapshots.get(addr)
+        if outgoing is not None and outgoing[0] is sock:
+            return True
+        return any(pending_addr == addr and pending_sock is sock
+                   for _, pending_addr, pending_sock in self.pending_snapshots)
+
+    def flush_snapshots(self):
+        # start transfers for snapshots whose encoding has completed
+        still_pending = []
+        for future, addr, sock in self.pending_snapshots:
+            if not future.done():
+                still_pending.append((future, addr, sock))
+                continue
+            try:
+                self.start_snapshot_transfer(addr, sock, future.result())
+            except Exception as e:
+                print(f"INTERNAL {self.id}: Error sending database snapshot: {e}")
+        self.pending_snapshots = still_pending
+
+    def start_snapshot_transfer(self, addr, sock, blob):
+        # checksum a freshly encoded snapshot, keep it for resumes and begin streaming it
+        digest = hashlib.sha256(blob).hexdigest()
+        self.counters["snapshots_sent"] += 1
+        self.snapshot_cache = (uuid.uuid4().hex, blob, digest)
+        self.outgoing_snapshots[addr] = (sock, snapshot_transfer.OutgoingSnapshot(
+            self.snapshot_cache[0], blob, digest, self.snapshot_chunk_bytes))
+
+    def pump_snapshots(self):
+        # queue the next chunks of each transfer, keeping at most two chunks buffered per
+        # peer so a large snapshot never monopolizes the loop or the peer's queue
+        for addr, (sock, outgoing) in list(self.outgoing_snapshots.items()):
+            if (addr, sock) not in self.peer_connections:
+                # the connection went away; the peer will ask to resume
+                del self.outgoing_snapshots[addr]
+                continue
+            channel = self.channel_for(addr, sock)
+            while channel.queued_bytes < 2 * self.snapshot_chunk_bytes:
+                frame = outgoing.next_frame()
+                if frame is None:
+                    del self.outgoing_snapshots[addr]
+                    break
+                self.send_to_peer(addr, sock, frame)
+
+    def begin_incoming_snapshot(self, begin):
+        # start receiving a snapshot, or continue a matching interrupted one
+        if self.incoming_snapshot is not None:
+            if self.incoming_snapshot.can_resume(begin):
+                self.incoming_snapshot.resume_requested = False
+                return
+            self.incoming_snapshot.abort()
+        self.sync_request = None
+        print(f"INTERNAL {self.id}: Receiving snapshot of {begin['total_bytes']} bytes")
+        self.incoming_snapshot = snapshot_transfer.IncomingSnapshot(
+            database.snapshot_store_location(self.id), begin)
+
+    def finish_incoming_snapshot(self, end):
+        # verify the received snapshot and swap it in, or start over when it is damaged
+        incoming = self.incoming_snapshot
+        if incoming is None or incoming.snapshot_id != end["snapshot_id"]:
+            return
+        self.incoming_snapshot = None
+        snapshot = incoming.finish()
+        if snapshot is None:
+            print(f"INTERNAL {self.id}: Snapshot checksum mismatch, requesting a new one")
+            self.db_synchronized = False
+            return
+        self.install_snapshot(snapshot)
+
+    def install_snapshot(self, snapshot):
+        # replace the whole database with a verified snapshot in one assignment
+        print(f"INTERNAL {self.id}: Installing database snapshot")
+        self.vm.database = {
+            "users": snapshot["users"],
+            "messages": database.to_mailboxes(snapshot["messages"]),
+            "settings": snapshot["settings"],
+        }
+        # the snapshot's applied vector supersedes anything logged locally
+        self.replication_log.clear()
+        self.log_first = {}
+        self.vm.rebuild_indexes()
+        self.vm.persist()
+        self.counters["snapshots_installed"] += 1
+        print(f"INTERNAL {self.id}: Updating COMPLETE database")
+        self.db_synchronized = True
+        self.finish_rejoin()
+
+    def request_snapshot_resume(self):
+        # ask the leader to continue the current transfer from the last verified chunk
+        incoming = self.incoming_snapshot
+        incoming.last_progress = time.monotonic()
+        incoming.resume_requested = True
+        request = {"version": 0, "command": "get_database", "host": self.host, "port": self.port,
+                   "resume": {"snapshot_id": incoming.snapshot_id, "next_seq": incoming.next_seq}}
+        for addr, conn in self.peer_connections:
+            if f"{addr[0]}:{addr[1]}" == self.leader:
+                self.send_to_peer(addr, conn, framing.encode_frame(request))
+
+    def monitor_network_peers(self):
+        # periodically checks leadership and synchronization
+        # heartbeats and connection attempts run on the event loop, so a slow or
+        # unreachable endpoint never holds up these checks
+        while True:
+            # verify leader status, under the lock since an election may save the stores
+            with self.state_lock.high():
+                self.verify_leader()
 
             # attempt to sync database if needed
             if not self.db_synchronized:
                 self.sync_database_from_leader()
+            elif self.anti_entropy_interval > 0 and time.monotonic() >= self.next_anti_entropy:
+                self.next_anti_entropy = time.monotonic() + self.anti_entropy_interval
+                self.start_anti_entropy()
 
             time.sleep(1)
 
+    def leader_candidates(self):
+        # nodes of our group that may lead; ones catching up after a restart or draining for
+        # one are passed over while anyone else can lead. a restarted node that reaches no
+        # caught-up peer within REJOIN_GRACE leads from its own stores
+        me = f"{self.host}:{self.port}"
+        peers = [f"{addr[0]}:{addr[1]}" for addr, _ in self.peers_in_group(self.group)]
+        ready = [peer for peer in peers if peer not in self.catching_up and peer not in self.departed]
+        if not (self.rejoining or self.draining):
+            ready.append(me)
+        if ready:
+            return ready
+        if self.rejoining and time.monotonic() - self.started < REJOIN_GRACE:
+            return []
+        return [me] + peers
+
+    def note_rejoining(self, peer, hello_data):
+        # a peer that identifies itself is back, and may still be catching up
+        self.departed.pop(peer, None)
+        if hello_data.get("rejoining"):
+            self.catching_up.add(peer)
+        else:
+            self.catching_up.discard(peer)
+        self.note_leader(peer, hello_data)
+
+    def note_leader(self, peer, data):
+        # record the leader a peer follows; once we have elected, a claim from our own group
+        # with a later term, or the lower leader in the same term, replaces ours as long as
+        # that leader could lead for us too
+        if "leader" not in data:
+            return
+        term, leader = data.get("term", 0), data["leader"]
+        self.peer_leaders[peer] = (term, leader)
+        if not self.elected or leader is None:
+            return
+        if self.ring is not None and self.peer_groups.get(peer) != self.group:
+            return
+        if leader == self.leader:
+            self.term = max(self.term, term)
+            return
+        better = term > self.term or (term == self.term and (self.leader is None or leader < self.leader))
+        if better and leader in self.leader_candidates():
+            print(f"INTERNAL {self.id}: Peer {peer} follows {leader} in term {term}, adopting it")
+            self.set_leader(leader, term)
+
+    def finish_rejoin(self):
+        # caught up after a restart: tell the peers we can be elected again
+        if not self.rejoining:
+            return
+        print(f"INTERNAL {self.id}: Caught up after restart")
+        self.rejoining = False
+        # may run on the monitor thread, so the stores are saved under the state lock
+        with self.state_lock.high():
+            self.vm.database["settings"].pop("drained", None)
+            self.vm.persist()
+        frame = framing.encode_frame({"version": 0, "command": "caught_up", "host": self.host,
+                                      "port": self.port, "data": {}})
+        for addr, sock in self.peer_connections:
+            self.send_to_peer(addr, sock, frame)
+
+    def request_drain(self, timeout):
+        # start handing off before a restart; drained is set once peers have our updates
+        # (or timeout seconds have passed) and know we are leaving
+        self.drain_deadline = time.monotonic() + timeout
+        self.draining = True
+        self.wake()
+
+    def continue_drain(self):
+        # runs on each pass of the event loop while draining: flush our updates, give the
+        # group until the deadline to acknowledge them, then announce our applied vector and
+        # let go once that announcement has been written
+        if self.leaving_sent:
+            if self.flush_outbound() or time.monotonic() >= self.drain_deadline + 1:
+                print(f"INTERNAL {self.id}: Drained")
+                self.drained.set()
+            return
+        self.flush_batch()
+        peers = self.peers_in_group(self.group)
+        with self.ack_lock:
+            acked = self.next_index == 0 or self.acked_by(self.next_index) >= len(peers)
+        if not (acked and self.flush_outbound()) and time.monotonic() < self.drain_deadline:
+            return
+        frame = framing.encode_frame({"version": 0, "command": "leaving", "host": self.host,
+                                      "port": self.port,
+                                      "data": {"applied": dict(self.applied_vector())}})
+        for addr, sock in list(self.peer_connections):
+            self.send_to_peer(addr, sock, frame)
+        self.leaving_sent = True
+
+    def start_anti_entropy(self):
+        # open a round by sending our root to the leader; it answers only if the roots differ
+        # a follower that trails the leader would just see the updates still in flight
+        if self.is_leader() or self.leader is None or self.read_lag() != 0:
+            return
+        with self.state_lock.high():
+            root = self.vm.merkle.root()
+        self.send_merkle(self.leader, "merkle_root", {"root": root})
+
+    def send_merkle(self, peer, command, data):
+        frame = framing.encode_frame({"version": 0, "command": command, "host": self.host,
+                                      "port": self.port, "data": data})
+        for addr, sock in self.peer_connections:
+            if f"{addr[0]}:{addr[1]}" == peer:
+                self.send_to_peer(addr, sock, frame)
+
+    def handle_anti_entropy(self, msg):
+        # one step of the tree comparison; the leader describes its tree a level at a time
+        # and the follower asks only for the subtrees whose hashes differ from its own
+        peer = f"{msg['host']}:{msg['port']}"
+        tree = self.vm.merkle
+        data = msg["data"]
+        command = msg["command"]
+        if command == "merkle_root":
+            if data["root"] != tree.root():
+                self.send_merkle(peer, "merkle_branches", {"branches": tree.branch_hashes()})
+            return
+        if command == "merkle_leaves":
+            leaves = {}
+            for branch in data["branches"]:
+                leaves.update(tree.leaves_of(branch))
+            self.send_merkle(peer, "merkle_leaf_hashes", {"leaves": leaves})
+            return
+        if command == "merkle_keys":
+            self.send_merkle(peer, "merkle_key_hashes",
+                             {"keys": {leaf: tree.keys_in(leaf) for leaf in data["leaves"]}})
+            return
+        if command == "merkle_fetch":
+            # our applied vector tells the follower whether these copies include all it holds
+            self.send_merkle(peer, "merkle_repair",
+                             {"items": {key: self.vm.merkle_value(key) for key in data["keys"]},
+                              "applied": dict(self.applied_vector())})
+            return
+        # the remaining steps run on the follower, which trusts only its current leader
+        if peer != self.leader or self.is_leader():
+            return
+        if command == "merkle_branches":
+            branches = merkle.differing(tree.branch_hashes(), data["branches"])
+            if branches:
+                self.send_merkle(peer, "merkle_leaves", {"branches": branches})
+        elif command == "merkle_leaf_hashes":
+            theirs = {int(leaf): value for leaf, value in data["leaves"].items()}
+            mine = {leaf: value for branch in {leaf // merkle.FANOUT for leaf in theirs}
+                    for leaf, value in tree.leaves_of(branch).items()}
+            leaves = merkle.differing(mine, theirs)
+            if leaves:
+                self.send_merkle(peer, "merkle_keys", {"leaves": leaves})
+        elif command == "merkle_key_hashes":
+            keys = []
+            for leaf, theirs in data["keys"].items():
+                keys.extend(merkle.differing(tree.keys_in(int(leaf)), theirs))
+            if keys:
+                self.repair_fetched = {key: tree.item_hash(key) for key in keys}
+                self.send_merkle(peer, "merkle_fetch", {"keys": keys})
+        elif command == "merkle_repair":
+            fetched, self.repair_fetched = self.repair_fetched, {}
+            # updates may have been applied since the round started; the leader's copies only
+            # win if it had applied everything we have, and never over keys changed meanwhile
+            theirs = data.get("applied", {})
+            if any(index > theirs.get(origin, 0) for origin, index in self.applied_vector().items()):
+                print(f"INTERNAL {self.id}: Anti-entropy skipped, leader has not applied all our updates")
+                return
+            items = {key: value for key, value in data["items"].items()
+                     if key in fetched and tree.item_hash(key) == fetched[key]}
+            print(f"INTERNAL {self.id}: Anti-entropy repairing {len(items)} keys")
+            if items:
+                self.vm.apply_repair(items)
+
     def verify_leader(self):
         # check if current leader is valid or needs re-election
         all_nodes = [f"{self.host}:{self.port}"] + [
-            f"{addr[0]}:{addr[1]}" for addr, _ in self.peer_connections
+            f"{addr[0]}:{addr[1]}" for addr, _ in self.peers_in_group(self.group)
         ]
-        
+        if not self.elected and not self.discovery_settled():
+            # not every peer has been heard from yet; electing now could pick ourselves
+            # beside a group that already has a leader
+            return
+        # a live leader is kept even when a lower node joins: that node may be new or still
+        # behind, and following it would make the others sync their newer data away
         if (
             not self.leader
             or self.leader not in all_nodes
-            or self.leader < min(all_nodes)
+            or self.leader not in self.leader_candidates()
         ):
             print(f"INTERNAL {self.id}: Leader validation failed, selecting new leader")
             self.select_leader()
 
+    def send_forward_reply(self, msg, reply):
+        # may run on whichever thread released the write concern gate
+        frame = {"version": 0, "command": "forward_reply", "host": self.host, "port": self.port,
+                 "data": {"request_id": msg["data"]["request_id"], "reply": reply}}
+        for addr, sock in list(self.peer_connections):
+            if addr[0] == msg["host"] and addr[1] == msg["port"]:
+                self.send_to_peer(addr, sock, framing.encode_frame(frame))
+
+    def send_ack(self, msg, entries):
+        # tell the sender how far we have applied each origin in a replication frame
+        if "host" not in msg:
+            return
+        applied = self.applied_vector()
+        origins = {entry["origin"] for entry in entries if "origin" in entry}
+        frame = {"version": 0, "command": "ack", "host": self.host, "port": self.port,
+                 "data": {"applied": {origin: applied.get(origin, 0) for origin in origins}}}
+        for addr, sock in self.peer_connections:
+            if addr[0] == msg["host"] and addr[1] == msg["port"]:
+                self.send_to_peer(addr, sock, framing.encode_frame(frame))
+
+    def session_token(self):
+        # replication position of this node's updates so far; a client presents it to read
+        # its own writes from a follower
+        with self.batch_lock:
+            token = {self.origin: self.next_index}
+            for group, index in self.stream_index.items():
+                token[f"{self.origin}>{group}"] = index
+        return token
+
+    def has_applied(self, token):
+        # whether every update named in a session token has been applied here
+        # streams addressed to other replica groups never reach us and are skipped
+        applied = self.applied_vector()
+        for origin, index in token.items():
+            if ">" in origin and origin.rsplit(">", 1)[1] != self.group:
+                continue
+            if applied.get(origin, 0) < index:
+                return False
+        return True
+
+    def read_lag(self):
+        # how many updates the leader had applied, as of its last ping, that we have not
+        if self.is_leader():
+            return 0
+        if self.leader_applied is None or time.monotonic() - self.leader_applied_at > self.suspicion_timeout:
+            return float("inf")
+        applied = self.applied_vector()
+        return sum(max(0, index - applied.get(origin, 0)) for origin, index in self.leader_applied.items())
+
+    def last_index(self):
+        # index of the newest update this node has broadcast
+        return self.next_index
+
+    def acks_needed(self, write_concern):
+        # number of peers that must apply a write before it satisfies the write concern
+        if write_concern == "one":
+            return 1
+        if write_concern == "majority":
+            nodes = max(self.cluster_size, len(self.peers_in_group(self.group)) + 1)
+            return nodes // 2
+        return 0
+
+    def acked_by(self, index):
+        return sum(1 for acked in self.peer_acks.values() if acked >= index)
+
+    def wait_for_acks(self, index, needed, timeout):
+        # future resolving to True once needed peers have applied our update index,
+        # or to False if that has not happened within timeout seconds
+        future = concurrent.futures.Future()
+        with self.ack_lock:
+            if self.acked_by(index) >= needed:
+                future.set_result(True)
+                return future
+            self.ack_waiters.append((index, needed, time.monotonic() + timeout, future))
+        self.wake()
+        return future
+
+    def record_ack(self, peer, applied):
+        if self.origin not in applied:
+            return
+        with self.ack_lock:
+            self.peer_acks[peer] = max(self.peer_acks.get(peer, 0), applied[self.origin])
+            self.settle_ack_waiters()
+
+    def settle_ack_waiters(self):
+        # resolve satisfied or expired waiters; the caller holds ack_lock
+        now = time.monotonic()
+        waiting = []
+        for waiter in self.ack_waiters:
+            index, needed, deadline, future = waiter
+            if self.acked_by(index) >= needed:
+                future.set_result(True)
+            elif now >= deadline:
+                future.set_result(False)
+            else:
+                waiting.append(waiter)
+        self.ack_waiters = waiting
+
+    def peers_in_group(self, group):
+        # connections to the peers in a replica group; without sharding every peer is in ours
+        if self.ring is None:
+            return list(self.peer_connections)
+        return [(addr, sock) for addr, sock in self.peer_connections
+                if self.peer_groups.get(f"{addr[0]}:{addr[1]}") == group]
+
+    def owner_group(self, username):
+        # the replica group holding a user's mailbox, or None when users are not sharded
+        return None if self.ring is None else self.ring.owner(username)
+
+    def leader_of(self, group):
+        # another group's leader is the best claim its members announced in handshakes and
+        # pings, by the rule note_leader applies to ours: the latest term, then the lower
+        # address. None until one of them has reported a leader we are connected to
+        if group == self.group:
+            return self.leader
+        members = [f"{addr[0]}:{addr[1]}" for addr, _ in self.peers_in_group(group)]
+        claims = [self.peer_leaders[member] for member in members
+                  if self.peer_leaders.get(member, (0, None))[1] in members]
+        if not claims:
+            return None
+        term = max(term for term, _ in claims)
+        return min(leader for claimed, leader in claims if claimed == term)
+
+    def is_leader(self):
+        return self.leader == f"{self.host}:{self.port}"
+
+    def forward_request(self, payload, group=None):
+        # send a client request to the leader of a group (ours by default), returning False
+        # when that leader is not reachable
+        leader = self.leader_of(self.group if group is None else group)
+        for addr, conn in self.peer_connections:
+            if f"{addr[0]}:{addr[1]}" == leader:
+                frame = {"version": 0, "command": "forward_request", "host": self.host,
+                         "port": self.port, "data": payload}
+                self.send_to_peer(addr, conn, framing.encode_frame(frame))
+                return True
+        return False
+
+    def discovery_settled(self):
+        # every other endpoint has identified itself or failed a connection attempt, or the
+        # wait has gone on for REJOIN_GRACE
+        if time.monotonic() - self.started >= REJOIN_GRACE:
+            return True
+        for host, port in self.available_endpoints:
+            if (host, port) == (self.host, self.port) or f"{host}:{port}" in self.peer_groups:
+                continue
+            if (host, port) not in self.backoff or (host, port) in self.connecting:
+                return False
+        return True
+
     def select_leader(self):
-        # select a new leader based on lowest ID
-        all_nodes = [f"{self.host}:{self.port}"] + [
-            f"{addr[0]}:{addr[1]}" for addr, _ in self.peer_connections
-        ]
-        new_leader = min(all_nodes)
+        # select a new leader based on lowest ID in a term later than any we know of; on its
+        # first election a node follows the best claim its peers already made, if any,
+        # instead of starting a second leader
+        candidates = self.leader_candidates()
+        announced = list(self.peer_leaders.copy().values())
+        followed = [(term, leader) for term, leader in announced if leader in candidates]
+        if not self.elected and followed:
+            # the latest term wins, then the lower address
+            term = max(term for term, _ in followed)
+            new_leader = min(leader for claimed, leader in followed if claimed == term)
+        else:
+            new_leader = min(candidates) if candidates else None
+            term = self.term
+            if new_leader is not None and new_leader != self.leader:
+                term = max([self.term] + [term for term, _ in announced]) + 1
+        self.elected = self.elected or new_leader is not None
+        self.set_leader(new_leader, term)
+
+    def set_leader(self, new_leader, term):
+        # follow new_leader from now on and resynchronize from it
+        if new_leader != self.leader:
+            self.leader_applied = None
+            self.counters["leader_changes"] += 1
         self.leader = new_leader
+        self.term = term
         self.db_synchronized = False
+        if self.is_leader():
+            # nobody else was there to catch up from
+            self.finish_rejoin()
         print(f"INTERNAL {self.id}: New leader selected: {self.leader}")
 
     def sync_database_from_leader(self):
-        # request database sync from the current leader
+        # request the updates this node is missing from the current leader
+        # a node that has never applied any update asks for a full snapshot instead
+        if self.incoming_snapshot is not None:
+            # a snapshot is already on its way; only nudge it along if it has stalled
+            if self.incoming_snapshot.stalled():
+                self.request_snapshot_resume()
+            return
+        pending = self.sync_request
+        if pending is not None and pending[0] == self.leader and time.monotonic() < pending[1]:
+            # still waiting for the answer to the last request
+            return
         if self.leader is not None:
+            applied = self.vm.database["settings"].get("applied", {})
+            if applied:
+                request = {"version": 0, "command": "get_log", "host": self.host,
+                           "port": self.port, "applied": applied}
+            else:
+                request = {"version": 0, "command": "get_database", "host": self.host,
+                           "port": self.port}
             for addr, conn in self.peer_connections:
                 if f"{addr[0]}:{addr[1]}" == self.leader:
-                    try:
-                        conn.sendall(
-                            f"{json.dumps({'version': 0, 'command': 'get_database', 'host': self.host, 'port': self.port})}\0".encode(
-                                "utf-8"
-                            )
-                        )
-                    except Exception as e:
-                        print(f"INTERNAL {self.id}: Error syncing database: {e}")
-
-    def broadcast_update(self, update):
-        # distribute updates to all peer servers
-        for _, sock in self.peer_connections:
-            data_obj = {
+                    self.send_to_peer(addr, conn, framing.encode_frame(request))
+                    self.sync_request = (self.leader, time.monotonic() + SYNC_REQUEST_TIMEOUT)
+
+    def broadcast_update(self, update, groups=None):
+        # number and log the update, then add it to the batch being assembled for peers
+        # with sharding, groups names the replica groups that store the update (None means
+        # all of them); each other group gets its own numbered stream from this node
+        with self.batch_lock:
+            window_opens = not self.pending_batch
+            targets = {self.group}
+            if self.ring is not None:
+                targets = set(self.ring.groups if groups is None else groups)
+            for group in sorted(targets):
+                if group == self.group:
+                    self.next_index += 1
+                    entry = self.make_entry(self.origin, self.next_index, update)
+                    self.applied_vector()[self.origin] = self.next_index
+                    self.append_log(entry)
+                    self.broadcast_times.append((self.next_index, time.monotonic()))
+                else:
+                    # other groups catch up from their own leaders, so these are not logged here
+                    index = self.stream_index.get(group, 0) + 1
+                    self.stream_index[group] = index
+                    entry = self.make_entry(f"{self.origin}>{group}", index, update)
+                    entry["group"] = group
+                self.pending_batch.append(entry)
+            if window_opens:
+                self.batch_deadline = time.monotonic() + self.batch_window
+            full = len(self.pending_batch) >= self.batch_max or self.batch_window <= 0
+        if full:
+            self.flush_batch()
+        else:
+            self.wake()
+
+    def make_entry(self, origin, index, update):
+        return {
+            "version": 0,
+            "command": "distribute_update",
+            "origin": origin,
+            "index": index,
+            "data": {
                 "version": 0,
-                "command": "distribute_update",
-                "data": {
-                    "version": 0,
-                    "command": update["command"],
-                    "data": update["data"],
-                },
-            }
-            sock.sendall(f"{json.dumps(data_obj)}\0".encode("utf-8"))
+                "command": update["command"],
+                "data": update["data"],
+            },
+        }
+
+    def flush_batch(self):
+        # encode the pending updates once and queue the frame for every peer
+        # the lock is held while queueing so batches reach each peer in order
+        with self.batch_lock:
+            entries = self.pending_batch
+            self.pending_batch = []
+            self.batch_deadline = None
+            if not entries:
+                return
+            by_group = {}
+            for entry in entries:
+                by_group.setdefault(entry.get("group", self.group), []).append(entry)
+            for group, group_entries in by_group.items():
+                # the sender address tells replicas where to acknowledge the updates
+                if len(group_entries) == 1:
+                    frame = framing.encode_frame(
+                        {**group_entries[0], "host": self.host, "port": self.port})
+                else:
+                    frame = framing.encode_frame(
+                        {"version": 0, "command": "distribute_batch", "host": self.host,
+                         "port": self.port, "data": {"entries": group_entries}})
+                for addr, sock in self.peers_in_group(group):
+                    self.send_to_peer(addr, sock, frame, droppable=True)
+                    counters = self.peer_counters[f"{addr[0]}:{addr[1]}"]
+                    counters["updates_sent"] += len(group_entries)
+                    counters["update_bytes_sent"] += len(frame)
@@ -20,6 +20,33 @@ def initialize_server_nodes():
             internal_other_servers=settings.internal_other_servers.split(","),
             internal_other_ports=list(map(int, settings.internal_other_ports.split(","))),
             internal_max_ports=list(map(int, settings.internal_max_ports.split(","))),
+            serialization_workers=settings.serialization_workers,
+            serialization_pool=settings.serialization_pool,
+            offload_threshold=settings.offload_threshold,
+            log_capacity=settings.log_capacity,
+            peer_queue_bytes=settings.peer_queue_bytes,
+            batch_window_ms=settings.batch_window_ms,
+            batch_max=settings.batch_max,
+            snapshot_chunk_bytes=settings.snapshot_chunk_bytes,
+            write_mode=settings.write_mode,
+            id_scheme=settings.id_scheme,
+            node_number=None if settings.node_number < 0 else settings.node_number + i,
+            write_concern=settings.write_concern,
+            write_timeout_ms=settings.write_timeout_ms,
+            cluster_size=settings.cluster_size,
+            heartbeat_interval_ms=settings.heartbeat_interval_ms,
+            suspicion_timeout_ms=settings.suspicion_timeout_ms,
+            phi_threshold=settings.phi_threshold,
+            connect_timeout_ms=settings.connect_timeout_ms,
+            max_backoff_ms=settings.max_backoff_ms,
+            shard_groups=[g for g in settings.shard_groups.split(",") if g],
+            shard_group=settings.shard_group,
+            max_read_lag=settings.max_read_lag,
+            anti_entropy_interval_ms=settings.anti_entropy_interval_ms,
+            dedup_capacity=settings.dedup_capacity,
+            client_budget=settings.client_budget,
+            drain_timeout_ms=settings.drain_timeout_ms,
+            replication_factor=settings.replication_factor,
         )
         node.start()
         active_servers.append(node)
@@ -66,6 +93,169 @@ def setup_command_parameters(args):
         default="10",
         help="list of other server ports.",
     )
+    parser.add_argument(
+        "--serialization_workers",
+        type=int,
+        default=2,
+        help="Workers encoding large replies off the event loop (0 encodes inline).",
+    )
+    parser.add_argument(
+        "--serialization_pool",
+        type=str,
+        default="process",
+        choices=["thread", "process"],
+        help="Kind of pool used for serialization workers (json encoding holds the GIL, so only processes keep the event loop free).",
+    )
+    parser.add_argument(
+        "--offload_threshold",
+        type=int,
+        default=200,
+        help="Minimum number of list entries in a reply before it is offloaded.",
+    )
+    parser.add_argument(
+        "--log_capacity",
+        type=int,
+        default=10000,
+        help="Replicated updates kept in memory for catch-up before a snapshot is needed.",
+    )
+    parser.add_argument(
+        "--peer_queue_bytes",
+        type=int,
+        default=8 * 1024 * 1024,
+        help="Replication bytes buffered per peer before updates are dropped for a resync.",
+    )
+    parser.add_argument(
+        "--batch_window_ms",
+        type=int,
+        default=5,
+        help="Window in which replication updates are batched into one frame (0 disables).",
+    )
+    parser.add_argument(
+        "--batch_max",
+        type=int,
+        default=64,
+        help="Maximum number of replication updates per batch.",
+    )
+    parser.add_argument(
+        "--snapshot_chunk_bytes",
+        type=int,
+        default=256 * 1024,
+        help="Size of each checksummed chunk when streaming a database snapshot.",
+    )
+    parser.add_argument(
+        "--write_mode",
+        choices=["leader", "local"],
+        default="leader",
+        help="Send every client write through the elected leader, or apply it on the receiving node.",
+    )
+    parser.add_argument(
+        "--id_scheme",
+        choices=["sequence", "snowflake"],
+        default="sequence",
+        help="Number messages from a shared counter, or with per-node time-ordered ids.",
+    )
+    parser.add_argument(
+        "--node_number",
+        type=int,
+        default=-1,
+        help="Node number embedded in snowflake ids for the first server (required with --id_scheme snowflake).",
+    )
+    parser.add_argument(
+        "--write_concern",
+        choices=["local", "one", "majority"],
+        default="local",
+        help="Replicas that must apply a write before the client gets its reply.",
+    )
+    parser.add_argument(
+        "--write_timeout_ms",
+        type=int,
+        default=2000,
+        help="How long a write waits for replica acknowledgements before replying with an error.",
+    )
+    parser.add_argument(
+        "--cluster_size",
+        type=int,
+        default=0,
+        help="Total number of nodes used to compute a majority (0 counts connected nodes).",
+    )
+    parser.add_argument(
+        "--heartbeat_interval_ms",
+        type=int,
+        default=200,
+        help="Interval between pings sent to each peer.",
+    )
+    parser.add_argument(
+        "--suspicion_timeout_ms",
+        type=int,
+        default=2000,
+        help="Silence after which a peer is considered failed regardless of its history.",
+    )
+    parser.add_argument(
+        "--phi_threshold",
+        type=float,
+        default=8.0,
+        help="Phi accrual suspicion level at which a peer is considered failed.",
+    )
+    parser.add_argument(
+        "--connect_timeout_ms",
+        type=int,
+        default=500,
+        help="How long a connection attempt to a candidate peer may take.",
+    )
+    parser.add_argument(
+        "--max_backoff_ms",
+        type=int,
+        default=5000,
+        help="Longest delay between connection attempts to an endpoint that keeps failing.",
+    )
+    parser.add_argument(
+        "--shard_groups",
+        type=str,
+        default="",
+        help="Comma-separated names of every replica group users are sharded across (empty disables sharding).",
+    )
+    parser.add_argument(
+        "--shard_group",
+        type=str,
+        default="0",
+        help="Replica group the servers started by this command belong to.",
+    )
+    parser.add_argument(
+        "--max_read_lag",
+        type=int,
+        default=50,
+        help="Updates a follower may trail the leader by and still answer reads itself (-1 disables the bound).",
+    )
+    parser.add_argument(
+        "--anti_entropy_interval_ms",
+        type=int,
+        default=10000,
+        help="Milliseconds between merkle tree comparisons of a follower with its leader (0 disables).",
+    )
+    parser.add_argument(
+        "--dedup_capacity",
+        type=int,
+        default=1000,
+        help="Client request ids whose replies are kept so retried writes are not applied twice.",
+    )
+    parser.add_argument(
+        "--client_budget",
+        type=int,
+        default=32,
+        help="Client connections served per event loop iteration before replication gets a turn.",
+    )
+    parser.add_argument(
+        "--drain_timeout_ms",
+        type=int,
+        default=5000,
+        help="Milliseconds a draining server waits for peers to acknowledge its last updates.",
+    )
+    parser.add_argument(
+        "--replication_factor",
+        type=int,
+        default=0,
+        help="Nodes storing each user, out of --cluster_size numbered nodes (0 stores everything everywhere).",
+    )
     return parser.parse_args(args)
 
 
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import threading
+
+# the key space is split into LEAF_COUNT leaves, grouped FANOUT to a branch under the root
+LEAF_COUNT = 256
+FANOUT = 16
+# default milliseconds between anti-entropy rounds on a follower
+DEFAULT_ANTI_ENTROPY_INTERVAL_MS = 10000
+EMPTY_HASH = ""
+
+
+def digest(value):
+    # stable hash of any json-serializable value, independent of dict ordering
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def leaf_of(key):
+    return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:4], "big") % LEAF_COUNT
+
+
+def differing(mine, theirs):
+    # positions (list indexes or dict keys) whose hashes disagree, including ones only one side has
+    if isinstance(mine, dict):
+        return sorted(key for key in set(mine) | set(theirs) if mine.get(key) != theirs.get(key))
+    return [i for i, (a, b) in enumerate(zip(mine, theirs)) if a != b]
+
+
+class MerkleTree:
+    # hash tree over keyed items: root -> branches -> leaves -> item hashes
+    # writers only mark keys dirty; item and leaf hashes are recomputed for just those keys
+    # the next time the tree is read, so the write path never pays for hashing
+    def __init__(self, item_hash):
+        # item_hash(key) returns the current hash of an item, or None when it does not exist
+        self.item_hash = item_hash
+        self.leaves = [{} for _ in range(LEAF_COUNT)]
+        self.leaf_hashes = [EMPTY_HASH] * LEAF_COUNT
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def mark_dirty(self, key):
+        with self.lock:
+            self.dirty.add(key)
+
+    def refresh(self):
+        # rehash dirty items and the leaves holding them
+        with self.lock:
+            stale = set()
+            for key in self.dirty:
+                leaf = leaf_of(key)
+                item = self.item_hash(key)
+                if item is None:
+                    self.leaves[leaf].pop(key, None)
+                else:
+                    self.leaves[leaf][key] = item
+                stale.add(leaf)
+            self.dirty = set()
+            for leaf in stale:
+                items = self.leaves[leaf]
+                self.leaf_hashes[leaf] = digest(sorted(items.items())) if items else EMPTY_HASH
+
+    def branch_hashes(self):
+        self.refresh()
+        return [digest(self.leaf_hashes[start:start + FANOUT]) for start in range(0, LEAF_COUNT, FANOUT)]
+
+    def root(self):
+        return digest(self.branch_hashes())
+
+    def leaves_of(self, branch):
+        # leaf -> hash for every leaf under one branch
+        self.refresh()
+        return {leaf: self.leaf_hashes[leaf] for leaf in range(branch * FANOUT, (branch + 1) * FANOUT)}
+
+    def keys_in(self, leaf):
+        # key -> hash for every item in one leaf
+        self.refresh()
+        return dict(self.leaves[leaf])
@@ -0,0 +1,40 @@
+import threading
+import time
+
+# ids are laid out snowflake style: milliseconds since ID_EPOCH_MS, then the node number,
+# then a per-millisecond sequence, so they sort by creation time across the cluster
+ID_EPOCH_MS = 1735689600000  # 2025-01-01 UTC
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+MAX_NODE = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class MessageIdGenerator:
+    # hands out unique, roughly time-ordered message ids without talking to other nodes
+    def __init__(self, node_number):
+        if not 0 <= node_number <= MAX_NODE:
+            raise ValueError(f"node number must be between 0 and {MAX_NODE}")
+        self.node_number = node_number
+        self.last_ms = 0
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            # never step backwards if the wall clock does; reuse the last millisecond instead
+            now_ms = max(int(time.time() * 1000) - ID_EPOCH_MS, self.last_ms)
+            if now_ms == self.last_ms:
+                self.sequence += 1
+                if self.sequence > MAX_SEQUENCE:
+                    # the millisecond is used up, borrow the next one rather than block
+                    now_ms += 1
+                    self.sequence = 0
+            else:
+                self.sequence = 0
+            self.last_ms = now_ms
+            return (now_ms << (NODE_BITS + SEQUENCE_BITS)) | (self.node_number << SEQUENCE_BITS) | self.sequence
+
+    @staticmethod
+    def node_of(message_id):
+        return (message_id >> SEQUENCE_BITS) & MAX_NODE
@@ -0,0 +1,127 @@
+import bisect
+
+
+# key identifying the conversation between two users regardless of direction
+def conversation_key(user_a, user_b):
+    return (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+
+
+class MessageIndex:
+    # in-memory lookup structures over the message store
+    # entries reference the same message objects held in the delivered/undelivered mailboxes
+    # each bucket is a pair of lists: sorted (timestamp, id) keys and messages in the same order
+    def __init__(self):
+        self.by_id = {}
+        # receiver -> bucket
+        self.by_receiver_time = {}
+        # sender -> {id: message}, in insertion order
+        self.by_sender = {}
+        # conversation_key(sender, receiver) -> bucket
+        self.by_conversation = {}
+
+    # build a fresh index from the id-keyed delivered and undelivered mailboxes
+    @classmethod
+    def from_messages(cls, messages):
+        index = cls()
+        for msg_obj in messages["delivered"].values():
+            index.add(msg_obj)
+        for msg_obj in messages["undelivered"].values():
+            index.add(msg_obj)
+        return index
+
+    @staticmethod
+    def time_key(msg_obj):
+        # messages persisted before timestamps existed sort first
+        return (msg_obj.get("timestamp", 0), msg_obj["id"])
+
+    @staticmethod
+    def insert_sorted(buckets, bucket_key, msg_obj):
+        keys, msgs = buckets.setdefault(bucket_key, ([], []))
+        key = MessageIndex.time_key(msg_obj)
+        pos = bisect.bisect_right(keys, key)
+        keys.insert(pos, key)
+        msgs.insert(pos, msg_obj)
+
+    @staticmethod
+    def discard_sorted(buckets, bucket_key, msg_obj):
+        entry = buckets.get(bucket_key)
+        if entry is None:
+            return
+        keys, msgs = entry
+        key = MessageIndex.time_key(msg_obj)
+        pos = bisect.bisect_left(keys, key)
+        while pos < len(keys) and keys[pos] == key:
+            if msgs[pos] is msg_obj:
+                del keys[pos]
+                del msgs[pos]
+                break
+            pos += 1
+        if not keys:
+            del buckets[bucket_key]
+
+    # index a newly stored message
+    def add(self, msg_obj):
+        self.by_id[msg_obj["id"]] = msg_obj
+        self.insert_sorted(self.by_receiver_time, msg_obj["receiver"], msg_obj)
+        self.by_sender.setdefault(msg_obj["sender"], {})[msg_obj["id"]] = msg_obj
+        self.insert_sorted(self.by_conversation,
+                           conversation_key(msg_obj["sender"], msg_obj["receiver"]), msg_obj)
+
+    # drop a message that was removed from the store
+    def remove(self, msg_obj):
+        if self.by_id.get(msg_obj["id"]) is msg_obj:
+            del self.by_id[msg_obj["id"]]
+        self.discard_sorted(self.by_receiver_time, msg_obj["receiver"], msg_obj)
+        sent = self.by_sender.get(msg_obj["sender"])
+        if sent is not None and sent.get(msg_obj["id"]) is msg_obj:
+            del sent[msg_obj["id"]]
+            if not sent:
+                del self.by_sender[msg_obj["sender"]]
+        self.discard_sorted(self.by_conversation,
+                            conversation_key(msg_obj["sender"], msg_obj["receiver"]), msg_obj)
+
+    # every message received by username, oldest first
+    def received(self, username):
+        return list(self.by_receiver_time.get(username, ([], []))[1])
+
+    # every message sent or received by username, each listed once
+    def involving(self, username):
+        found = {m["id"]: m for m in self.by_receiver_time.get(username, ([], []))[1]}
+        found.update(self.by_sender.get(username, {}))
+        return list(found.values())
+
+    # messages received by username strictly after the given time, oldest first
+    def received_since_time(self, username, since_time, limit=None):
+        keys, msgs = self.by_receiver_time.get(username, ([], []))
+        # (since_time, inf) sorts after every key carrying exactly since_time
+        pos = bisect.bisect_right(keys, (since_time, float("inf")))
+        end = len(msgs) if limit is None else min(len(msgs), pos + limit)
+        return msgs[pos:end]
+
+    # messages received by username after the message with id since_id, oldest first
+    def received_since_id(self, username, since_id, limit=None):
+        anchor = self.by_id.get(since_id)
+        if anchor is not None and anchor["receiver"] == username:
+            keys, msgs = self.by_receiver_time[username]
+            pos = bisect.bisect_right(keys, self.time_key(anchor))
+            end = len(msgs) if limit is None else min(len(msgs), pos + limit)
+            return msgs[pos:end]
+        # the anchor is gone (deleted or never ours), so fall back to comparing ids
+        _, msgs = self.by_receiver_time.get(username, ([], []))
+        newer = [m for m in msgs if m["id"] > since_id]
+        return newer if limit is None else newer[:limit]
+
+    # one page of the thread between two users, oldest first, ending just before before_id
+    # returns the page and the id to pass as before_id for the next (older) page, or None
+    def conversation_page(self, user_a, user_b, page_size, before_id=None):
+        keys, msgs = self.by_conversation.get(conversation_key(user_a, user_b), ([], []))
+        end = len(msgs)
+        if before_id is not None:
+            anchor = self.by_id.get(before_id)
+            if anchor is None or conversation_key(anchor["sender"], anchor["receiver"]) != conversation_key(user_a, user_b):
+                return [], None
+            end = bisect.bisect_left(keys, self.time_key(anchor))
+        start = max(0, end - page_size)
+        page = msgs[start:end]
+        next_before = msgs[start]["id"] if start > 0 else None
+        return page, next_before
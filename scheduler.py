@@ -0,0 +1,60 @@
+import contextlib
+import threading
+
+# default number of client requests the server loop runs before checking in with replication
+DEFAULT_CLIENT_BUDGET = 32
+
+
+class PriorityLock:
+    # reentrant lock over the replicated state shared by the client loop and the coordinator
+    # replication work takes it at high priority: once it is waiting, no new client request
+    # starts, so under load replicas keep applying updates instead of queueing behind clients
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.owner = None
+        self.depth = 0
+        self.high_waiting = 0
+
+    def acquire(self, high=False):
+        me = threading.get_ident()
+        with self.cond:
+            if self.owner == me:
+                self.depth += 1
+                return
+            if high:
+                self.high_waiting += 1
+                while self.owner is not None:
+                    self.cond.wait()
+                self.high_waiting -= 1
+            else:
+                while self.owner is not None or self.high_waiting:
+                    self.cond.wait()
+            self.owner = me
+            self.depth = 1
+
+    def release(self):
+        with self.cond:
+            self.depth -= 1
+            if self.depth == 0:
+                self.owner = None
+                self.cond.notify_all()
+
+    def contended(self):
+        # whether high priority work is waiting for the lock
+        return self.high_waiting > 0
+
+    @contextlib.contextmanager
+    def high(self):
+        self.acquire(high=True)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextlib.contextmanager
+    def low(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
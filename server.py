@@ -1,21 +1,104 @@
+import collections
+import concurrent.futures
 import database
+import failure_detector
 import fnmatch
 import handle_servers
 import json
+import merkle
+import message_ids
+import message_index
 import multiprocessing
+import scheduler
 import selectors
+import sharding
+import signal
+import snapshot_transfer
 import socket
+import time
 import types
+import workers
+
+# client commands that change replicated state; in leader write mode followers forward them
+WRITE_COMMANDS = {"create", "login", "logout", "delete_acct", "send_msg", "get_undelivered", "delete_msg"}
+# read-only client commands, which followers answer when they are fresh enough
+READ_COMMANDS = {"search", "get_delivered", "refresh_home", "get_messages_since", "get_conversation"}
+# default number of updates a follower may trail the leader by and still answer reads
+DEFAULT_MAX_READ_LAG = 50
+# client commands that touch one user's mailbox, and the field naming that user; when
+# users are sharded they run in the replica group that owns the user
+MAILBOX_COMMANDS = {"send_msg": "sender", "get_undelivered": "username", "get_delivered": "username",
+                    "refresh_home": "username", "delete_msg": "current_user",
+                    "get_messages_since": "username", "get_conversation": "username"}
+# seconds a follower waits for the leader to answer a forwarded write
+FORWARD_TIMEOUT = 5.0
+# writes that bind a user to the connection sending them; a retry has to bind the new
+# connection, so these run again instead of being answered from the dedup cache
+SESSION_COMMANDS = {"login", "logout"}
+# default number of client request ids whose replies are kept for answering retries
+DEFAULT_DEDUP_CAPACITY = 1000
+# default milliseconds a draining node waits for peers to acknowledge its last updates
+DEFAULT_DRAIN_TIMEOUT_MS = 5000
+
+# socket stand-in that collects the reply to a request forwarded from another node
+class ReplyCapture:
+    def __init__(self):
+        self.sent = b""
+
+    def send(self, data):
+        self.sent += bytes(data)
+        return len(data)
 
 class FaultTolerantServer(multiprocessing.Process):
     def __init__(self, id, host, port, current_starting_port=60000, 
                  internal_other_servers=["localhost"], internal_other_ports=[60000], 
-                 internal_max_ports=[10]):
+                 internal_max_ports=[10], serialization_workers=2,
+                 serialization_pool="process",
+                 offload_threshold=workers.DEFAULT_OFFLOAD_THRESHOLD,
+                 log_capacity=handle_servers.DEFAULT_LOG_CAPACITY,
+                 peer_queue_bytes=handle_servers.DEFAULT_PEER_QUEUE_BYTES,
+                 batch_window_ms=handle_servers.DEFAULT_BATCH_WINDOW_MS,
+                 batch_max=handle_servers.DEFAULT_BATCH_MAX,
+                 snapshot_chunk_bytes=snapshot_transfer.DEFAULT_CHUNK_BYTES,
+                 write_mode="leader", id_scheme="sequence", node_number=None,
+                 write_concern="local", write_timeout_ms=2000, cluster_size=0,
+                 heartbeat_interval_ms=failure_detector.DEFAULT_HEARTBEAT_INTERVAL_MS,
+                 suspicion_timeout_ms=failure_detector.DEFAULT_SUSPICION_TIMEOUT_MS,
+                 phi_threshold=failure_detector.DEFAULT_PHI_THRESHOLD,
+                 connect_timeout_ms=handle_servers.DEFAULT_CONNECT_TIMEOUT_MS,
+                 max_backoff_ms=handle_servers.DEFAULT_MAX_BACKOFF_MS,
+                 shard_groups=None, shard_group=handle_servers.DEFAULT_SHARD_GROUP,
+                 max_read_lag=DEFAULT_MAX_READ_LAG,
+                 anti_entropy_interval_ms=merkle.DEFAULT_ANTI_ENTROPY_INTERVAL_MS,
+                 dedup_capacity=DEFAULT_DEDUP_CAPACITY,
+                 client_budget=scheduler.DEFAULT_CLIENT_BUDGET,
+                 drain_timeout_ms=DEFAULT_DRAIN_TIMEOUT_MS, replication_factor=0):
         super().__init__()
         # set id, host and port
         self.id = f"{id}{port}"
         self.host = host
         self.port = port
+        # a replication factor places each user on that many nodes instead of all of them:
+        # the cluster_size numbered nodes are split into replica groups of that size and the
+        # groups are sharded as if listed by hand, so a node's group comes from its number
+        if replication_factor < 0:
+            raise ValueError("the replication factor cannot be negative")
+        if replication_factor:
+            if id_scheme != "snowflake":
+                # nodes of different groups accept writes at once, so ids must not depend on a counter
+                raise ValueError("a replication factor needs the snowflake id scheme")
+            if shard_groups:
+                raise ValueError("set either a replication factor or the shard groups, not both")
+            if node_number is None or not 0 <= node_number < cluster_size:
+                raise ValueError("a replication factor needs node numbers below the cluster size")
+            if cluster_size < replication_factor:
+                raise ValueError("the replication factor is larger than the cluster")
+            groups = sharding.replica_groups(cluster_size, replication_factor)
+            shard_groups = [f"r{i}" for i in range(len(groups))]
+            mine = next(i for i, members in enumerate(groups) if node_number in members)
+            shard_group = shard_groups[mine]
+            # acknowledgements come from our group only, so its size sets the majority
+            cluster_size = len(groups[mine])
         # set up the internal communicator arguments
         self.internal_communicator_args = {
             "vm": self,
@@ -25,47 +108,259 @@ class FaultTolerantServer(multiprocessing.Process):
             "max_ports": internal_max_ports,
             "current_host": host,
             "current_port": current_starting_port,
+            "log_capacity": log_capacity,
+            "peer_queue_bytes": peer_queue_bytes,
+            "batch_window_ms": batch_window_ms,
+            "batch_max": batch_max,
+            "snapshot_chunk_bytes": snapshot_chunk_bytes,
+            "cluster_size": cluster_size,
+            "heartbeat_interval_ms": heartbeat_interval_ms,
+            "suspicion_timeout_ms": suspicion_timeout_ms,
+            "phi_threshold": phi_threshold,
+            "connect_timeout_ms": connect_timeout_ms,
+            "max_backoff_ms": max_backoff_ms,
+            "shard_groups": shard_groups,
+            "shard_group": shard_group,
+            "anti_entropy_interval_ms": anti_entropy_interval_ms,
         }
         users, messages, settings = database.fetch_data_stores(self.id)
         self.database = {
             "users": users,
-            "messages": messages,
+            "messages": database.to_mailboxes(messages),
             "settings": settings,
         }
+        self.rebuild_indexes()
+        self.journal_entries = len(database.read_journal(self.id))
         self.sel = None
+        # the encoder pool is created in run() so it lives in the server process
+        self.serialization_workers = serialization_workers
+        self.serialization_pool = serialization_pool
+        self.offload_threshold = offload_threshold
+        self.encoder_pool = None
+        # "leader" sends every write through the elected leader, which assigns ids and
+        # orders the replication log; "local" applies writes on whichever node receives them
+        self.write_mode = write_mode
+        # writes forwarded to the leader and awaiting its reply: request id -> (future, deadline)
+        self.forwarded = {}
+        self.forward_counter = 0
+        # "local" replies as soon as a write is applied here; "one" and "majority" wait
+        # (without blocking other clients) until that many replicas have applied it
+        self.write_concern = write_concern
+        self.write_timeout = write_timeout_ms / 1000
+        # reads are forwarded to the leader once this node trails it by more updates (-1: never)
+        self.max_read_lag = max_read_lag
+        # writes carrying a client request id have their replies kept, oldest evicted first,
+        # in settings["requests"]; the cache is replicated so a retry sent to another node
+        # after a failover is answered from it instead of being applied again
+        self.dedup_capacity = dedup_capacity
+        # (request id, captured replies) of the write being run, attached to its update
+        self.current_request = None
+        # client connections served per loop iteration; the rest wait for the next one, so
+        # replication and heartbeats get a turn even when every client is busy
+        self.client_budget = client_budget
+        self.next_client = 0
+        # a drain (sigterm or the drain admin command) stops accepting clients, finishes the
+        # requests in flight, hands off to the peers and exits, leaving stores the node can
+        # restart from without a snapshot
+        self.drain_timeout = drain_timeout_ms / 1000
+        self.draining = False
+        self.lsock = None
+        self.wakeup_recv = None
+        self.wakeup_send = None
+        # "sequence" numbers messages from the shared settings counter, which is only safe when
+        # one node accepts writes; "snowflake" lets every node mint unique time-ordered ids
+        if id_scheme == "snowflake":
+            if node_number is None:
+                # a number derived from the address could silently match another node's
+                raise ValueError("the snowflake id scheme needs an explicit node number")
+            self.id_generator = message_ids.MessageIdGenerator(node_number)
+        elif id_scheme == "sequence":
+            if shard_groups:
+                # each group would count on its own, so ids could clash where groups share messages
+                raise ValueError("sharded deployments need the snowflake id scheme")
+            self.id_generator = None
+        else:
+            raise ValueError(f"unknown id scheme: {id_scheme}")
 
     # extract json from data and return command, command data, data and data length
+    # replicated updates arrive already decoded and are used as they are, without another
+    # round of json encoding and parsing
     def extract_json(self, sock: socket.socket, data, internal_change=False):
         if internal_change:
-            decoded_data = json.dumps(data)
+            json_data = data
+            data_length = 0
         else:
             decoded_data = data.outb.decode("utf-8").split("\0")[0]
-        json_data = json.loads(decoded_data)
+            json_data = json.loads(decoded_data)
+            data_length = len(decoded_data) + len("\0")
         version = json_data["version"]
         command = json_data["command"]
         command_data = json_data["data"]
-        data_length = len(decoded_data) + len("\0")
         if version != 0:
             self.emit_err(sock, data_length, data, "unsupported protocol version")
         return command, command_data, data, data_length
 
     # send a message back to the client with a json payload
+    # large payloads are encoded on the worker pool and sent once the encoding finishes
     def emit_msg(self, sock: socket.socket, data_length: int, command, data, message):
         data_obj = {"version": 0, "command": command, "data": message}
-        sock.send(json.dumps(data_obj).encode("utf-8"))
+        self.capture_reply(data, data_obj)
+        if workers.should_offload(self.encoder_pool, message, self.offload_threshold):
+            data.replies.append(self.encoder_pool.submit(workers.encode_frame, data_obj))
+        else:
+            data.replies.append(workers.encode_frame(data_obj))
+        self.flush_replies(sock, data)
         data.outb = data.outb[data_length:]
 
     # send an error message back to the client in json format
     def emit_err(self, sock: socket.socket, data_length: int, data, error_message: str):
         error_obj = {"version": 0, "command": "error", "data": {"error": error_message}}
-        sock.send(json.dumps(error_obj).encode("utf-8"))
+        self.capture_reply(data, error_obj)
+        data.replies.append(workers.encode_frame(error_obj))
+        self.flush_replies(sock, data)
+        data.outb = data.outb[data_length:]
+
+    # keep a copy of a reply while a request with an idempotency key is running
+    def capture_reply(self, data, reply_obj):
+        captured = getattr(data, "captured", None)
+        if captured is not None:
+            captured.append(reply_obj)
+
+    # the replies cached for a client request id, or None when it has not been seen
+    def cached_replies(self, request_id):
+        if request_id is None:
+            return None
+        return self.database["settings"].get("requests", {}).get(request_id)
+
+    # remember the replies to a write so a retry with the same id gets them again; this is
+    # called before the write runs, so the persist that stores the write stores the entry too
+    def remember_request(self, request_id, replies):
+        cache = self.database["settings"].setdefault("requests", {})
+        cache[request_id] = replies
+        while len(cache) > self.dedup_capacity:
+            del cache[next(iter(cache))]
+
+    # send an applied write to the replicas; a write made under a client request id carries
+    # the id and its replies, so every replica stores the entry together with the write
+    def replicate(self, update, groups=None):
+        if self.current_request is not None:
+            request_id, replies = self.current_request
+            update["request"] = {"request_id": request_id, "replies": list(replies)}
+        self.internal_communicator.broadcast_update(update, groups)
+
+    # answer a retried write from the cache without running it again
+    def replay_replies(self, sock, data, replies, data_length):
+        token = self.internal_communicator.session_token()
+        for reply_obj in replies:
+            data.replies.append(self.stamp_reply(workers.encode_frame(reply_obj), token))
         data.outb = data.outb[data_length:]
+        self.flush_replies(sock, data)
+
+    # write queued replies in order, stopping at the first one still being encoded
+    def flush_replies(self, sock: socket.socket, data):
+        while data.replies:
+            reply = data.replies[0]
+            if isinstance(reply, concurrent.futures.Future):
+                if not reply.done():
+                    return
+                reply = reply.result()
+                if isinstance(reply, list):
+                    # a released write concern gate hands back the replies it was holding
+                    data.replies.popleft()
+                    data.replies.extendleft(reversed(reply))
+                    continue
+            try:
+                sent = sock.send(reply)
+            except BlockingIOError:
+                sent = 0
+            if sent < len(reply):
+                # keep the unsent tail at the head of the queue for the next write event
+                data.replies[0] = reply[sent:]
+                return
+            data.replies.popleft()
+
+    # write the stores to disk, flattening the in-memory mailboxes back into lists
+    def persist(self):
+        database.persist_data_stores(self.id,
+                                     self.database["users"],
+                                     database.to_message_lists(self.database["messages"]),
+                                     self.database["settings"])
+        self.journal_entries = 0
+
+    # rebuild the message indexes after the message store is replaced wholesale
+    def rebuild_indexes(self):
+        self.index = message_index.MessageIndex.from_messages(self.database["messages"])
+        # the anti-entropy tree hashes every user record and every receiver's mailbox
+        self.merkle = merkle.MerkleTree(self.merkle_item)
+        for username in self.database["users"]:
+            self.touch_user(username)
+        for receiver in self.index.by_receiver_time:
+            self.touch_mailbox(receiver)
+
+    # note a changed user record or mailbox so its hash is recomputed
+    def touch_user(self, username):
+        self.merkle.mark_dirty(f"user:{username}")
+
+    def touch_mailbox(self, receiver):
+        self.merkle.mark_dirty(f"mail:{receiver}")
+
+    # a receiver's messages split by box, in id order, as compared and repaired by anti-entropy
+    def mailbox_of(self, receiver):
+        mailbox = {"delivered": [], "undelivered": []}
+        for m in sorted(self.index.received(receiver), key=lambda m: m["id"]):
+            box = "delivered" if m["id"] in self.database["messages"]["delivered"] else "undelivered"
+            mailbox[box].append(m)
+        return mailbox
+
+    # current value of an anti-entropy key, or None when it does not exist
+    def merkle_value(self, key):
+        kind, name = key.split(":", 1)
+        if kind == "user":
+            return self.database["users"].get(name)
+        if name not in self.index.by_receiver_time:
+            return None
+        return self.mailbox_of(name)
+
+    def merkle_item(self, key):
+        value = self.merkle_value(key)
+        return None if value is None else merkle.digest(value)
+
+    # overwrite the keys anti-entropy found out of step with the leader by the leader's values
+    def apply_repair(self, items):
+        messages = self.database["messages"]
+        for key, value in items.items():
+            kind, name = key.split(":", 1)
+            if kind == "user":
+                if value is None:
+                    self.database["users"].pop(name, None)
+                else:
+                    self.database["users"][name] = value
+                self.touch_user(name)
+                continue
+            for m in self.index.received(name):
+                self.index.remove(m)
+                messages["delivered"].pop(m["id"], None)
+                messages["undelivered"].pop(m["id"], None)
+            for box, msgs in (value or {}).items():
+                for m in msgs:
+                    # a message may have been filed under another receiver's key here
+                    stale = self.index.by_id.get(m["id"])
+                    if stale is not None:
+                        self.index.remove(stale)
+                        messages["delivered"].pop(m["id"], None)
+                        messages["undelivered"].pop(m["id"], None)
+                        self.touch_mailbox(stale["receiver"])
+                    messages[box][m["id"]] = m
+                    self.index.add(m)
+            self.touch_mailbox(name)
+        self.persist()
 
     # count the number of pending (undelivered) messages for a given username
     def count_pending(self, username: str):
+        pending = self.database["messages"]["undelivered"]
         count = 0
-        for msg_obj in self.database["messages"]["undelivered"]:
-            if msg_obj["receiver"] == username:
+        for msg_obj in self.index.received(username):
+            if msg_obj["id"] in pending:
                 count += 1
         return count
 
@@ -77,10 +372,8 @@ class FaultTolerantServer(multiprocessing.Process):
         if internal_change:
             addr = cmd_data.get("addr")
             self.database["users"][username] = {"password": password, "logged_in": True, "addr": addr}
-            database.persist_data_stores(self.id,
-                                         self.database["users"],
-                                         self.database["messages"],
-                                         self.database["settings"])
+            self.touch_user(username)
+            self.persist()
             return
         if not username.isalnum():
             self.emit_err(sock, data_length, data, "username must be alphanumeric")
@@ -99,11 +392,9 @@ class FaultTolerantServer(multiprocessing.Process):
         }
         ret = {"username": username, "undeliv_messages": 0}
         self.emit_msg(sock, data_length, "login", data, ret)
-        database.persist_data_stores(self.id,
-                                     self.database["users"],
-                                     self.database["messages"],
-                                     self.database["settings"])
-        self.internal_communicator.broadcast_update({
+        self.touch_user(username)
+        self.persist()
+        self.replicate({
             "command": "create",
             "data": {
                 "username": username,
@@ -121,15 +412,15 @@ class FaultTolerantServer(multiprocessing.Process):
             addr = cmd_data.get("addr")
             self.database["users"][username]["logged_in"] = True
             self.database["users"][username]["addr"] = addr
-            database.persist_data_stores(self.id,
-                                         self.database["users"],
-                                         self.database["messages"],
-                                         self.database["settings"])
+            self.touch_user(username)
+            self.persist()
             return
         if username not in self.database["users"]:
             self.emit_err(sock, data_length, data, "username does not exist")
             return
-        if self.database["users"][username]["logged_in"]:
+        # a retried login that already succeeded moves the session to this connection
+        retry = self.cached_replies(cmd_data.get("request_id")) is not None
+        if self.database["users"][username]["logged_in"] and not retry:
             self.emit_err(sock, data_length, data, "user already logged in")
             return
         if password != self.database["users"][username]["password"]:
@@ -140,11 +431,9 @@ class FaultTolerantServer(multiprocessing.Process):
         self.database["users"][username]["addr"] = f"{data.addr[0]}:{data.addr[1]}"
         ret = {"username": username, "undeliv_messages": pending}
         self.emit_msg(sock, data_length, "login", data, ret)
-        database.persist_data_stores(self.id,
-                                     self.database["users"],
-                                     self.database["messages"],
-                                     self.database["settings"])
-        self.internal_communicator.broadcast_update({
+        self.touch_user(username)
+        self.persist()
+        self.replicate({
             "command": "login",
             "data": {
                 "username": username,
@@ -160,10 +449,8 @@ class FaultTolerantServer(multiprocessing.Process):
         if internal_change:
             self.database["users"][username]["logged_in"] = False
             self.database["users"][username]["addr"] = None
-            database.persist_data_stores(self.id,
-                                         self.database["users"],
-                                         self.database["messages"],
-                                         self.database["settings"])
+            self.touch_user(username)
+            self.persist()
             return
         if username not in self.database["users"]:
             self.emit_err(sock, data_length, data, "username does not exist")
@@ -171,11 +458,9 @@ class FaultTolerantServer(multiprocessing.Process):
         self.database["users"][username]["logged_in"] = False
         self.database["users"][username]["addr"] = None
         self.emit_msg(sock, data_length, "logout", data, {})
-        database.persist_data_stores(self.id,
-                                     self.database["users"],
-                                     self.database["messages"],
-                                     self.database["settings"])
-        self.internal_communicator.broadcast_update({
+        self.touch_user(username)
+        self.persist()
+        self.replicate({
             "command": "logout",
             "data": {"username": username}
         })
@@ -188,6 +473,14 @@ class FaultTolerantServer(multiprocessing.Process):
         ret = {"user_list": matched}
         self.emit_msg(sock, data_length, "user_list", data, ret)
 
+    # remove every message sent or received by acct, touching only that account's messages
+    def drop_account_msgs(self, acct):
+        for m in self.index.involving(acct):
+            self.index.remove(m)
+            self.touch_mailbox(m["receiver"])
+            self.database["messages"]["delivered"].pop(m["id"], None)
+            self.database["messages"]["undelivered"].pop(m["id"], None)
+
     # remove a user account and its messages
     def remove_account(self, sock: socket.socket, unparsed_data, internal_change=False):
         _, cmd_data, data, data_length = self.extract_json(sock, unparsed_data, internal_change)
@@ -195,29 +488,19 @@ class FaultTolerantServer(multiprocessing.Process):
         if internal_change:
             if acct in self.database["users"]:
                 del self.database["users"][acct]
-                def rm_msgs(lst, acc):
-                    lst[:] = [m for m in lst if m["sender"] != acc and m["receiver"] != acc]
-                rm_msgs(self.database["messages"]["delivered"], acct)
-                rm_msgs(self.database["messages"]["undelivered"], acct)
-                database.persist_data_stores(self.id,
-                                             self.database["users"],
-                                             self.database["messages"],
-                                             self.database["settings"])
+                self.drop_account_msgs(acct)
+                self.touch_user(acct)
+                self.persist()
             return
         if acct not in self.database["users"]:
             self.emit_err(sock, data_length, data, "account does not exist")
             return
         del self.database["users"][acct]
-        def rm_msgs(lst, acc):
-            lst[:] = [m for m in lst if m["sender"] != acc and m["receiver"] != acc]
-        rm_msgs(self.database["messages"]["delivered"], acct)
-        rm_msgs(self.database["messages"]["undelivered"], acct)
+        self.drop_account_msgs(acct)
         self.emit_msg(sock, data_length, "logout", data, {})
-        database.persist_data_stores(self.id,
-                                     self.database["users"],
-                                     self.database["messages"],
-                                     self.database["settings"])
-        self.internal_communicator.broadcast_update({
+        self.touch_user(acct)
+        self.persist()
+        self.replicate({
             "command": "delete_acct",
             "data": {"username": acct}
         })
@@ -229,76 +512,100 @@ class FaultTolerantServer(multiprocessing.Process):
         receiver = cmd_data["recipient"]
         message = cmd_data["message"]
         if internal_change:
-            self.database["settings"]["counter"] += 1
-            msg_obj = {"id": self.database["settings"]["counter"],
-                       "sender": sender, "receiver": receiver, "message": message}
-            if self.database["users"][receiver]["logged_in"]:
-                self.database["messages"]["delivered"].append(msg_obj)
+            # use the id chosen by the node that accepted the message so every replica agrees
+            msg_id = cmd_data.get("id")
+            if msg_id in self.index.by_id:
+                # already here, copied over by an anti-entropy repair before the update arrived;
+                # the update's dedup entry still has to reach disk
+                self.persist()
+                return
+            if msg_id is None:
+                self.database["settings"]["counter"] += 1
+                msg_id = self.database["settings"]["counter"]
             else:
-                self.database["messages"]["undelivered"].append(msg_obj)
-            database.persist_data_stores(self.id,
-                                         self.database["users"],
-                                         self.database["messages"],
-                                         self.database["settings"])
+                self.database["settings"]["counter"] = max(self.database["settings"]["counter"], msg_id)
+            msg_obj = {"id": msg_id,
+                       "sender": sender, "receiver": receiver, "message": message,
+                       "timestamp": cmd_data.get("timestamp", time.time())}
+            box = "delivered" if self.database["users"][receiver]["logged_in"] else "undelivered"
+            self.database["messages"][box][msg_obj["id"]] = msg_obj
+            self.index.add(msg_obj)
+            self.touch_mailbox(receiver)
+            self.persist()
             return
         if receiver not in self.database["users"]:
             self.emit_err(sock, data_length, data, "receiver does not exist")
             return
-        self.database["settings"]["counter"] += 1
-        msg_obj = {"id": self.database["settings"]["counter"],
-                   "sender": sender, "receiver": receiver, "message": message}
-        if self.database["users"][receiver]["logged_in"]:
-            self.database["messages"]["delivered"].append(msg_obj)
-        else:
-            self.database["messages"]["undelivered"].append(msg_obj)
+        # the timestamp is assigned here and replicated so every node agrees on it
+        msg_obj = {"id": self.next_message_id(),
+                   "sender": sender, "receiver": receiver, "message": message,
+                   "timestamp": time.time()}
+        box = "delivered" if self.database["users"][receiver]["logged_in"] else "undelivered"
+        self.database["messages"][box][msg_obj["id"]] = msg_obj
+        self.index.add(msg_obj)
+        self.touch_mailbox(receiver)
         pending = self.count_pending(sender)
         ret = {"undeliv_messages": pending}
         self.emit_msg(sock, data_length, "refresh_home", data, ret)
-        database.persist_data_stores(self.id,
-                                     self.database["users"],
-                                     self.database["messages"],
-                                     self.database["settings"])
-        self.internal_communicator.broadcast_update({
+        self.persist()
+        self.replicate({
             "command": "send_msg",
-            "data": {"sender": sender, "recipient": receiver, "message": message}
-        })
+            "data": {"sender": sender, "recipient": receiver, "message": message,
+                     "timestamp": msg_obj["timestamp"], "id": msg_obj["id"]}
+        }, self.groups_for([sender, receiver]))
+
+    # replica groups storing messages that involve the given users, or None when users are
+    # not sharded (every node stores everything)
+    def groups_for(self, usernames):
+        owners = {self.internal_communicator.owner_group(name) for name in usernames}
+        return None if None in owners else owners
+
+    # id for a message accepted on this node
+    def next_message_id(self):
+        if self.id_generator is not None:
+            return self.id_generator.next_id()
+        self.database["settings"]["counter"] += 1
+        return self.database["settings"]["counter"]
 
     # fetch undelivered messages for a user and move them to delivered
-    def fetch_pending_msgs(self, sock: socket.socket, unparsed_data):
-        _, cmd_data, data, data_length = self.extract_json(sock, unparsed_data)
+    def fetch_pending_msgs(self, sock: socket.socket, unparsed_data, internal_change=False):
+        _, cmd_data, data, data_length = self.extract_json(sock, unparsed_data, internal_change)
         receiver = cmd_data["username"]
         num_to_view = cmd_data["num_messages"]
         delivered = self.database["messages"]["delivered"]
         pending_list = self.database["messages"]["undelivered"]
+        if internal_change:
+            # replicas move exactly the messages the originating node delivered
+            for msg_id in cmd_data.get("ids", []):
+                if msg_id in pending_list:
+                    delivered[msg_id] = pending_list.pop(msg_id)
+            self.touch_mailbox(receiver)
+            self.persist()
+            return
         to_send = []
-        remove_indices = []
         if len(pending_list) == 0 and num_to_view > 0:
             self.emit_err(sock, data_length, data, "no undelivered messages")
             return
-        for idx, msg_obj in enumerate(pending_list):
+        for msg_obj in self.index.received(receiver):
             if num_to_view == 0:
                 break
-            if msg_obj["receiver"] == receiver:
+            if msg_obj["id"] in pending_list:
                 to_send.append({
                     "id": msg_obj["id"],
                     "sender": msg_obj["sender"],
                     "message": msg_obj["message"]
                 })
-                delivered.append(msg_obj)
-                remove_indices.append(idx)
+                delivered[msg_obj["id"]] = pending_list.pop(msg_obj["id"])
                 num_to_view -= 1
-        for idx in sorted(remove_indices, reverse=True):
-            del pending_list[idx]
         ret = {"messages": to_send}
         self.emit_msg(sock, data_length, "messages", data, ret)
-        database.persist_data_stores(self.id,
-                                     self.database["users"],
-                                     self.database["messages"],
-                                     self.database["settings"])
-        self.internal_communicator.broadcast_update({
+        self.touch_mailbox(receiver)
+        self.persist()
+        self.replicate({
             "command": "get_undelivered",
-            "data": {"username": receiver, "num_messages": num_to_view}
-        })
+            "data": {"username": receiver, "num_messages": len(to_send),
+                     "ids": [msg["id"] for msg in to_send]}
+        }, self.groups_for([receiver] + [msg["sender"] for msg in to_send]))
 
     # fetch delivered messages for a user
     def fetch_seen_msgs(self, sock: socket.socket, unparsed_data):
@@ -310,10 +617,10 @@ class FaultTolerantServer(multiprocessing.Process):
             self.emit_err(sock, data_length, data, "no delivered messages")
             return
         to_send = []
-        for msg_obj in delivered:
+        for msg_obj in self.index.received(receiver):
             if num_to_view == 0:
                 break
-            if msg_obj["receiver"] == receiver:
+            if msg_obj["id"] in delivered:
                 to_send.append({
                     "id": msg_obj["id"],
                     "sender": msg_obj["sender"],
@@ -323,6 +630,30 @@ class FaultTolerantServer(multiprocessing.Process):
         ret = {"messages": to_send}
         self.emit_msg(sock, data_length, "messages", data, ret)
 
+    # admin commands are only taken from clients on this machine
+    def local_client(self, data):
+        return data.addr[0] in ("127.0.0.1", "::1", "localhost")
+
+    # replication metrics for this node
+    def report_stats(self, sock: socket.socket, unparsed_data):
+        _, _, data, data_length = self.extract_json(sock, unparsed_data)
+        if not self.local_client(data):
+            self.emit_err(sock, data_length, data, "stats are only available to local clients")
+            return
+        ret = self.internal_communicator.metrics()
+        ret["forwarded_pending"] = len(self.forwarded)
+        ret["journal_entries"] = self.journal_entries
+        self.emit_msg(sock, data_length, "stats", data, ret)
+
+    # drain this node ahead of a restart
+    def drain_command(self, sock: socket.socket, unparsed_data):
+        _, _, data, data_length = self.extract_json(sock, unparsed_data)
+        if not self.local_client(data):
+            self.emit_err(sock, data_length, data, "drain is only available to local clients")
+            return
+        self.emit_msg(sock, data_length, "draining", data, {})
+        self.request_drain()
+
     # update home with new undelivered message count
     def update_home(self, sock: socket.socket, unparsed_data):
         _, cmd_data, data, data_length = self.extract_json(sock, unparsed_data)
@@ -331,45 +662,163 @@ class FaultTolerantServer(multiprocessing.Process):
         ret = {"undeliv_messages": pending}
         self.emit_msg(sock, data_length, "refresh_home", data, ret)
 
+    # parse delete_ids (an int list or the legacy comma-joined string, which may hold a-b
+    # ranges) and delete_ranges ([[low, high], ...], inclusive) into ids and ranges
+    # raises ValueError or TypeError for anything else, before a single message is touched
+    def parse_delete_ids(self, cmd_data):
+        ids = set()
+        ranges = []
+        for bounds in cmd_data.get("delete_ranges", []):
+            if (not isinstance(bounds, list) or len(bounds) != 2
+                    or not all(isinstance(b, int) and not isinstance(b, bool) for b in bounds)):
+                raise ValueError(f"delete range {bounds!r} is not a pair of ids")
+            ranges.append(tuple(bounds))
+        raw_ids = cmd_data.get("delete_ids", [])
+        if isinstance(raw_ids, str):
+            raw_ids = [token.strip() for token in raw_ids.split(",") if token.strip()]
+        for token in raw_ids:
+            if isinstance(token, str) and "-" in token.strip("-"):
+                low, high = token.split("-", 1)
+                ranges.append((int(low), int(high)))
+            else:
+                ids.add(int(token))
+        return ids, ranges
+
+    # remove the current user's delivered messages with the given ids or in the given ranges
+    # returns the ids actually removed; cost follows the number of ids, not the store size
+    def drop_delivered(self, current_user, ids_to_rm, ranges=()):
+        delivered = self.database["messages"]["delivered"]
+        candidates = set(ids_to_rm)
+        mailbox = self.index.received(current_user) if ranges else []
+        for low, high in ranges:
+            if high - low + 1 <= len(mailbox):
+                candidates.update(range(low, high + 1))
+            else:
+                # a range wider than the user's mailbox is cheaper to test message by message
+                candidates.update(m["id"] for m in mailbox if low <= m["id"] <= high)
+        removed = []
+        for msg_id in candidates:
+            m = delivered.get(msg_id)
+            if m is not None and m["receiver"] == current_user:
+                self.index.remove(m)
+                self.touch_mailbox(m["receiver"])
+                del delivered[msg_id]
+                removed.append(msg_id)
+        return sorted(removed)
+
+    # record deleted ids in the journal, rewriting the stores only once it grows large
+    def persist_deletion(self, removed):
+        if not removed:
+            return
+        self.journal_entries += 1
+        if self.journal_entries >= database.JOURNAL_COMPACT_ENTRIES:
+            self.persist()
+            return
+        database.append_journal(self.id, {"command": "delete_msg", "ids": removed})
+
+    # fetch messages received since a time or message id so clients can sync incrementally
+    def fetch_msgs_since(self, sock: socket.socket, unparsed_data):
+        _, cmd_data, data, data_length = self.extract_json(sock, unparsed_data)
+        username = cmd_data["username"]
+        limit = cmd_data.get("num_messages")
+        since_id = cmd_data.get("since_id")
+        since_time = cmd_data.get("since_time")
+        if username not in self.database["users"]:
+            self.emit_err(sock, data_length, data, "username does not exist")
+            return
+        # the bounds are compared against stored ids and timestamps, which a string or a
+        # list would make raise inside the client loop
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 1):
+            self.emit_err(sock, data_length, data, "num_messages must be a positive integer")
+            return
+        if since_id is not None and (not isinstance(since_id, int) or isinstance(since_id, bool)):
+            self.emit_err(sock, data_length, data, "since_id must be a message id")
+            return
+        if since_time is not None and (not isinstance(since_time, (int, float)) or isinstance(since_time, bool)):
+            self.emit_err(sock, data_length, data, "since_time must be a number")
+            return
+        if since_id is not None:
+            found = self.index.received_since_id(username, since_id, limit)
+        elif since_time is not None:
+            found = self.index.received_since_time(username, since_time, limit)
+        else:
+            self.emit_err(sock, data_length, data, "since_time or since_id is required")
+            return
+        to_send = [{
+            "id": msg_obj["id"],
+            "sender": msg_obj["sender"],
+            "message": msg_obj["message"],
+            "timestamp": msg_obj.get("timestamp", 0)
+        } for msg_obj in found]
+        ret = {"messages": to_send}
+        self.emit_msg(sock, data_length, "messages", data, ret)
+
+    # fetch one page of the conversation between two users, newest page first
+    def fetch_conversation(self, sock: socket.socket, unparsed_data):
+        _, cmd_data, data, data_length = self.extract_json(sock, unparsed_data)
+        username = cmd_data["username"]
+        other_user = cmd_data["other_user"]
+        page_size = cmd_data.get("num_messages", 50)
+        if not isinstance(page_size, int) or isinstance(page_size, bool) or page_size < 1:
+            self.emit_err(sock, data_length, data, "num_messages must be a positive integer")
+            return
+        before_id = cmd_data.get("before_id")
+        if before_id is not None and (not isinstance(before_id, int) or isinstance(before_id, bool)):
+            self.emit_err(sock, data_length, data, "before_id must be a message id")
+            return
+        if other_user not in self.database["users"]:
+            self.emit_err(sock, data_length, data, "other user does not exist")
+            return
+        page, next_before_id = self.index.conversation_page(
+            username, other_user, page_size, before_id)
+        to_send = [{
+            "id": msg_obj["id"],
+            "sender": msg_obj["sender"],
+            "receiver": msg_obj["receiver"],
+            "message": msg_obj["message"],
+            "timestamp": msg_obj.get("timestamp", 0)
+        } for msg_obj in page]
+        ret = {"messages": to_send, "next_before_id": next_before_id}
+        self.emit_msg(sock, data_length, "messages", data, ret)
+
     # remove messages given by delete ids
     def remove_msgs(self, sock: socket.socket, unparsed_data, internal_change=False):
         _, cmd_data, data, data_length = self.extract_json(sock, unparsed_data, internal_change)
         current_user = cmd_data["current_user"]
-        ids_to_rm = set(cmd_data["delete_ids"].split(","))
         if internal_change:
-            self.database["messages"]["delivered"] = [
-                m for m in self.database["messages"]["delivered"]
-                if not (str(m["id"]) in ids_to_rm and m["receiver"] == current_user)
-            ]
-            database.persist_data_stores(self.id,
-                                         self.database["users"],
-                                         self.database["messages"],
-                                         self.database["settings"])
-            return
-        self.database["messages"]["delivered"] = [
-            m for m in self.database["messages"]["delivered"]
-            if not (str(m["id"]) in ids_to_rm and m["receiver"] == current_user)
-        ]
+            ids_to_rm, ranges = self.parse_delete_ids(cmd_data)
+            removed = self.drop_delivered(current_user, ids_to_rm, ranges)
+            self.persist_deletion(removed)
+            return
+        try:
+            ids_to_rm, ranges = self.parse_delete_ids(cmd_data)
+        except (TypeError, ValueError):
+            self.emit_err(sock, data_length, data, "delete ids must be integers or ranges")
+            return
+        # with sharding, the senders' groups hold copies of these messages too
+        senders = set()
+        if self.internal_communicator.owner_group(current_user) is not None:
+            senders = {m["sender"] for m in self.index.received(current_user)}
+        removed = self.drop_delivered(current_user, ids_to_rm, ranges)
         pending = self.count_pending(current_user)
         ret = {"undeliv_messages": pending}
         self.emit_msg(sock, data_length, "refresh_home", data, ret)
-        database.persist_data_stores(self.id,
-                                     self.database["users"],
-                                     self.database["messages"],
-                                     self.database["settings"])
-        self.internal_communicator.broadcast_update({
+        self.persist_deletion(removed)
+        if not removed:
+            return
+        # replicas receive the resolved ids so they never expand ranges themselves
+        self.replicate({
             "command": "delete_msg",
-            "data": {"current_user": current_user, "delete_ids": ",".join(list(ids_to_rm))}
-        })
+            "data": {"current_user": current_user, "delete_ids": removed}
+        }, self.groups_for([current_user] + sorted(senders)))
 
     # accept a new connection and register it with the selector
     def accept_conn(self, sock):
         conn, addr = sock.accept()
         print(f"accepted connection from {addr}")
         conn.setblocking(False)
-        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        self.sel.register(conn, events, data=data)
+        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"", replies=collections.deque())
+        self.sel.register(conn, selectors.EVENT_READ, data=data)
 
     # serve existing connection events
     def handle_conn(self, key, mask):
@@ -388,52 +837,296 @@ class FaultTolerantServer(multiprocessing.Process):
                 sock.close()
                 for user in self.database["users"]:
                     if self.database["users"][user]["addr"] == f"{data.addr[0]}:{data.addr[1]}":
+                        if self.forwards_writes():
+                            # the leader owns writes, so it performs the logout for us
+                            frame = json.dumps({"version": 0, "command": "logout", "data": {"username": user}})
+                            self.forward_client_request(None, frame, data.addr)
+                            break
                         self.database["users"][user]["logged_in"] = False
                         self.database["users"][user]["addr"] = None
-                        self.internal_communicator.broadcast_update({
+                        self.touch_user(user)
+                        self.replicate({
                             "command": "logout",
                             "data": {"username": user}
                         })
                         break
-                database.persist_data_stores(self.id,
-                                             self.database["users"],
-                                             self.database["messages"],
-                                             self.database["settings"])
+                self.persist()
         if mask & selectors.EVENT_WRITE:
+            if data.replies:
+                self.flush_replies(sock, data)
             if data.outb:
-                received_data = data.outb.decode("utf-8")
-                command, _, _, data_length = self.extract_json(sock, data)
-                if command == "create":
-                    self.register_user(sock, data)
-                elif command == "login":
-                    self.user_login(sock, data)
-                elif command == "logout":
-                    self.user_logout(sock, data)
-                elif command == "search":
-                    self.find_users(sock, data)
-                elif command == "delete_acct":
-                    self.remove_account(sock, data)
-                elif command == "send_msg":
-                    self.process_msg(sock, data)
-                elif command == "get_undelivered":
-                    self.fetch_pending_msgs(sock, data)
-                elif command == "get_delivered":
-                    self.fetch_seen_msgs(sock, data)
-                elif command == "refresh_home":
-                    self.update_home(sock, data)
-                elif command == "delete_msg":
-                    self.remove_msgs(sock, data)
-                elif command == "check_connection":
-                    data.outb = data.outb[data_length:]
-                else:
-                    print(f"no valid command: {received_data}")
-                    data.outb = data.outb[len(received_data):]
+                self.dispatch_request(sock, data)
+
+    # handle the first framed request buffered for a connection
+    def dispatch_request(self, sock, data, allow_forward=True):
+        received_data = data.outb.decode("utf-8")
+        command, cmd_data, _, data_length = self.extract_json(sock, data)
+        frame = received_data.split("\0")[0]
+        if command in WRITE_COMMANDS:
+            cached = None if command in SESSION_COMMANDS else self.cached_replies(cmd_data.get("request_id"))
+            if cached is not None:
+                # a retry of a write that was already applied
+                self.replay_replies(sock, data, cached, data_length)
+                return
+        if command in MAILBOX_COMMANDS and allow_forward:
+            group = self.internal_communicator.owner_group(cmd_data.get(MAILBOX_COMMANDS[command], ""))
+            if group is not None and group != self.internal_communicator.group:
+                # the user's mailbox lives in another replica group
+                self.forward_or_fail(sock, data, frame, data_length, group)
+                return
+        if command in WRITE_COMMANDS:
+            if allow_forward and self.forwards_writes():
+                self.forward_or_fail(sock, data, frame, data_length)
+                return
+            self.run_write(sock, data, command, received_data, data_length, cmd_data.get("request_id"))
+            return
+        if command in READ_COMMANDS and allow_forward and not self.serves_read(cmd_data):
+            # too stale for this client, so the leader answers; if it cannot be reached
+            # a possibly stale answer beats none
+            if self.forward_client_request(data, frame, data.addr):
+                data.outb = data.outb[data_length:]
+                return
+        self.run_command(sock, data, command, received_data, data_length)
+
+    # run one client command against the local stores
+    def run_command(self, sock, data, command, received_data, data_length):
+        if command == "create":
+            self.register_user(sock, data)
+        elif command == "login":
+            self.user_login(sock, data)
+        elif command == "logout":
+            self.user_logout(sock, data)
+        elif command == "search":
+            self.find_users(sock, data)
+        elif command == "delete_acct":
+            self.remove_account(sock, data)
+        elif command == "send_msg":
+            self.process_msg(sock, data)
+        elif command == "get_undelivered":
+            self.fetch_pending_msgs(sock, data)
+        elif command == "get_delivered":
+            self.fetch_seen_msgs(sock, data)
+        elif command == "refresh_home":
+            self.update_home(sock, data)
+        elif command == "delete_msg":
+            self.remove_msgs(sock, data)
+        elif command == "get_messages_since":
+            self.fetch_msgs_since(sock, data)
+        elif command == "get_conversation":
+            self.fetch_conversation(sock, data)
+        elif command == "stats":
+            self.report_stats(sock, data)
+        elif command == "drain":
+            self.drain_command(sock, data)
+        elif command == "check_connection":
+            data.outb = data.outb[data_length:]
+        else:
+            print(f"no valid command: {received_data}")
+            data.outb = data.outb[len(received_data):]
+
+    # run a write whose replies are held back until enough replicas have applied it
+    # other requests keep flowing; only this connection's later replies queue behind the gate
+    def run_write(self, sock, data, command, received_data, data_length, request_id=None):
+        gate = concurrent.futures.Future()
+        data.replies.append(gate)
+        before = self.internal_communicator.last_index()
+        if request_id is not None:
+            # the handler's replies fill the cached list before it persists its write
+            data.captured = []
+            self.remember_request(request_id, data.captured)
+            self.current_request = (request_id, data.captured)
+        try:
+            self.run_command(sock, data, command, received_data, data_length)
+        finally:
+            self.current_request = None
+        applied = self.internal_communicator.last_index()
+        if request_id is not None and applied == before:
+            # rejected requests changed nothing, so retrying them is already safe
+            self.database["settings"]["requests"].pop(request_id, None)
+        data.captured = None
+        held = []
+        while data.replies[-1] is not gate:
+            held.insert(0, data.replies.pop())
+        token = self.internal_communicator.session_token()
+        held = [self.stamp_reply(reply, token) for reply in held]
+        index = self.internal_communicator.last_index()
+        if applied == before or self.write_concern == "local":
+            # nothing was replicated (the request was rejected), or nobody needs to confirm it
+            gate.set_result(held)
+        else:
+            needed = self.internal_communicator.acks_needed(self.write_concern)
+            error = workers.encode_frame({"version": 0, "command": "error", "data": {
+                "error": f"write applied but not acknowledged by {needed} replica(s) in time"}})
+            acked = self.internal_communicator.wait_for_acks(index, needed, self.write_timeout)
+            acked.add_done_callback(lambda done: gate.set_result(held if done.result() else [error]))
+        self.flush_replies(sock, data)
+
+    # add the session token to an encoded reply frame, which always ends with its closing brace
+    def stamp_reply(self, reply, token):
+        suffix = (', "session": ' + json.dumps(token) + "}").encode("utf-8")
+        if isinstance(reply, concurrent.futures.Future):
+            stamped = concurrent.futures.Future()
+            reply.add_done_callback(lambda done: stamped.set_result(done.result()[:-1] + suffix))
+            return stamped
+        return reply[:-1] + suffix
+
+    # whether this node may answer a read itself: it leads, or it trails the leader by at
+    # most max_read_lag updates and has applied every write in the client's session token
+    def serves_read(self, cmd_data):
+        coordinator = self.internal_communicator
+        if coordinator.is_leader():
+            return True
+        if self.max_read_lag >= 0 and coordinator.read_lag() > self.max_read_lag:
+            return False
+        return coordinator.has_applied(cmd_data.get("session") or {})
+
+    # whether client writes must go through another node acting as leader
+    def forwards_writes(self):
+        return self.write_mode == "leader" and not self.internal_communicator.is_leader()
+
+    # hand a client request to the leader of a group (our own by default), reserving its
+    # place in the client's reply order; returns False when that leader is unreachable
+    # several requests may be in flight at once; replies are matched back by request id
+    def forward_client_request(self, data, frame, addr, group=None):
+        self.forward_counter += 1
+        request_id = self.forward_counter
+        placeholder = concurrent.futures.Future()
+        # registered before sending so an immediate reply always finds it
+        # the leader may hold its reply for the write concern, so that wait is allowed for too
+        self.forwarded[request_id] = (placeholder, time.monotonic() + FORWARD_TIMEOUT + self.write_timeout)
+        payload = {"request_id": request_id, "frame": frame, "addr": list(addr)}
+        if not self.internal_communicator.forward_request(payload, group):
+            del self.forwarded[request_id]
+            return False
+        if data is not None:
+            data.replies.append(placeholder)
+        return True
+
+    # forward a request that only the leader may run, telling the client when it cannot
+    def forward_or_fail(self, sock, data, frame, data_length, group=None):
+        data.outb = data.outb[data_length:]
+        if not self.forward_client_request(data, frame, data.addr, group):
+            data.replies.append(workers.encode_frame(
+                {"version": 0, "command": "error", "data": {"error": "no leader available, please retry"}}))
+            self.flush_replies(sock, data)
+
+    # leader side: run a forwarded write as if its client were connected here; returns a
+    # future with the client's reply, which the write concern may hold back until enough
+    # replicas have acknowledged the write
+    def execute_forwarded(self, payload):
+        capture = ReplyCapture()
+        data = types.SimpleNamespace(addr=tuple(payload["addr"]), inb=b"",
+                                     outb=(payload["frame"] + "\0").encode("utf-8"),
+                                     replies=collections.deque())
+        self.dispatch_request(capture, data, allow_forward=False)
+        reply = concurrent.futures.Future()
+
+        def finish(_=None):
+            self.flush_replies(capture, data)
+            if data.replies:
+                # waiting on the write concern gate or on a reply from the encoder pool
+                data.replies[0].add_done_callback(finish)
+            else:
+                reply.set_result(capture.sent.decode("utf-8"))
+        finish()
+        return reply
+
+    # follower side: the leader answered a forwarded write
+    def complete_forwarded(self, request_id, reply):
+        entry = self.forwarded.pop(request_id, None)
+        if entry is not None:
+            entry[0].set_result(reply.encode("utf-8"))
+
+    # fail forwarded writes the leader never answered so their clients are not stuck
+    def expire_forwarded(self):
+        now = time.monotonic()
+        for request_id, (placeholder, deadline) in list(self.forwarded.items()):
+            if now >= deadline and self.forwarded.pop(request_id, None) is not None:
+                placeholder.set_result(workers.encode_frame(
+                    {"version": 0, "command": "error", "data": {"error": "leader did not respond, please retry"}}))
+
+    # serve ready client connections, at most client_budget of them, starting where the last
+    # iteration stopped so every client gets its turn; stops early when replication is
+    # waiting for the state lock
+    def serve_clients(self, clients):
+        if not clients:
+            return
+        state_lock = self.internal_communicator.state_lock
+        start = self.next_client % len(clients)
+        served = 0
+        for key, mask in clients[start:] + clients[:start]:
+            if served >= self.client_budget or (served and state_lock.contended()):
+                break
+            with state_lock.low():
+                self.handle_conn(key, mask)
+            self.watch_conn(key)
+            served += 1
+        self.next_client = start + served
+
+    # a connection only needs write events while it has replies or requests queued; idle
+    # connections are not reported as writable on every iteration
+    def watch_conn(self, key):
+        data = key.data
+        events = selectors.EVENT_READ
+        if data.replies or data.outb:
+            events |= selectors.EVENT_WRITE
+        try:
+            if self.sel.get_key(key.fileobj).events != events:
+                self.sel.modify(key.fileobj, events, data=data)
+        except (KeyError, ValueError):
+            # closed while it was being served
+            pass
+
+    # stop accepting clients and start handing off to the peers
+    def request_drain(self):
+        if self.draining:
+            return
+        print(f"{self.id} : draining for restart")
+        self.draining = True
+        if self.lsock is not None:
+            self.sel.unregister(self.lsock)
+            self.lsock.close()
+            self.lsock = None
+        self.internal_communicator.request_drain(self.drain_timeout)
+
+    # close client connections once their replies are out; returns True when nothing is left
+    # and the peers have been told, after saving the stores with the drained marker
+    # a client whose connection closes resends its request to another server
+    def finish_drain(self):
+        clients = [key for key in self.sel.get_map().values() if isinstance(key.data, types.SimpleNamespace)]
+        for key in clients:
+            if not key.data.replies:
+                self.sel.unregister(key.fileobj)
+                key.fileobj.close()
+        if len(self.sel.get_map()) > 1 or self.forwarded or not self.internal_communicator.drained.is_set():
+            return False
+        with self.internal_communicator.state_lock.high():
+            self.database["settings"]["drained"] = True
+            self.persist()
+        return True
+
+    # signal handlers only set a flag and wake the loop, which does the work
+    def on_sigterm(self, signum, frame):
+        self.draining_signalled = True
+        try:
+            self.wakeup_send.send(b"\0")
+        except OSError:
+            pass
 
     # run the server: setup the internal communicator and socket listening
     def run(self):
         self.sel = selectors.DefaultSelector()
+        self.encoder_pool = workers.create_pool(self.serialization_pool, self.serialization_workers)
         self.internal_communicator = handle_servers.ServerCoordinator(**self.internal_communicator_args)
+        # the coordinator ends with the server loop, including after a drain
+        self.internal_communicator.daemon = True
         self.internal_communicator.start()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.sel.register(self.wakeup_recv, selectors.EVENT_READ, data="wakeup")
+        self.draining_signalled = False
+        signal.signal(signal.SIGTERM, self.on_sigterm)
         lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         lsock.bind((self.host, self.port))
@@ -441,15 +1134,32 @@ class FaultTolerantServer(multiprocessing.Process):
         print("listening on", (self.host, self.port))
         lsock.setblocking(False)
         self.sel.register(lsock, selectors.EVENT_READ, data=None)
+        self.lsock = lsock
         try:
             while True:
-                events = self.sel.select(timeout=None)
+                timeout = FORWARD_TIMEOUT / 10 if self.forwarded else None
+                if self.draining:
+                    timeout = 0.05
+                events = self.sel.select(timeout=timeout)
+                clients = []
                 for key, mask in events:
                     if key.data is None:
                         self.accept_conn(key.fileobj)
+                    elif key.data == "wakeup":
+                        self.wakeup_recv.recv(4096)
                     else:
-                        self.handle_conn(key, mask)
+                        clients.append((key, mask))
+                self.serve_clients(clients)
+                if self.forwarded:
+                    self.expire_forwarded()
+                if self.draining_signalled:
+                    self.request_drain()
+                if self.draining and self.finish_drain():
+                    print(f"{self.id} : drained, exiting")
+                    break
         except KeyboardInterrupt:
             print(f"{self.id} : caught keyboard interrupt, exiting")
         finally:
             self.sel.close()
+            if self.encoder_pool is not None:
+                self.encoder_pool.shutdown(wait=False, cancel_futures=True)
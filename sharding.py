@@ -0,0 +1,36 @@
+import bisect
+import hashlib
+
+# points each replica group gets on the ring; more points spread users more evenly
+DEFAULT_VNODES = 64
+
+
+def ring_hash(key):
+    # stable across processes and machines, unlike the builtin hash()
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    # consistent-hash ring mapping usernames to replica groups
+    # adding or removing a group only moves the users on that group's arcs
+    def __init__(self, groups, vnodes=DEFAULT_VNODES):
+        self.groups = sorted(set(groups))
+        points = sorted(
+            (ring_hash(f"{group}#{i}"), group) for group in self.groups for i in range(vnodes)
+        )
+        self.hashes = [point for point, _ in points]
+        self.owners = [group for _, group in points]
+
+    def owner(self, key):
+        # the first group point clockwise from the key's hash
+        pos = bisect.bisect_right(self.hashes, ring_hash(key))
+        return self.owners[pos % len(self.owners)]
+
+
+def replica_groups(cluster_size, replication_factor):
+    # node numbers 0..cluster_size-1 split in order into groups of replication_factor nodes,
+    # so every user is stored on that many nodes; the last group takes any remainder
+    count = max(1, cluster_size // replication_factor)
+    groups = [list(range(i * replication_factor, (i + 1) * replication_factor)) for i in range(count)]
+    groups[-1] = list(range(groups[-1][0], max(cluster_size, groups[-1][-1] + 1)))
+    return groups
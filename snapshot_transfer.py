@@ -0,0 +1,121 @@
+import framing
+import hashlib
+import json
+import os
+import time
+
+# size of the raw snapshot slice carried by each chunk frame
+DEFAULT_CHUNK_BYTES = 256 * 1024
+# an incoming transfer that makes no progress for this long is resumed from its last good chunk
+STALL_TIMEOUT = 5.0
+
+
+class OutgoingSnapshot:
+    # one encoded snapshot being streamed to a peer as checksummed chunk frames
+    def __init__(self, snapshot_id, blob, digest, chunk_bytes, start_seq=0):
+        self.snapshot_id = snapshot_id
+        self.blob = blob
+        self.digest = digest
+        self.chunk_bytes = chunk_bytes
+        self.total_chunks = max(1, -(-len(blob) // chunk_bytes))
+        self.start_seq = start_seq
+        self.next_seq = start_seq
+        self.begun = False
+        self.ended = False
+
+    def next_frame(self):
+        # the begin frame, then each chunk in order, then the end frame, then None
+        if not self.begun:
+            self.begun = True
+            return framing.encode_frame({
+                "version": 0,
+                "command": "snapshot_begin",
+                "data": {
+                    "snapshot_id": self.snapshot_id,
+                    "total_bytes": len(self.blob),
+                    "total_chunks": self.total_chunks,
+                    "sha256": self.digest,
+                    "start_seq": self.start_seq,
+                },
+            })
+        if self.next_seq < self.total_chunks:
+            start = self.next_seq * self.chunk_bytes
+            chunk = self.blob[start:start + self.chunk_bytes]
+            # the chunk itself is the frame body, sent as raw bytes
+            frame = framing.encode_frame({
+                "version": 0,
+                "command": "snapshot_chunk",
+                "data": {
+                    "snapshot_id": self.snapshot_id,
+                    "seq": self.next_seq,
+                    "sha256": hashlib.sha256(chunk).hexdigest(),
+                },
+            }, chunk)
+            self.next_seq += 1
+            return frame
+        if not self.ended:
+            self.ended = True
+            return framing.encode_frame({
+                "version": 0,
+                "command": "snapshot_end",
+                "data": {"snapshot_id": self.snapshot_id},
+            })
+        return None
+
+
+class IncomingSnapshot:
+    # a snapshot being received: each chunk is verified and appended to a part file on disk
+    def __init__(self, path, begin):
+        self.path = path
+        self.snapshot_id = begin["snapshot_id"]
+        self.total_bytes = begin["total_bytes"]
+        self.total_chunks = begin["total_chunks"]
+        self.digest = begin["sha256"]
+        self.next_seq = 0
+        self.file = open(path, "wb")
+        self.last_progress = time.monotonic()
+        # set while waiting for the sender to restart from next_seq
+        self.resume_requested = False
+
+    def can_resume(self, begin):
+        # a repeated begin for the same snapshot continues where the part file ends
+        return begin["snapshot_id"] == self.snapshot_id and begin["start_seq"] == self.next_seq
+
+    def add_chunk(self, chunk_data, chunk):
+        # verify and store one chunk, returning False when it is out of order or corrupt
+        if chunk_data["snapshot_id"] != self.snapshot_id or chunk_data["seq"] != self.next_seq:
+            return False
+        if hashlib.sha256(chunk).hexdigest() != chunk_data["sha256"]:
+            return False
+        self.file.write(chunk)
+        self.next_seq += 1
+        self.last_progress = time.monotonic()
+        return True
+
+    def stalled(self):
+        return time.monotonic() - self.last_progress > STALL_TIMEOUT
+
+    def finish(self):
+        # check the whole snapshot against its checksum and return the decoded contents,
+        # or None when it does not match
+        self.file.close()
+        hasher = hashlib.sha256()
+        size = 0
+        with open(self.path, "rb") as part_file:
+            for block in iter(lambda: part_file.read(1024 * 1024), b""):
+                hasher.update(block)
+                size += len(block)
+        if self.next_seq != self.total_chunks or size != self.total_bytes or hasher.hexdigest() != self.digest:
+            self.abort()
+            return None
+        with open(self.path, "r") as part_file:
+            snapshot = json.load(part_file)
+        os.remove(self.path)
+        return snapshot
+
+    def abort(self):
+        # discard a transfer that cannot be completed
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
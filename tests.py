@@ -5,14 +5,26 @@ import json
 import socket
 import threading
 import shutil
+import types
+import collections
+import concurrent.futures
+import time
 from io import StringIO
 from unittest.mock import patch
 
 # Import modules under test.
 import client
 import database
+import failure_detector
+import framing
 import handle_servers
 import main
+import merkle
+import message_ids
+import scheduler
+import server
+import sharding
+import workers
 
 class TestClientModule(unittest.TestCase):
     def setUp(self):
@@ -48,6 +60,46 @@ class TestClientModule(unittest.TestCase):
         self.assertEqual(client.retrieve_active_socket(), fake_sock)
         fake_sock.close()
 
+    def test_reads_rotate_over_servers_with_session_token(self):
+        primary, replica = DummySocket(), DummySocket()
+        client.connected_servers = [(("localhost", 50000), primary), (("localhost", 50001), replica)]
+        client.session_token.clear()
+        client.record_session_token({"node:1": 4})
+        with patch("client.follower_reads", True):
+            router = client.route_request()
+            router.sendall(b'{"version": 0, "command": "refresh_home", "data": {"username": "a"}}\0')
+            self.assertIs(client.retrieve_reply_socket(), replica)
+            router.sendall(b'{"version": 0, "command": "send_msg", "data": {}}\0')
+            self.assertIs(client.retrieve_reply_socket(), primary)
+            # paged reads rotate and carry the token like the others
+            router.sendall(b'{"version": 0, "command": "get_messages_since", "data": {"username": "a"}}\0')
+            self.assertIs(client.retrieve_reply_socket(), primary)
+            router.sendall(b'{"version": 0, "command": "get_conversation", "data": {"username": "a"}}\0')
+            self.assertIs(client.retrieve_reply_socket(), replica)
+        read = json.loads(replica.sent_data[0].decode("utf-8").rstrip("\0"))
+        self.assertEqual(read["data"]["session"], {"node:1": 4})
+        for sent in (primary.sent_data[-1], replica.sent_data[-1]):
+            self.assertEqual(json.loads(sent.decode("utf-8").rstrip("\0"))["data"]["session"], {"node:1": 4})
+        # the client routes exactly the commands the server treats as reads
+        self.assertEqual(client.READ_ONLY_COMMANDS, server.READ_COMMANDS)
+        client.connected_servers = []
+        client.session_token.clear()
+
+    def test_write_retried_on_another_server_with_same_request_id(self):
+        primary, replica = DummySocket(), DummySocket()
+        primary.recv = lambda size: b""
+        replica.recv = lambda size: b'{"version": 0, "command": "refresh_home", "data": {}}'
+        client.connected_servers = [(("localhost", 50000), primary), (("localhost", 50001), replica)]
+        client.route_request().sendall(b'{"version": 0, "command": "send_msg", "data": {}}\0')
+        self.assertIn(b"refresh_home", client.receive_reply(primary))
+        self.assertEqual(replica.sent_data, primary.sent_data)
+        self.assertIn("request_id", json.loads(primary.sent_data[0].decode("utf-8").rstrip("\0"))["data"])
+        # reads carry no id and are resent as they are
+        client.route_request().sendall(b'{"version": 0, "command": "search", "data": {}}\0')
+        client.receive_reply(primary)
+        self.assertEqual(replica.sent_data[-1], b'{"version": 0, "command": "search", "data": {}}\0')
+        client.connected_servers = []
+
     def test_get_connection_args_default(self):
         testargs = ["client.py"]
         with patch("sys.argv", testargs):
@@ -81,12 +133,15 @@ class TestDatabaseModule(unittest.TestCase):
         database.users_store_location = lambda vm_id: os.path.join(self.test_dir, f"users_{vm_id}.json")
         database.messages_store_location = lambda vm_id: os.path.join(self.test_dir, f"messages_{vm_id}.json")
         database.config_store_location = lambda vm_id: os.path.join(self.test_dir, f"settings_{vm_id}.json")
+        self.orig_journal_store = database.journal_store_location
+        database.journal_store_location = lambda vm_id: os.path.join(self.test_dir, f"journal_{vm_id}.jsonl")
 
     def tearDown(self):
         shutil.rmtree(self.test_dir)
         database.users_store_location = self.orig_users_store
         database.messages_store_location = self.orig_messages_store
         database.config_store_location = self.orig_config_store
+        database.journal_store_location = self.orig_journal_store
 
     def test_read_json_securely_file_not_exist(self):
         filepath = os.path.join(self.test_dir, "nonexistent.json")
@@ -145,15 +200,49 @@ class TestDatabaseModule(unittest.TestCase):
         self.assertIn("counter", config)
         self.assertIn("host", config)
 
+    def test_journal_replayed_and_cleared(self):
+        vm_id = "test"
+        _, messages, settings = database.initialize_empty_stores(vm_id)
+        messages["delivered"] = [{"id": 1, "sender": "a", "receiver": "b", "message": "x"},
+                                 {"id": 2, "sender": "a", "receiver": "b", "message": "y"}]
+        database.persist_data_stores(vm_id, {}, messages, settings)
+        database.append_journal(vm_id, {"command": "delete_msg", "ids": [1]})
+        _, loaded, _ = database.fetch_data_stores(vm_id)
+        self.assertEqual([m["id"] for m in loaded["delivered"]], [2])
+        database.persist_data_stores(vm_id, {}, loaded, settings)
+        self.assertEqual(database.read_journal(vm_id), [])
+
 # Create dummy classes to simulate a socket and a VM for Communication testing.
 class DummySocket:
     def __init__(self):
         self.sent_data = []
     def sendall(self, data):
         self.sent_data.append(data)
+    def send(self, data):
+        self.sent_data.append(bytes(data))
+        return len(data)
     def close(self):
         pass
 
+# Decode the peer frames written to a DummySocket.
+def peer_frames(sock):
+    decoder = framing.FrameDecoder()
+    decoder.feed(b"".join(sock.sent_data))
+    return [json.loads(header) for header, _ in decoder.pop_frames()]
+
+# Socket stand-in returning queued bytes a few at a time from recv.
+class PieceSocket:
+    def __init__(self, raw, piece):
+        self.raw = raw
+        self.piece = piece
+        self.offset = 0
+    def recv(self, size):
+        chunk = self.raw[self.offset:self.offset + min(size, self.piece)]
+        self.offset += len(chunk)
+        return chunk
+    def remaining(self):
+        return self.offset < len(self.raw)
+
 class DummyVM:
     def __init__(self):
         self.database = {
@@ -161,6 +250,8 @@ class DummyVM:
             "messages": {"dummy": "data"},
             "settings": {"dummy": "data"}
         }
+        self.encoder_pool = None
+        self.applied_updates = []
     def create_account(self, conn, data, flag):
         pass
     def login(self, conn, data, flag):
@@ -181,6 +272,142 @@ class DummyVM:
         pass
     def delete_messages(self, conn, data, flag):
         pass
+    # handlers used by the replication apply path, recording what was applied
+    def register_user(self, conn, data, flag):
+        self.applied_updates.append(data)
+    def process_msg(self, conn, data, flag):
+        self.applied_updates.append(data)
+    def persist(self):
+        pass
+    def rebuild_indexes(self):
+        pass
+
+class TestMessageIdsModule(unittest.TestCase):
+    def test_ids_unique_and_ordered_across_nodes(self):
+        first = message_ids.MessageIdGenerator(1)
+        second = message_ids.MessageIdGenerator(2)
+        with patch("message_ids.time.time", return_value=1800000000.0):
+            ids = [first.next_id() for _ in range(5)] + [second.next_id() for _ in range(5)]
+        self.assertEqual(len(set(ids)), 10)
+        self.assertEqual(ids[:5], sorted(ids[:5]))
+        self.assertEqual(message_ids.MessageIdGenerator.node_of(ids[7]), 2)
+        with patch("message_ids.time.time", return_value=1800000001.0):
+            self.assertGreater(first.next_id(), max(ids))
+
+    def test_clock_step_back_and_sequence_overflow(self):
+        gen = message_ids.MessageIdGenerator(3)
+        with patch("message_ids.time.time", return_value=1800000000.0):
+            ids = [gen.next_id() for _ in range(message_ids.MAX_SEQUENCE + 3)]
+        with patch("message_ids.time.time", return_value=1799999999.0):
+            ids.append(gen.next_id())
+        self.assertEqual(ids, sorted(set(ids)))
+
+class TestFailureDetectorModule(unittest.TestCase):
+    def test_phi_rises_with_silence(self):
+        detector = failure_detector.PhiAccrualDetector(0.0, 0.1, 1.0, 8.0)
+        for i in range(1, 21):
+            detector.heartbeat(i * 0.1, 0.002)
+        self.assertLess(detector.phi(2.1), 1)
+        self.assertFalse(detector.suspected(2.1))
+        self.assertFalse(detector.suspected(2.6))
+        self.assertTrue(detector.suspected(2.8))
+        self.assertAlmostEqual(detector.rtt, 0.002)
+
+    def test_startup_grace_before_first_pong(self):
+        detector = failure_detector.PhiAccrualDetector(0.0, 0.1, 1.0, 8.0)
+        self.assertFalse(detector.suspected(2.0))
+        self.assertTrue(detector.suspected(failure_detector.STARTUP_GRACE + 1))
+
+class TestShardingModule(unittest.TestCase):
+    def test_ring_spreads_users_and_moves_few_on_change(self):
+        users = [f"user{i}" for i in range(1000)]
+        ring = sharding.HashRing(["a", "b", "c"])
+        owners = {name: ring.owner(name) for name in users}
+        counts = collections.Counter(owners.values())
+        self.assertEqual(set(counts), {"a", "b", "c"})
+        self.assertGreater(min(counts.values()), 200)
+        # dropping a group only reassigns the users that group owned
+        smaller = sharding.HashRing(["a", "b"])
+        moved = [name for name in users if smaller.owner(name) != owners[name]]
+        self.assertTrue(all(owners[name] == "c" for name in moved))
+
+    def test_replica_groups_cover_every_node_once(self):
+        self.assertEqual(sharding.replica_groups(6, 3), [[0, 1, 2], [3, 4, 5]])
+        # the remainder joins the last group instead of forming an undersized one
+        self.assertEqual(sharding.replica_groups(7, 3), [[0, 1, 2], [3, 4, 5, 6]])
+        self.assertEqual(sharding.replica_groups(3, 3), [[0, 1, 2]])
+
+class TestMerkleModule(unittest.TestCase):
+    def test_only_marked_keys_are_rehashed(self):
+        store = {f"user:{i}": i for i in range(50)}
+        hashed = []
+        def item_hash(key):
+            hashed.append(key)
+            return None if key not in store else merkle.digest(store[key])
+        tree = merkle.MerkleTree(item_hash)
+        other = merkle.MerkleTree(item_hash)
+        for key in store:
+            tree.mark_dirty(key)
+            other.mark_dirty(key)
+        self.assertEqual(tree.root(), other.root())
+        hashed.clear()
+        store["user:7"] = "changed"
+        del store["user:9"]
+        tree.mark_dirty("user:7")
+        tree.mark_dirty("user:9")
+        self.assertNotEqual(tree.root(), other.root())
+        self.assertEqual(sorted(hashed), ["user:7", "user:9"])
+        branches = merkle.differing(tree.branch_hashes(), other.branch_hashes())
+        leaves = merkle.differing(
+            {k: v for b in branches for k, v in tree.leaves_of(b).items()},
+            {k: v for b in branches for k, v in other.leaves_of(b).items()})
+        keys = [key for leaf in leaves for key in merkle.differing(tree.keys_in(leaf), other.keys_in(leaf))]
+        self.assertEqual(sorted(keys), ["user:7", "user:9"])
+
+class TestSchedulerModule(unittest.TestCase):
+    def test_waiting_replication_goes_before_new_client_work(self):
+        lock = scheduler.PriorityLock()
+        order = []
+        lock.acquire()
+        lock.acquire()
+        high = threading.Thread(target=lambda: (lock.acquire(high=True), order.append("high"), lock.release()))
+        high.start()
+        while not lock.contended():
+            time.sleep(0.001)
+        low = threading.Thread(target=lambda: (lock.acquire(), order.append("low"), lock.release()))
+        low.start()
+        time.sleep(0.05)
+        self.assertEqual(order, [])
+        lock.release()
+        lock.release()
+        high.join(1)
+        low.join(1)
+        self.assertEqual(order, ["high", "low"])
+
+class TestFramingModule(unittest.TestCase):
+    def test_frames_split_across_reads(self):
+        decoder = framing.FrameDecoder()
+        stream = (framing.encode_frame({"a": 1}) + framing.encode_frame({"b": 2}, b"\0raw\xff")
+                  + framing.encode_frame({"c": "\u00e9"}))
+        frames = []
+        for i in range(0, len(stream), 5):
+            decoder.feed(stream[i:i + 5])
+            frames.extend(decoder.pop_frames())
+        self.assertEqual([json.loads(header) for header, _ in frames], [{"a": 1}, {"b": 2}, {"c": "\u00e9"}])
+        self.assertEqual([body for _, body in frames], [b"", b"\0raw\xff", b""])
+        self.assertEqual(decoder.pending_bytes(), 0)
+
+    def test_partial_tail_is_kept_and_bad_lengths_rejected(self):
+        decoder = framing.FrameDecoder()
+        frame = framing.encode_frame({"x": "x" * 1000})
+        for i in range(0, len(frame) - 1, 10):
+            decoder.feed(frame[i:min(i + 10, len(frame) - 1)])
+            self.assertEqual(decoder.pop_frames(), [])
+        decoder.feed(frame[-1:])
+        self.assertEqual(len(decoder.pop_frames()), 1)
+        decoder.feed(framing.FRAME_HEADER.pack(framing.MAX_FRAME_BYTES, 1))
+        with self.assertRaises(ValueError):
+            decoder.pop_frames()
 
 class TestHandleServersModule(unittest.TestCase):
     def setUp(self):
@@ -214,7 +441,9 @@ class TestHandleServersModule(unittest.TestCase):
     def test_distribute_update(self):
         update = {"command": "test_command", "data": {"key": "value"}}
         self.comm.broadcast_update(update)
-        sent_data = b"".join(self.dummy_socket.sent_data).decode("utf-8")
+        self.comm.flush_batch()
+        self.comm.flush_outbound()
+        sent_data = json.dumps(peer_frames(self.dummy_socket))
         self.assertIn("test_command", sent_data)
         self.assertIn("value", sent_data)
 
@@ -222,9 +451,1071 @@ class TestHandleServersModule(unittest.TestCase):
         # Set leader to the address of our dummy socket.
         self.comm.leader = "127.0.0.1:60001"
         self.comm.sync_database_from_leader()
-        sent_data = b"".join(self.dummy_socket.sent_data).decode("utf-8")
+        self.comm.flush_outbound()
+        sent_data = json.dumps(peer_frames(self.dummy_socket))
         self.assertIn("get_database", sent_data)
         self.assertIn("127.0.0.1", sent_data)
+
+    def test_broadcast_update_numbers_and_logs(self):
+        self.comm.batch_window = 0
+        self.comm.broadcast_update({"command": "send_msg", "data": {}})
+        self.comm.broadcast_update({"command": "send_msg", "data": {}})
+        self.comm.flush_outbound()
+        frames = peer_frames(self.dummy_socket)
+        self.assertEqual([f["index"] for f in frames], [1, 2])
+        self.assertEqual({f["origin"] for f in frames}, {self.comm.origin})
+        self.assertEqual(len(self.comm.replication_log), 2)
+
+    def test_apply_update_skips_duplicates_and_detects_gaps(self):
+        self.vm.database["settings"] = {}
+        self.comm.db_synchronized = True
+        update = lambda index: {"origin": "peer:1", "index": index,
+                                "data": {"version": 0, "command": "create", "data": {"n": index}}}
+        self.comm.apply_update(None, update(1))
+        self.comm.apply_update(None, update(1))
+        self.assertEqual(len(self.vm.applied_updates), 1)
+        self.comm.apply_update(None, update(3))
+        self.assertEqual(len(self.vm.applied_updates), 1)
+        self.assertFalse(self.comm.db_synchronized)
+        self.assertEqual(self.vm.database["settings"]["applied"], {"peer:1": 1})
+
+    def test_gapped_log_entries_keep_follower_unsynchronized(self):
+        self.vm.database["settings"] = {}
+        update = lambda index: {"origin": "peer:1", "index": index,
+                                "data": {"version": 0, "command": "create", "data": {"n": index}}}
+        self.comm.handle_peer_frame(None, {"command": "log_entries",
+                                           "data": {"entries": [update(1), update(3)]}})
+        self.assertEqual(len(self.vm.applied_updates), 1)
+        self.assertFalse(self.comm.db_synchronized)
+        self.comm.handle_peer_frame(None, {"command": "log_entries", "data": {"entries": [update(2), update(3)]}})
+        self.assertTrue(self.comm.db_synchronized)
+        self.assertEqual(self.vm.database["settings"]["applied"], {"peer:1": 3})
+
+    def test_replica_acknowledges_applied_updates(self):
+        self.vm.database["settings"] = {}
+        frame = {"version": 0, "command": "distribute_update", "origin": "peer:1", "index": 1,
+                 "host": "127.0.0.1", "port": 60001,
+                 "data": {"version": 0, "command": "create", "data": {}}}
+        self.comm.handle_peer_frame(None, frame)
+        self.comm.flush_outbound()
+        ack = peer_frames(self.dummy_socket)[-1]
+        self.assertEqual(ack["command"], "ack")
+        self.assertEqual(ack["data"]["applied"], {"peer:1": 1})
+
+    def test_metrics_report_per_peer_lag(self):
+        self.comm.batch_window = 0
+        self.comm.leader = "127.0.0.1:60000"
+        for _ in range(3):
+            self.comm.broadcast_update({"command": "send_msg", "data": {}})
+        self.comm.record_ack("127.0.0.1:60001", {self.comm.origin: 1})
+        metrics = self.comm.metrics()
+        peer = metrics["peers"]["127.0.0.1:60001"]
+        self.assertTrue(metrics["is_leader"])
+        self.assertEqual(peer["updates_sent"], 3)
+        self.assertEqual((peer["acked_index"], peer["lag_ops"]), (1, 2))
+        self.assertGreaterEqual(peer["lag_ms"], 0)
+        self.comm.record_ack("127.0.0.1:60001", {self.comm.origin: 3})
+        self.assertEqual(self.comm.metrics()["peers"]["127.0.0.1:60001"]["lag_ms"], 0.0)
+        json.dumps(metrics)
+
+    def test_write_waits_for_acks_until_timeout(self):
+        self.comm.broadcast_update({"command": "send_msg", "data": {}})
+        acked = self.comm.wait_for_acks(1, 1, 60)
+        expired = self.comm.wait_for_acks(1, 2, 0)
+        self.assertFalse(acked.done())
+        self.comm.handle_peer_frame(None, {"command": "ack", "host": "127.0.0.1", "port": 60001,
+                                           "data": {"applied": {self.comm.origin: 1}}})
+        self.assertTrue(acked.result(timeout=0))
+        self.assertFalse(expired.result(timeout=0))
+        self.assertEqual(self.comm.acks_needed("majority"), 1)
+
+    def test_draining_leader_hands_off_and_log_keeps_its_delta(self):
+        departing = DummySocket()
+        self.comm.peer_connections.append((("127.0.0.1", 59999), departing))
+        self.comm.leader = "127.0.0.1:59999"
+        self.comm.log_capacity = 2
+        self.comm.batch_window = 0
+        self.comm.broadcast_update({"command": "send_msg", "data": {}})
+        self.comm.handle_peer_frame(None, {"command": "leaving", "host": "127.0.0.1", "port": 59999,
+                                           "data": {"applied": {self.comm.origin: 1}}})
+        self.assertEqual(self.comm.leader, "127.0.0.1:60000")
+        for _ in range(4):
+            self.comm.broadcast_update({"command": "send_msg", "data": {}})
+        self.assertEqual([entry["index"] for entry in self.comm.replication_log], [2, 3, 4, 5])
+        self.assertEqual(len(self.comm.log_suffix({self.comm.origin: 1})), 4)
+        # back, but catching up: still not electable
+        self.comm.handle_peer_frame(None, {"version": framing.PROTOCOL_VERSION, "command": "welcome",
+                                           "host": "127.0.0.1", "port": 59999,
+                                           "data": {"rejoining": True}})
+        self.comm.verify_leader()
+        self.assertEqual(self.comm.leader, "127.0.0.1:60000")
+        self.comm.handle_peer_frame(None, {"command": "caught_up", "host": "127.0.0.1", "port": 59999, "data": {}})
+        self.assertEqual(self.comm.catching_up, set())
+
+    def test_restarted_node_catches_up_before_leading(self):
+        self.vm.database["settings"] = {"drained": True, "applied": {"old:1": 3}}
+        comm = handle_servers.ServerCoordinator(
+            vm=self.vm, vm_id="test", allowed_hosts=["127.0.0.1"], starting_ports=[60000],
+            max_ports=[1], current_host="127.0.0.1", current_port=60000)
+        comm.peer_connections = [(("127.0.0.1", 60001), self.dummy_socket)]
+        comm.select_leader()
+        self.assertEqual(comm.leader, "127.0.0.1:60001")
+        comm.sync_database_from_leader()
+        comm.handle_peer_frame(None, {"command": "log_entries", "data": {"entries": []}})
+        comm.flush_outbound()
+        sent = [f["command"] for f in peer_frames(self.dummy_socket)]
+        self.assertEqual(sent, ["get_log", "caught_up"])
+        self.assertFalse(comm.rejoining)
+        self.assertNotIn("drained", self.vm.database["settings"])
+        # draining again announces the applied vector once the group has everything
+        comm.request_drain(0)
+        comm.continue_drain()
+        # the event loop calls it again on its next pass instead of waiting inside it
+        self.assertFalse(comm.drained.is_set())
+        comm.continue_drain()
+        leaving = peer_frames(self.dummy_socket)[-1]
+        self.assertEqual(leaving["command"], "leaving")
+        self.assertEqual(leaving["data"]["applied"], {"old:1": 3})
+        self.assertTrue(comm.drained.is_set())
+
+    def test_joining_nodes_follow_the_live_leader(self):
+        comm = handle_servers.ServerCoordinator(
+            vm=self.vm, vm_id="test", allowed_hosts=["127.0.0.1"], starting_ports=[60002],
+            max_ports=[1], current_host="127.0.0.1", current_port=60002)
+        comm.peer_connections = [(("127.0.0.1", 60003), DummySocket())]
+        welcome = lambda port, data: {"version": framing.PROTOCOL_VERSION, "command": "welcome",
+                                      "host": "127.0.0.1", "port": port, "data": data}
+        comm.handle_peer_frame(None, welcome(60003, {"leader": "127.0.0.1:60003"}))
+        # we are the lowest node, but the group already follows 60003
+        comm.verify_leader()
+        self.assertEqual(comm.leader, "127.0.0.1:60003")
+        # a lower node connecting later does not take over either
+        comm.peer_connections.append((("127.0.0.1", 60001), DummySocket()))
+        comm.handle_peer_frame(None, welcome(60001, {"leader": None}))
+        comm.verify_leader()
+        self.assertEqual(comm.leader, "127.0.0.1:60003")
+        # a node that crashed with data of its own rejoins like a drained one
+        self.vm.database["settings"] = {"applied": {"old:1": 3}}
+        restarted = handle_servers.ServerCoordinator(
+            vm=self.vm, vm_id="test", allowed_hosts=["127.0.0.1"], starting_ports=[60000],
+            max_ports=[1], current_host="127.0.0.1", current_port=60000)
+        self.assertTrue(restarted.rejoining)
+        self.assertNotIn("127.0.0.1:60000", restarted.leader_candidates())
+
+    def test_healed_partition_settles_on_one_leader(self):
+        ports = [60000, 60001, 60002]
+        nodes = {port: handle_servers.ServerCoordinator(
+            vm=DummyVM(), vm_id=f"n{port}", allowed_hosts=["127.0.0.1"], starting_ports=[port],
+            max_ports=[1], current_host="127.0.0.1", current_port=port) for port in ports}
+        for port, node in nodes.items():
+            node.peer_connections = [(("127.0.0.1", other), DummySocket()) for other in ports if other != port]
+        def exchange_pings():
+            for port, node in nodes.items():
+                for addr, _ in node.peer_connections:
+                    nodes[addr[1]].handle_peer_frame(None, {"command": "ping", "host": "127.0.0.1", "port": port,
+                                                            "data": {"sent": 0, "leader": node.leader, "term": node.term}})
+        for node in nodes.values():
+            node.select_leader()
+        exchange_pings()
+        a, b, c = (nodes[port] for port in ports)
+        self.assertEqual({node.leader for node in nodes.values()}, {"127.0.0.1:60000"})
+        # b loses a and elects itself in a later term; c, which still reaches both, follows
+        a.drop_peer(("127.0.0.1", 60001))
+        b.drop_peer(("127.0.0.1", 60000))
+        b.verify_leader()
+        self.assertEqual(b.leader, "127.0.0.1:60001")
+        exchange_pings()
+        self.assertEqual(c.leader, "127.0.0.1:60001")
+        self.assertEqual(a.leader, "127.0.0.1:60000")
+        # once a and b reconnect, the handshake carries b's newer term to a
+        a.peer_connections.append((("127.0.0.1", 60001), DummySocket()))
+        b.peer_connections.append((("127.0.0.1", 60000), DummySocket()))
+        for node, other in ((a, b), (b, a)):
+            node.handle_peer_frame(None, {"version": framing.PROTOCOL_VERSION, "command": "welcome",
+                                          "host": "127.0.0.1", "port": other.port, "data": other.handshake_data()})
+        exchange_pings()
+        for node in nodes.values():
+            node.verify_leader()
+        self.assertEqual({node.leader for node in nodes.values()}, {"127.0.0.1:60001"})
+        self.assertEqual({node.term for node in nodes.values()}, {b.term})
+
+    def test_ping_pong_and_silent_leader_failover(self):
+        self.comm.leader = "127.0.0.1:60001"
+        self.comm.heartbeat()
+        self.comm.heartbeat()
+        self.comm.flush_outbound()
+        ping = peer_frames(self.dummy_socket)[-1]
+        self.assertEqual(ping["command"], "ping")
+        self.comm.handle_peer_frame(None, {"command": "pong", "host": "127.0.0.1", "port": 60001,
+                                           "data": ping["data"]})
+        self.assertIsNotNone(self.comm.peer_health()["127.0.0.1:60001"]["rtt_ms"])
+        # the leader goes quiet long enough to pass the suspicion timeout
+        later = time.monotonic() + self.comm.suspicion_timeout + 1
+        with patch("handle_servers.time.monotonic", return_value=later):
+            self.comm.heartbeat()
+        self.assertEqual(self.comm.peer_connections, [])
+        self.assertEqual(self.comm.leader, "127.0.0.1:60000")
+
+    def test_parallel_discovery_with_backoff(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(("127.0.0.1", 0))
+        live_addr, dead_addr = listener.getsockname(), closed.getsockname()
+        closed.close()
+        self.comm.sel = handle_servers.selectors.DefaultSelector()
+        self.comm.peer_connections = []
+        self.comm.available_endpoints = [live_addr, dead_addr]
+        try:
+            self.comm.discover_peers(time.monotonic())
+            deadline = time.monotonic() + 2
+            while self.comm.connecting and time.monotonic() < deadline:
+                for key, _ in self.comm.sel.select(timeout=0.1):
+                    self.comm.finish_connect(key.fileobj, key.data[1])
+            self.assertEqual([addr for addr, _ in self.comm.peer_connections], [live_addr])
+            retry_at, delay = self.comm.backoff[dead_addr]
+            self.assertEqual(delay, self.comm.heartbeat_interval)
+            self.comm.connect_failed(dead_addr, retry_at)
+            self.assertEqual(self.comm.backoff[dead_addr][1], 2 * self.comm.heartbeat_interval)
+        finally:
+            for _, sock in self.comm.peer_connections:
+                sock.close()
+            listener.close()
+            self.comm.sel.close()
+
+    def test_handshake_refuses_duplicate_node_number(self):
+        self.vm.id_generator = message_ids.MessageIdGenerator(5)
+        self.comm.sel = handle_servers.selectors.DefaultSelector()
+        accepted, remote = socket.socketpair()
+        try:
+            self.comm.sel.register(accepted, handle_servers.selectors.EVENT_READ,
+                                   data=types.SimpleNamespace(peer=None))
+            hello = {"version": framing.PROTOCOL_VERSION, "command": "hello", "host": "127.0.0.1", "port": 60002,
+                     "data": {"vm_id": "peer", "node_number": 5}}
+            self.comm.handle_peer_frame(accepted, hello)
+            self.assertEqual(accepted.fileno(), -1)
+            self.assertNotIn(("127.0.0.1", 60002), [addr for addr, _ in self.comm.peer_connections])
+        finally:
+            remote.close()
+            self.comm.sel.close()
+
+    def test_handshake_refuses_other_protocol_versions(self):
+        self.comm.sel = handle_servers.selectors.DefaultSelector()
+        accepted, remote = socket.socketpair()
+        try:
+            self.comm.sel.register(accepted, handle_servers.selectors.EVENT_READ,
+                                   data=types.SimpleNamespace(peer=None))
+            # a node still on the newline delimited protocol announces version 0
+            hello = {"version": 0, "command": "hello", "host": "127.0.0.1", "port": 60002,
+                     "data": {"vm_id": "peer"}}
+            with patch("sys.stdout", new_callable=StringIO) as output:
+                self.comm.handle_peer_frame(accepted, hello)
+            self.assertIn("peer protocol version 0", output.getvalue())
+            self.assertEqual(accepted.fileno(), -1)
+            self.assertNotIn(("127.0.0.1", 60002), [addr for addr, _ in self.comm.peer_connections])
+        finally:
+            remote.close()
+            self.comm.sel.close()
+
+    def test_handshake_keeps_one_connection_per_peer(self):
+        self.comm.sel = handle_servers.selectors.DefaultSelector()
+        peer = ("127.0.0.1", 60001)
+        hello = {"version": framing.PROTOCOL_VERSION, "command": "hello", "host": peer[0], "port": peer[1], "data": {"vm_id": "peer"}}
+        accepted, remote = socket.socketpair()
+        try:
+            # our own dialled connection wins because we have the lower address
+            self.comm.dialled.add(self.dummy_socket)
+            self.comm.sel.register(accepted, handle_servers.selectors.EVENT_READ,
+                                   data=types.SimpleNamespace(peer=None))
+            self.comm.handle_peer_frame(accepted, hello)
+            self.assertEqual(self.comm.peer_connections, [(peer, self.dummy_socket)])
+            self.assertEqual(accepted.fileno(), -1)
+            # without a connection of our own, the accepted one is adopted for both directions
+            self.comm.dialled.clear()
+            accepted, remote2 = socket.socketpair()
+            self.comm.sel.register(accepted, handle_servers.selectors.EVENT_READ,
+                                   data=types.SimpleNamespace(peer=None))
+            self.comm.handle_peer_frame(accepted, hello)
+            self.assertEqual(self.comm.peer_connections, [(peer, accepted)])
+            self.assertEqual(self.comm.sel.get_key(accepted).data.peer, peer)
+            self.comm.heartbeat()
+            self.comm.heartbeat()
+            self.comm.flush_outbound()
+            self.assertIn(b'"command":"ping"', remote2.recv(4096))
+            remote2.close()
+        finally:
+            remote.close()
+            for _, sock in self.comm.peer_connections:
+                sock.close()
+            self.comm.sel.close()
+
+    def test_sharded_updates_go_only_to_storing_groups(self):
+        self.comm.ring = sharding.HashRing(["a", "b", "c"])
+        self.comm.group = "a"
+        other_group = DummySocket()
+        self.comm.peer_connections.append((("127.0.0.1", 60002), other_group))
+        self.comm.peer_groups = {"127.0.0.1:60001": "a", "127.0.0.1:60002": "b"}
+        self.comm.batch_window = 0
+        self.comm.broadcast_update({"command": "send_msg", "data": {}}, {"a", "b"})
+        self.comm.broadcast_update({"command": "send_msg", "data": {}}, {"b"})
+        self.comm.flush_outbound()
+        same = peer_frames(self.dummy_socket)
+        other = peer_frames(other_group)
+        self.assertEqual([(f["origin"], f["index"]) for f in same], [(self.comm.origin, 1)])
+        self.assertEqual([(f["origin"], f["index"]) for f in other],
+                         [(f"{self.comm.origin}>b", 1), (f"{self.comm.origin}>b", 2)])
+        # leadership is decided within the group
+        self.comm.select_leader()
+        self.assertEqual(self.comm.leader, "127.0.0.1:60000")
+        # another group is reached through the leader its members announce, not its lowest member
+        self.comm.peer_connections.append((("127.0.0.1", 60003), DummySocket()))
+        self.comm.peer_groups["127.0.0.1:60003"] = "b"
+        self.assertIsNone(self.comm.leader_of("b"))
+        for port in (60002, 60003):
+            self.comm.handle_peer_frame(None, {"command": "ping", "host": "127.0.0.1", "port": port,
+                                               "data": {"sent": 0, "leader": "127.0.0.1:60003", "term": 2}})
+        self.assertEqual(self.comm.leader_of("b"), "127.0.0.1:60003")
+        self.assertEqual(self.comm.leader, "127.0.0.1:60000")
+
+    def test_read_lag_from_leader_heartbeat(self):
+        self.vm.database["settings"] = {"applied": {"x:1": 3}}
+        self.comm.leader = "127.0.0.1:60001"
+        self.assertEqual(self.comm.read_lag(), float("inf"))
+        self.comm.handle_peer_frame(None, {"command": "ping", "host": "127.0.0.1", "port": 60001,
+                                           "data": {"sent": 0, "applied": {"x:1": 5, "y:1": 2}}})
+        self.assertEqual(self.comm.read_lag(), 4)
+        self.assertTrue(self.comm.has_applied({"x:1": 3, "z:1>other": 9}))
+        self.assertFalse(self.comm.has_applied({"x:1": 4}))
+
+    def test_sync_requests_log_suffix_when_applied(self):
+        self.vm.database["settings"] = {"applied": {"peer:1": 4}}
+        self.comm.leader = "127.0.0.1:60001"
+        self.comm.sync_database_from_leader()
+        self.comm.flush_outbound()
+        request = peer_frames(self.dummy_socket)[-1]
+        self.assertEqual(request["command"], "get_log")
+        self.assertEqual(request["applied"], {"peer:1": 4})
+        # the next monitor passes wait for the answer instead of asking again
+        self.comm.sync_database_from_leader()
+        self.comm.flush_outbound()
+        self.assertEqual(len(peer_frames(self.dummy_socket)), 1)
+        self.comm.handle_peer_frame(None, {"command": "log_entries", "data": {"entries": []}})
+        self.comm.sync_database_from_leader()
+        self.comm.flush_outbound()
+        self.assertEqual(len(peer_frames(self.dummy_socket)), 2)
+        # an unanswered request is repeated once it times out
+        later = time.monotonic() + handle_servers.SYNC_REQUEST_TIMEOUT + 1
+        with patch("handle_servers.time.monotonic", return_value=later):
+            self.comm.sync_database_from_leader()
+        self.comm.flush_outbound()
+        self.assertEqual(len(peer_frames(self.dummy_socket)), 3)
+
+    def test_repeated_snapshot_request_does_not_restart_transfer(self):
+        addr = ("127.0.0.1", 60001)
+        self.vm.database = {"users": {}, "messages": {"undelivered": {}, "delivered": {}}, "settings": {}}
+        self.vm.encoder_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(self.vm.encoder_pool.shutdown)
+        gate = threading.Event()
+        self.addCleanup(gate.set)
+        self.vm.encoder_pool.submit(gate.wait)
+        self.comm.handle_peer_frame(None, {"command": "get_database", "host": addr[0], "port": addr[1]})
+        # still encoding: a repeat is dropped
+        self.comm.handle_peer_frame(None, {"command": "get_database", "host": addr[0], "port": addr[1]})
+        self.assertEqual(len(self.comm.pending_snapshots), 1)
+        gate.set()
+        concurrent.futures.wait([future for future, _, _ in self.comm.pending_snapshots])
+        self.comm.flush_snapshots()
+        # now streaming: a repeat is dropped too
+        self.comm.handle_peer_frame(None, {"command": "get_database", "host": addr[0], "port": addr[1]})
+        self.assertEqual(self.comm.pending_snapshots, [])
+        self.assertEqual(self.comm.counters["snapshots_sent"], 1)
+
+    def test_log_suffix_and_compaction_fallback(self):
+        self.vm.database["settings"] = {}
+        self.comm.log_capacity = 3
+        for _ in range(5):
+            self.comm.broadcast_update({"command": "send_msg", "data": {}})
+        suffix = self.comm.log_suffix({self.comm.origin: 3})
+        self.assertEqual([e["index"] for e in suffix], [4, 5])
+        self.assertEqual(self.comm.log_suffix({self.comm.origin: 5}), [])
+        # index 2 was evicted, so a peer that stopped at 1 needs a snapshot
+        self.assertIsNone(self.comm.log_suffix({self.comm.origin: 1}))
+
+    def test_updates_are_batched_into_one_frame(self):
+        self.vm.database["settings"] = {}
+        self.comm.batch_max = 3
+        for i in range(4):
+            self.comm.broadcast_update({"command": "send_msg", "data": {"n": i}})
+        # the first three filled a batch; the fourth waits for the window to close
+        self.assertEqual(len(self.comm.pending_batch), 1)
+        self.comm.flush_batch()
+        self.comm.flush_outbound()
+        frames = peer_frames(self.dummy_socket)
+        self.assertEqual([f["command"] for f in frames], ["distribute_batch", "distribute_update"])
+        self.assertEqual([e["index"] for e in frames[0]["data"]["entries"]], [1, 2, 3])
+
+    def test_peer_queue_overflow_drops_updates_and_requests_resync(self):
+        self.vm.database["settings"] = {}
+        self.comm.peer_queue_bytes = 600
+        self.comm.batch_window = 0
+        for _ in range(10):
+            self.comm.broadcast_update({"command": "send_msg", "data": {"message": "x" * 100}})
+        stats = self.comm.queue_stats()["127.0.0.1:60001"]
+        self.assertGreater(stats["overflows"], 0)
+        self.assertGreater(stats["frames_dropped"], 0)
+        self.assertLessEqual(stats["queued_bytes"], 600 + 100)
+        self.comm.flush_outbound()
+        commands = [f["command"] for f in peer_frames(self.dummy_socket)]
+        self.assertIn("resync", commands)
+
+    def test_failed_peer_is_dropped(self):
+        class BrokenSocket(DummySocket):
+            def send(self, data):
+                raise ConnectionResetError()
+        self.comm.peer_connections = [(("127.0.0.1", 60001), BrokenSocket())]
+        self.comm.broadcast_update({"command": "send_msg", "data": {}})
+        self.comm.flush_batch()
+        self.comm.flush_outbound()
+        self.assertEqual(self.comm.peer_connections, [])
+        self.assertEqual(self.comm.outbound, {})
+
+    # run the sender's snapshot pipeline until its transfer to the dummy peer completes
+    def stream_snapshot(self, resume=None):
+        addr = ("127.0.0.1", 60001)
+        self.comm.send_snapshot(addr, self.dummy_socket, resume)
+        while self.comm.pending_snapshots or self.comm.outgoing_snapshots:
+            concurrent.futures.wait([f for f, _, _ in self.comm.pending_snapshots])
+            self.comm.flush_snapshots()
+            self.comm.pump_snapshots()
+            self.comm.flush_outbound()
+
+    # feed raw peer bytes to a receiving coordinator in small pieces, like recv would
+    def deliver(self, receiver, raw, piece=1000):
+        conn = PieceSocket(raw, piece)
+        data = types.SimpleNamespace(addr=("127.0.0.1", 60000), decoder=handle_servers.framing.FrameDecoder(),
+                                     peer=None)
+        key = types.SimpleNamespace(fileobj=conn, data=data)
+        while conn.remaining():
+            receiver.process_peer_message(key, handle_servers.selectors.EVENT_READ)
+
+    def snapshot_receiver(self, test_dir):
+        receiver_vm = DummyVM()
+        receiver = handle_servers.ServerCoordinator(
+            vm=receiver_vm, vm_id="receiver", allowed_hosts=["127.0.0.1"], starting_ports=[60000],
+            max_ports=[1], current_host="127.0.0.1", current_port=60001)
+        receiver.leader = "127.0.0.1:60000"
+        receiver.peer_connections = [(("127.0.0.1", 60000), DummySocket())]
+        return receiver_vm, receiver
+
+    def test_chunked_snapshot_transfer(self):
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        with patch.object(database, "snapshot_store_location",
+                          lambda vm_id: os.path.join(test_dir, f"snapshot_{vm_id}.part")):
+            self.vm.database = {
+                "users": {f"user{i}": {"password": "x" * 40, "logged_in": False, "addr": None} for i in range(50)},
+                "messages": {"undelivered": {}, "delivered": {}},
+                "settings": {"counter": 7},
+            }
+            self.vm.encoder_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self.comm.snapshot_chunk_bytes = 512
+            try:
+                self.stream_snapshot()
+            finally:
+                self.vm.encoder_pool.shutdown()
+            commands = [f["command"] for f in peer_frames(self.dummy_socket)]
+            self.assertEqual(commands[0], "snapshot_begin")
+            self.assertEqual(commands[-1], "snapshot_end")
+            self.assertGreater(commands.count("snapshot_chunk"), 3)
+
+            receiver_vm, receiver = self.snapshot_receiver(test_dir)
+            self.deliver(receiver, b"".join(self.dummy_socket.sent_data))
+            self.assertTrue(receiver.db_synchronized)
+            self.assertEqual(receiver_vm.database["users"], self.vm.database["users"])
+            self.assertEqual(receiver_vm.database["settings"]["counter"], 7)
+            self.assertFalse(os.path.exists(os.path.join(test_dir, "snapshot_receiver.part")))
+
+    def test_corrupt_chunk_resumes_from_last_good_chunk(self):
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        with patch.object(database, "snapshot_store_location",
+                          lambda vm_id: os.path.join(test_dir, f"snapshot_{vm_id}.part")):
+            self.vm.database = {
+                "users": {f"user{i}": {"password": "x", "logged_in": False, "addr": None} for i in range(50)},
+                "messages": {"undelivered": {}, "delivered": {}},
+                "settings": {"counter": 0},
+            }
+            self.comm.snapshot_chunk_bytes = 256
+            self.stream_snapshot()
+            frames = list(self.dummy_socket.sent_data)
+            receiver_vm, receiver = self.snapshot_receiver(test_dir)
+            # chunk 2 arrives damaged, so the receiver asks to resume from it
+            decoder = framing.FrameDecoder()
+            decoder.feed(frames[3])
+            [(header, body)] = decoder.pop_frames()
+            bad = json.loads(header)
+            bad["data"]["sha256"] = "0" * 64
+            self.deliver(receiver, b"".join(frames[:3]) + framing.encode_frame(bad, body) + b"".join(frames[4:-1]))
+            receiver.flush_outbound()
+            self.assertEqual(len(receiver.peer_connections[0][1].sent_data), 1)
+            resume = peer_frames(receiver.peer_connections[0][1])[-1]
+            self.assertEqual(resume["resume"]["next_seq"], 2)
+            self.dummy_socket.sent_data = []
+            self.stream_snapshot(resume["resume"])
+            self.deliver(receiver, b"".join(self.dummy_socket.sent_data))
+            self.assertTrue(receiver.db_synchronized)
+            self.assertEqual(receiver_vm.database["users"], self.vm.database["users"])
+
+# Socket stand-in for client connections, accepting at most max_send bytes per send.
+class DummyClientSocket:
+    def __init__(self, max_send=None):
+        self.sent = b""
+        self.max_send = max_send
+    def send(self, data):
+        n = len(data) if self.max_send is None else min(self.max_send, len(data))
+        self.sent += bytes(data[:n])
+        return n
+    def replies(self):
+        # replies are concatenated json objects, so decode them one after another
+        decoder = json.JSONDecoder()
+        text = self.sent.decode("utf-8")
+        replies, pos = [], 0
+        while pos < len(text):
+            reply, pos = decoder.raw_decode(text, pos)
+            replies.append(reply)
+        return replies
+
+class DummyCoordinator:
+    def __init__(self):
+        self.updates = []
+        self.leader = True
+        self.forwarded = []
+        self.group = "0"
+        self.ring = None
+        self.update_groups = []
+        self.lag = 0
+        self.state_lock = scheduler.PriorityLock()
+    def broadcast_update(self, update, groups=None):
+        self.updates.append(update)
+        self.update_groups.append(groups)
+    def owner_group(self, username):
+        return None if self.ring is None else self.ring.owner(username)
+    def is_leader(self):
+        return self.leader
+    def forward_request(self, payload, group=None):
+        self.forwarded.append(payload)
+        return True
+    def last_index(self):
+        return len(self.updates)
+    def session_token(self):
+        return {"origin": len(self.updates)}
+    def has_applied(self, token):
+        return token.get("origin", 0) <= len(self.updates)
+    def read_lag(self):
+        return self.lag
+    def acks_needed(self, write_concern):
+        return 1
+    def wait_for_acks(self, index, needed, timeout):
+        self.ack_future = concurrent.futures.Future()
+        return self.ack_future
+    def metrics(self):
+        return {"leader": self.leader, "peers": {}}
+
+class TestServerModule(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.orig_users_store = database.users_store_location
+        self.orig_messages_store = database.messages_store_location
+        self.orig_config_store = database.config_store_location
+        database.users_store_location = lambda vm_id: os.path.join(self.test_dir, f"users_{vm_id}.json")
+        database.messages_store_location = lambda vm_id: os.path.join(self.test_dir, f"messages_{vm_id}.json")
+        database.config_store_location = lambda vm_id: os.path.join(self.test_dir, f"settings_{vm_id}.json")
+        self.orig_journal_store = database.journal_store_location
+        database.journal_store_location = lambda vm_id: os.path.join(self.test_dir, f"journal_{vm_id}.jsonl")
+        self.server = server.FaultTolerantServer(0, "127.0.0.1", 50000)
+        self.server.internal_communicator = DummyCoordinator()
+
+    def tearDown(self):
+        if self.server.encoder_pool is not None:
+            self.server.encoder_pool.shutdown()
+        shutil.rmtree(self.test_dir)
+        database.users_store_location = self.orig_users_store
+        database.messages_store_location = self.orig_messages_store
+        database.config_store_location = self.orig_config_store
+        database.journal_store_location = self.orig_journal_store
+
+    # feed one framed client request through the connection handler
+    def request(self, sock, command, payload, addr=("127.0.0.1", 40000)):
+        frame = json.dumps({"version": 0, "command": command, "data": payload}) + "\0"
+        data = types.SimpleNamespace(addr=addr, inb=b"", outb=frame.encode("utf-8"),
+                                     replies=collections.deque())
+        key = types.SimpleNamespace(fileobj=sock, data=data)
+        self.server.handle_conn(key, server.selectors.EVENT_WRITE)
+        return data
+
+    def test_create_account_reply(self):
+        sock = DummyClientSocket()
+        self.request(sock, "create", {"username": "alice", "password": "pw"})
+        self.assertEqual(sock.replies()[-1]["command"], "login")
+        self.assertIn("alice", self.server.database["users"])
+        self.assertEqual(self.server.internal_communicator.updates[0]["command"], "create")
+
+    def test_replication_factor_derives_replica_group(self):
+        node = server.FaultTolerantServer(0, "127.0.0.1", 50001, id_scheme="snowflake",
+                                          node_number=4, cluster_size=7, replication_factor=3)
+        args = node.internal_communicator_args
+        self.assertEqual(args["shard_groups"], ["r0", "r1"])
+        self.assertEqual(args["shard_group"], "r1")
+        # majorities are counted within the group of four
+        self.assertEqual(args["cluster_size"], 4)
+        with self.assertRaises(ValueError):
+            server.FaultTolerantServer(0, "127.0.0.1", 50002, id_scheme="snowflake",
+                                       cluster_size=7, replication_factor=3)
+        with self.assertRaisesRegex(ValueError, "snowflake"):
+            server.FaultTolerantServer(0, "127.0.0.1", 50003, id_scheme="sequence",
+                                       node_number=4, cluster_size=7, replication_factor=3)
+        with self.assertRaisesRegex(ValueError, "negative"):
+            server.FaultTolerantServer(0, "127.0.0.1", 50004, id_scheme="snowflake",
+                                       node_number=4, cluster_size=7, replication_factor=-1)
+
+    def test_large_reply_is_offloaded_and_flushed(self):
+        self.server.encoder_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.server.offload_threshold = 5
+        for i in range(10):
+            self.server.database["users"][f"user{i}"] = {"password": "pw", "logged_in": False, "addr": None}
+        sock = DummyClientSocket()
+        with patch.object(self.server.encoder_pool, "submit", wraps=self.server.encoder_pool.submit) as submit:
+            data = self.request(sock, "search", {"search": "*"})
+        self.assertEqual(submit.call_count, 1)
+        concurrent.futures.wait([r for r in data.replies if isinstance(r, concurrent.futures.Future)])
+        self.server.flush_replies(sock, data)
+        self.assertEqual(len(sock.replies()[-1]["data"]["user_list"]), 10)
+
+    def test_partial_send_keeps_tail_queued(self):
+        sock = DummyClientSocket(max_send=8)
+        data = self.request(sock, "search", {"search": "*"})
+        self.assertEqual(len(data.replies), 1)
+        while data.replies:
+            self.server.flush_replies(sock, data)
+        self.assertEqual(sock.replies()[-1]["command"], "user_list")
+
+    def test_send_msg_replicates_timestamp(self):
+        for name in ("alice", "bob"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        with patch("server.time.time", return_value=1000.0):
+            self.request(DummyClientSocket(), "send_msg", {"sender": "alice", "recipient": "bob", "message": "hi"})
+        self.assertEqual(self.server.database["messages"]["undelivered"][1]["timestamp"], 1000.0)
+        self.assertEqual(self.server.internal_communicator.updates[-1]["data"]["timestamp"], 1000.0)
+
+    def test_follower_forwards_writes_in_reply_order(self):
+        self.server.internal_communicator.leader = False
+        sock = DummyClientSocket()
+        data = self.request(sock, "create", {"username": "alice", "password": "pw"})
+        self.assertNotIn("alice", self.server.database["users"])
+        forwarded = self.server.internal_communicator.forwarded
+        self.assertEqual(len(forwarded), 1)
+        # reads are still served locally, but queue behind the pending write's reply
+        data.outb = (json.dumps({"version": 0, "command": "search",
+                                 "data": {"search": "*", "username": "alice"}}) + "\0").encode("utf-8")
+        self.server.handle_conn(types.SimpleNamespace(fileobj=sock, data=data), server.selectors.EVENT_WRITE)
+        self.assertEqual(sock.sent, b"")
+        leader = json.dumps({"version": 0, "command": "login", "data": {"username": "alice"}})
+        self.server.complete_forwarded(forwarded[0]["request_id"], leader)
+        self.server.flush_replies(sock, data)
+        self.assertEqual([r["command"] for r in sock.replies()], ["login", "user_list"])
+
+    def test_forwarded_write_expires_without_leader_reply(self):
+        self.server.internal_communicator.leader = False
+        sock = DummyClientSocket()
+        data = self.request(sock, "create", {"username": "alice", "password": "pw"})
+        with patch("server.time.monotonic", return_value=time.monotonic() + server.FORWARD_TIMEOUT + self.server.write_timeout + 1):
+            self.server.expire_forwarded()
+        self.server.flush_replies(sock, data)
+        self.assertEqual(sock.replies()[-1]["command"], "error")
+        self.assertEqual(self.server.forwarded, {})
+
+    def test_leader_executes_forwarded_write(self):
+        for name in ("alice", "bob"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        frame = json.dumps({"version": 0, "command": "send_msg",
+                            "data": {"sender": "alice", "recipient": "bob", "message": "hi"}})
+        reply = self.server.execute_forwarded({"request_id": 1, "frame": frame, "addr": ["10.0.0.2", 4000]}).result(0)
+        self.assertIn(1, self.server.database["messages"]["undelivered"])
+        self.assertEqual(self.server.internal_communicator.updates[-1]["data"]["id"], 1)
+        self.assertEqual(json.loads(reply)["command"], "refresh_home")
+
+    def test_write_concern_holds_reply_until_acknowledged(self):
+        self.server.write_concern = "one"
+        for name in ("alice", "bob"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        sock = DummyClientSocket()
+        data = self.request(sock, "send_msg", {"sender": "alice", "recipient": "bob", "message": "hi"})
+        self.assertEqual(sock.sent, b"")
+        self.server.internal_communicator.ack_future.set_result(True)
+        self.server.flush_replies(sock, data)
+        self.assertEqual(sock.replies()[-1]["command"], "refresh_home")
+        # a rejected write replicates nothing and is answered straight away
+        self.request(sock, "send_msg", {"sender": "alice", "recipient": "nobody", "message": "hi"})
+        self.assertEqual(sock.replies()[-1]["command"], "error")
+
+    def test_write_concern_timeout_replies_with_error(self):
+        self.server.write_concern = "one"
+        sock = DummyClientSocket()
+        data = self.request(sock, "create", {"username": "alice", "password": "pw"})
+        self.server.internal_communicator.ack_future.set_result(False)
+        self.server.flush_replies(sock, data)
+        self.assertEqual([r["command"] for r in sock.replies()], ["error"])
+        self.assertIn("alice", self.server.database["users"])
+
+    def test_forwarded_write_waits_for_majority_of_five(self):
+        self.server.write_concern = "majority"
+        coordinator = handle_servers.ServerCoordinator(
+            vm=self.server, vm_id=self.server.id, allowed_hosts=["127.0.0.1"], starting_ports=[60000],
+            max_ports=[1], current_host="127.0.0.1", current_port=60000, cluster_size=5)
+        coordinator.leader = "127.0.0.1:60000"
+        follower = DummySocket()
+        coordinator.peer_connections = [(("127.0.0.1", 60001), follower)] + [
+            (("127.0.0.1", port), DummySocket()) for port in (60002, 60003, 60004)]
+        self.server.internal_communicator = coordinator
+        frame = json.dumps({"version": 0, "command": "create", "data": {"username": "alice", "password": "pw"}})
+        coordinator.handle_peer_frame(None, {"version": 0, "command": "forward_request", "host": "127.0.0.1",
+                                             "port": 60001, "data": {"request_id": 7, "frame": frame,
+                                                                     "addr": ["10.0.0.2", 4000]}})
+        coordinator.flush_outbound()
+
+        def forward_replies():
+            return [f for f in peer_frames(follower) if f["command"] == "forward_reply"]
+        # the forwarding follower alone is not a majority of five
+        coordinator.record_ack("127.0.0.1:60001", {coordinator.origin: 1})
+        coordinator.flush_outbound()
+        self.assertEqual(forward_replies(), [])
+        coordinator.record_ack("127.0.0.1:60003", {coordinator.origin: 1})
+        coordinator.flush_outbound()
+        self.assertEqual(json.loads(forward_replies()[0]["data"]["reply"])["command"], "login")
+
+    def test_follower_refuses_forwarded_write(self):
+        coordinator = handle_servers.ServerCoordinator(
+            vm=self.server, vm_id=self.server.id, allowed_hosts=["127.0.0.1"], starting_ports=[60000],
+            max_ports=[1], current_host="127.0.0.1", current_port=60000)
+        coordinator.leader = "127.0.0.1:60002"
+        sender = DummySocket()
+        coordinator.peer_connections = [(("127.0.0.1", 60001), sender)]
+        self.server.internal_communicator = coordinator
+        frame = json.dumps({"version": 0, "command": "create", "data": {"username": "alice", "password": "pw"}})
+        coordinator.handle_peer_frame(None, {"version": 0, "command": "forward_request", "host": "127.0.0.1",
+                                             "port": 60001, "data": {"request_id": 3, "frame": frame,
+                                                                     "addr": ["10.0.0.2", 4000]}})
+        coordinator.flush_outbound()
+        reply = json.loads(peer_frames(sender)[0]["data"]["reply"])
+        self.assertEqual(reply["command"], "error")
+        self.assertNotIn("alice", self.server.database["users"])
+
+    def test_sharded_mailbox_requests_run_in_owning_group(self):
+        coordinator = self.server.internal_communicator
+        coordinator.ring = sharding.HashRing(["0", "1"])
+        local = next(f"u{i}" for i in range(100) if coordinator.ring.owner(f"u{i}") == "0")
+        remote = next(f"u{i}" for i in range(100) if coordinator.ring.owner(f"u{i}") == "1")
+        self.server.id_generator = message_ids.MessageIdGenerator(1)
+        for name in (local, remote):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        sock = DummyClientSocket()
+        self.request(sock, "send_msg", {"sender": remote, "recipient": local, "message": "hi"})
+        self.assertEqual(len(coordinator.forwarded), 1)
+        self.assertEqual(self.server.database["messages"]["undelivered"], {})
+        self.request(sock, "send_msg", {"sender": local, "recipient": remote, "message": "hi"})
+        self.assertEqual(len(self.server.database["messages"]["undelivered"]), 1)
+        self.assertEqual(coordinator.update_groups[-1], {"0", "1"})
+
+    def test_follower_reads_bounded_by_lag_and_session(self):
+        coordinator = self.server.internal_communicator
+        coordinator.leader = False
+        self.server.database["users"]["alice"] = {"password": "pw", "logged_in": False, "addr": None}
+        search = {"search": "*", "username": "alice"}
+        sock = DummyClientSocket()
+        self.request(sock, "search", search)
+        self.assertEqual(sock.replies()[-1]["command"], "user_list")
+        # a session token naming a write this node has not applied sends the read to the leader
+        self.request(sock, "search", dict(search, session={"origin": 1}))
+        coordinator.lag = self.server.max_read_lag + 1
+        self.request(sock, "search", search)
+        self.assertEqual(len(coordinator.forwarded), 2)
+        self.assertEqual(len(sock.replies()), 1)
+
+    def test_write_replies_carry_session_token(self):
+        sock = DummyClientSocket()
+        self.request(sock, "create", {"username": "alice", "password": "pw"})
+        self.assertEqual(sock.replies()[-1]["session"], {"origin": 1})
+
+    def test_retried_write_is_answered_from_dedup_cache(self):
+        for name in ("alice", "bob"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        request = {"sender": "alice", "recipient": "bob", "message": "hi", "request_id": "r1"}
+        first, retry = DummyClientSocket(), DummyClientSocket()
+        self.request(first, "send_msg", request)
+        self.request(retry, "send_msg", request)
+        self.assertEqual(len(self.server.database["messages"]["undelivered"]), 1)
+        self.assertEqual(retry.replies()[-1]["data"], first.replies()[-1]["data"])
+        # the entry travels in the write's own update and was on disk with the write
+        update = self.server.internal_communicator.updates[-1]
+        self.assertEqual(update["command"], "send_msg")
+        self.assertEqual(update["request"], {"request_id": "r1", "replies": self.server.cached_replies("r1")})
+        _, _, stored = database.fetch_data_stores(self.server.id)
+        self.assertIn("r1", stored["requests"])
+        # a rejected write is not cached
+        self.request(DummyClientSocket(), "send_msg", {**request, "recipient": "nobody", "request_id": "r2"})
+        self.assertIsNone(self.server.cached_replies("r2"))
+        # replicas keep the entry, evicting the oldest ids beyond capacity
+        self.server.dedup_capacity = 2
+        self.server.remember_request("r3", [])
+        self.server.remember_request("r4", [])
+        self.assertEqual(list(self.server.database["settings"]["requests"]), ["r3", "r4"])
+        self.assertEqual(len(self.server.internal_communicator.updates), 1)
+
+    def test_retried_login_binds_the_new_connection(self):
+        self.server.database["users"]["alice"] = {"password": "pw", "logged_in": False, "addr": None}
+        login = {"username": "alice", "password": "pw", "request_id": "r1"}
+        self.request(DummyClientSocket(), "login", login, addr=("10.0.0.2", 4000))
+        # the first server's connection died before the reply; the retry reaches this one
+        retry = DummyClientSocket()
+        self.request(retry, "login", login, addr=("10.0.0.3", 5000))
+        self.assertEqual(retry.replies()[-1]["command"], "login")
+        self.assertEqual(self.server.database["users"]["alice"]["addr"], "10.0.0.3:5000")
+        self.assertEqual(self.server.internal_communicator.updates[-1]["data"]["addr"], "10.0.0.3:5000")
+        # without the request id it is still a second login
+        self.request(retry, "login", {"username": "alice", "password": "pw"})
+        self.assertEqual(retry.replies()[-1]["command"], "error")
+
+    def test_client_budget_rotates_over_connections(self):
+        self.server.sel = server.selectors.DefaultSelector()
+        self.server.client_budget = 2
+        clients = []
+        for i in range(3):
+            frame = json.dumps({"version": 0, "command": "search", "data": {"search": "*"}}) + "\0"
+            data = types.SimpleNamespace(addr=("127.0.0.1", 40000 + i), inb=b"",
+                                         outb=frame.encode("utf-8"), replies=collections.deque())
+            clients.append((types.SimpleNamespace(fileobj=DummyClientSocket(), data=data),
+                            server.selectors.EVENT_WRITE))
+        self.server.serve_clients(clients)
+        self.assertEqual([bool(key.fileobj.sent) for key, _ in clients], [True, True, False])
+        self.server.serve_clients(clients)
+        self.assertTrue(clients[2][0].fileobj.sent)
+        self.server.sel.close()
+
+    def test_drain_closes_idle_clients_and_marks_stores(self):
+        self.server.sel = server.selectors.DefaultSelector()
+        self.server.internal_communicator.drained = threading.Event()
+        client_end, server_end = socket.socketpair()
+        data = types.SimpleNamespace(addr=("127.0.0.1", 40000), inb=b"", outb=b"", replies=collections.deque())
+        self.server.sel.register(server_end, server.selectors.EVENT_READ, data=data)
+        self.assertFalse(self.server.finish_drain())
+        self.assertEqual(client_end.recv(10), b"")
+        self.server.internal_communicator.drained.set()
+        self.assertTrue(self.server.finish_drain())
+        self.assertTrue(database.fetch_data_stores(self.server.id)[2]["drained"])
+        client_end.close()
+        self.server.sel.close()
+
+    def test_stats_only_for_local_clients(self):
+        sock = DummyClientSocket()
+        self.request(sock, "stats", {})
+        reply = sock.replies()[-1]
+        self.assertEqual(reply["command"], "stats")
+        self.assertEqual(reply["data"]["forwarded_pending"], 0)
+        remote = DummyClientSocket()
+        self.request(remote, "stats", {}, addr=("10.0.0.5", 40000))
+        self.assertEqual(remote.replies()[-1]["command"], "error")
+
+    def test_anti_entropy_repair_keeps_changes_made_during_the_round(self):
+        coordinator = handle_servers.ServerCoordinator(
+            vm=self.server, vm_id=self.server.id, allowed_hosts=["127.0.0.1"], starting_ports=[60000],
+            max_ports=[1], current_host="127.0.0.1", current_port=60001)
+        coordinator.leader = "127.0.0.1:60000"
+        for name in ("alice", "bob"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        keys = ["user:alice", "user:bob"]
+        leader_copy = {key: {"password": "leader", "logged_in": False, "addr": None} for key in keys}
+
+        def repair(applied):
+            self.server.database["users"]["bob"]["logged_in"] = False
+            coordinator.repair_fetched = {key: self.server.merkle.item_hash(key) for key in keys}
+            # bob logs in here after the fetch went out
+            self.server.database["users"]["bob"]["logged_in"] = True
+            coordinator.handle_peer_frame(None, {"version": 0, "command": "merkle_repair", "host": "127.0.0.1",
+                                                 "port": 60000, "data": {"items": leader_copy, "applied": applied}})
+        # a leader that has not applied all of our updates overwrites nothing
+        self.server.database["settings"]["applied"] = {"other:1": 3}
+        repair({"other:1": 2})
+        self.assertEqual(self.server.database["users"]["alice"]["password"], "pw")
+        repair({"other:1": 3})
+        self.assertEqual(self.server.database["users"]["alice"]["password"], "leader")
+        self.assertEqual(self.server.database["users"]["bob"]["password"], "pw")
+        self.assertTrue(self.server.database["users"]["bob"]["logged_in"])
+
+    def test_anti_entropy_repairs_only_differing_keys(self):
+        follower = server.FaultTolerantServer(1, "127.0.0.1", 50001)
+        for vm in (self.server, follower):
+            for name in ("alice", "bob"):
+                vm.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+            vm.rebuild_indexes()
+        # the follower missed a message and holds an account the leader never had
+        self.request(DummyClientSocket(), "send_msg", {"sender": "alice", "recipient": "bob", "message": "hi"})
+        follower.database["users"]["ghost"] = {"password": "pw", "logged_in": False, "addr": None}
+        follower.touch_user("ghost")
+        coordinators = {}
+        for vm, port in ((self.server, 60000), (follower, 60001)):
+            coordinators[port] = handle_servers.ServerCoordinator(
+                vm=vm, vm_id=vm.id, allowed_hosts=["127.0.0.1"], starting_ports=[60000],
+                max_ports=[1], current_host="127.0.0.1", current_port=port)
+            coordinators[port].leader = "127.0.0.1:60000"
+        coordinators[60001].leader_applied = {}
+        coordinators[60001].leader_applied_at = time.monotonic()
+        fetched = []
+        def link(sender, receiver):
+            def send(peer, command, payload):
+                if command == "merkle_fetch":
+                    fetched.extend(payload["keys"])
+                frame = {"version": 0, "command": command, "host": sender.host, "port": sender.port,
+                         "data": payload}
+                receiver.handle_peer_frame(None, json.loads(json.dumps(frame)))
+            sender.send_merkle = send
+        link(coordinators[60000], coordinators[60001])
+        link(coordinators[60001], coordinators[60000])
+        coordinators[60001].start_anti_entropy()
+        self.assertEqual(sorted(fetched), ["mail:bob", "user:ghost"])
+        self.assertNotIn("ghost", follower.database["users"])
+        self.assertEqual(follower.mailbox_of("bob"), self.server.mailbox_of("bob"))
+        self.assertEqual(follower.merkle.root(), self.server.merkle.root())
+        # the replicated update arriving after the repair does not store the message twice
+        update = self.server.internal_communicator.updates[-1]
+        follower.process_msg(None, {"version": 0, "command": "send_msg", "data": update["data"]}, True)
+        self.assertEqual(len(follower.index.received("bob")), 1)
+
+    def test_replicated_update_applied_without_reparsing(self):
+        for name in ("alice", "bob"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        update = {"version": 0, "command": "send_msg", "data": {
+            "sender": "alice", "recipient": "bob", "message": "hi", "id": 5, "timestamp": 1.0}}
+        with patch("json.loads", wraps=json.loads) as loads:
+            self.server.process_msg(None, update, True)
+        loads.assert_not_called()
+        self.assertEqual(self.server.database["messages"]["undelivered"][5]["message"], "hi")
+
+    def test_snowflake_ids_for_sent_messages(self):
+        self.server.id_generator = message_ids.MessageIdGenerator(7)
+        for name in ("alice", "bob"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        self.request(DummyClientSocket(), "send_msg", {"sender": "alice", "recipient": "bob", "message": "hi"})
+        msg_id = self.server.internal_communicator.updates[-1]["data"]["id"]
+        self.assertIn(msg_id, self.server.database["messages"]["undelivered"])
+        self.assertEqual(message_ids.MessageIdGenerator.node_of(msg_id), 7)
+        self.assertEqual(self.server.database["settings"]["counter"], 0)
+        # numbers are never guessed from the address, where two nodes could collide
+        with self.assertRaises(ValueError):
+            server.FaultTolerantServer(0, "127.0.0.1", 50003, id_scheme="snowflake")
+
+    def test_get_messages_since(self):
+        for name in ("alice", "bob"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        for ts in (10.0, 20.0, 30.0):
+            with patch("server.time.time", return_value=ts):
+                self.request(DummyClientSocket(), "send_msg", {"sender": "alice", "recipient": "bob", "message": str(ts)})
+        sock = DummyClientSocket()
+        self.request(sock, "get_messages_since", {"username": "bob", "since_time": 10.0})
+        self.assertEqual([m["message"] for m in sock.replies()[-1]["data"]["messages"]], ["20.0", "30.0"])
+        sock = DummyClientSocket()
+        self.request(sock, "get_messages_since", {"username": "bob", "since_id": 1, "num_messages": 1})
+        self.assertEqual([m["id"] for m in sock.replies()[-1]["data"]["messages"]], [2])
+        sock = DummyClientSocket()
+        self.request(sock, "get_messages_since", {"username": "alice", "since_time": 0})
+        self.assertEqual(sock.replies()[-1]["data"]["messages"], [])
+        # bounds of the wrong type get an error reply instead of raising in the server loop
+        for bad in ({"since_time": "10"}, {"since_id": "1"}, {"since_id": [1]}, {"since_time": 0, "num_messages": -1}):
+            sock = DummyClientSocket()
+            self.request(sock, "get_messages_since", {"username": "bob", **bad})
+            self.assertEqual(sock.replies()[-1]["command"], "error")
+
+    def test_get_conversation_pages(self):
+        for name in ("alice", "bob", "carol"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        for sender, recipient in [("alice", "bob"), ("bob", "alice"), ("carol", "bob"), ("alice", "bob")]:
+            self.request(DummyClientSocket(), "send_msg", {"sender": sender, "recipient": recipient, "message": "m"})
+        sock = DummyClientSocket()
+        self.request(sock, "get_conversation", {"username": "bob", "other_user": "alice", "num_messages": 2})
+        reply = sock.replies()[-1]["data"]
+        self.assertEqual([m["id"] for m in reply["messages"]], [2, 4])
+        sock = DummyClientSocket()
+        self.request(sock, "get_conversation", {"username": "bob", "other_user": "alice",
+                                                "num_messages": 2, "before_id": reply["next_before_id"]})
+        reply = sock.replies()[-1]["data"]
+        self.assertEqual([m["id"] for m in reply["messages"]], [1])
+        self.assertIsNone(reply["next_before_id"])
+        # bad page bounds get an error reply instead of raising in the server loop
+        for bad in ({"num_messages": 0}, {"num_messages": -1}, {"num_messages": "2"}, {"before_id": [1]}):
+            sock = DummyClientSocket()
+            self.request(sock, "get_conversation", {"username": "bob", "other_user": "alice", **bad})
+            self.assertEqual(sock.replies()[-1]["command"], "error")
+
+    def test_delete_account_updates_conversation_index(self):
+        for name in ("alice", "bob"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        self.request(DummyClientSocket(), "send_msg", {"sender": "alice", "recipient": "bob", "message": "m"})
+        self.request(DummyClientSocket(), "delete_acct", {"username": "alice"})
+        self.assertEqual(self.server.index.by_conversation, {})
+        self.assertEqual(self.server.index.by_id, {})
+
+    def test_delete_account_touches_only_its_messages(self):
+        for name in ("alice", "bob", "carol"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        self.request(DummyClientSocket(), "send_msg", {"sender": "alice", "recipient": "bob", "message": "a"})
+        self.request(DummyClientSocket(), "send_msg", {"sender": "carol", "recipient": "bob", "message": "c"})
+        self.request(DummyClientSocket(), "send_msg", {"sender": "bob", "recipient": "alice", "message": "b"})
+        self.request(DummyClientSocket(), "delete_acct", {"username": "alice"})
+        self.assertEqual(list(self.server.database["messages"]["undelivered"]), [2])
+        self.assertEqual(self.server.count_pending("bob"), 1)
+        with open(database.messages_store_location(self.server.id)) as f:
+            self.assertEqual([m["id"] for m in json.load(f)["undelivered"]], [2])
+
+    def test_delete_msg_ids_and_ranges(self):
+        for name in ("alice", "bob"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": True, "addr": None}
+        for i in range(6):
+            self.request(DummyClientSocket(), "send_msg", {"sender": "alice", "recipient": "bob", "message": str(i)})
+        self.server.persist()
+        self.request(DummyClientSocket(), "delete_msg", {"current_user": "bob", "delete_ids": "1,3-4"})
+        self.request(DummyClientSocket(), "delete_msg", {"current_user": "bob", "delete_ids": [6],
+                                                         "delete_ranges": [[5, 1000]]})
+        self.request(DummyClientSocket(), "delete_msg", {"current_user": "alice", "delete_ids": [2]})
+        self.assertEqual(list(self.server.database["messages"]["delivered"]), [2])
+        self.assertEqual(self.server.internal_communicator.updates[-1]["data"]["delete_ids"], [5, 6])
+        # deletions are journaled rather than rewriting the stores
+        self.assertEqual(len(database.read_journal(self.server.id)), 2)
+        _, messages, _ = database.fetch_data_stores(self.server.id)
+        self.assertEqual([m["id"] for m in messages["delivered"]], [2])
+
+    def test_get_undelivered_replicates_moved_ids(self):
+        for name in ("alice", "bob"):
+            self.server.database["users"][name] = {"password": "pw", "logged_in": False, "addr": None}
+        for i in range(3):
+            self.request(DummyClientSocket(), "send_msg", {"sender": "alice", "recipient": "bob", "message": str(i)})
+        self.request(DummyClientSocket(), "get_undelivered", {"username": "bob", "num_messages": 2})
+        update = self.server.internal_communicator.updates[-1]
+        self.assertEqual(update["data"]["ids"], [1, 2])
+        # applying the update on a replica moves the same messages
+        self.server.database["messages"]["undelivered"].update(
+            {i: self.server.database["messages"]["delivered"].pop(i) for i in (1, 2)})
+        self.server.fetch_pending_msgs(None, {"version": 0, "command": "get_undelivered",
+                                              "data": update["data"]}, True)
+        self.assertEqual(list(self.server.database["messages"]["undelivered"]), [3])
+
+    def test_delete_msg_rejects_bad_ids(self):
+        sock = DummyClientSocket()
+        self.request(sock, "delete_msg", {"current_user": "bob", "delete_ids": "abc"})
+        self.assertEqual(sock.replies()[-1]["command"], "error")
+        for bad in ([[1]], [["a", "b"]], [[1, 2, 3]], [5], "1-2"):
+            sock = DummyClientSocket()
+            self.request(sock, "delete_msg", {"current_user": "bob", "delete_ranges": bad})
+            self.assertEqual(sock.replies()[-1]["command"], "error")
         
 class TestMainModule(unittest.TestCase):
     def test_setup_command_parameters_default(self):
@@ -0,0 +1,43 @@
+import concurrent.futures
+import json
+import signal
+
+# replies whose list payloads hold at least this many entries are encoded off the event loop
+DEFAULT_OFFLOAD_THRESHOLD = 200
+
+
+def encode_frame(obj):
+    # json encode a client reply or a snapshot payload into utf-8 bytes
+    # kept at module level so a process pool can pickle it
+    return json.dumps(obj).encode("utf-8")
+
+
+def reset_worker_signals():
+    # pool processes fork after the server installs its drain handler; restore the default
+    # so a signal to the process group stops them instead of poking the parent's wakeup socket
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def create_pool(kind, num_workers):
+    # builds the executor used for cpu heavy serialization, or None to encode inline
+    if num_workers <= 0:
+        return None
+    if kind == "process":
+        return concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=reset_worker_signals)
+    if kind == "thread":
+        return concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+    raise ValueError(f"unknown serialization pool kind: {kind}")
+
+
+def payload_size(payload):
+    # rough cost estimate of encoding a reply: the number of entries in its list fields
+    size = 0
+    for value in payload.values():
+        if isinstance(value, (list, dict)):
+            size += len(value)
+    return size
+
+
+def should_offload(pool, payload, threshold):
+    # decide whether a payload is big enough to be worth a trip to the pool
+    return pool is not None and payload_size(payload) >= threshold